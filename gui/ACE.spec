@@ -1,7 +1,8 @@
 # -*- mode: python ; coding: utf-8 -*-
-from PyInstaller.utils.hooks import copy_metadata
+from PyInstaller.utils.hooks import collect_data_files, copy_metadata
 
 datas = [('/Users/leework/miniconda3/anaconda3/envs/ace/lib/python3.10/site-packages/eel/eel.js', 'eel'), ('views', 'views'), ('trained_model_w_data_augmentation_b3000.pt', '.')]
+datas += collect_data_files('acelib')
 datas += copy_metadata('tqdm')
 datas += copy_metadata('regex')
 datas += copy_metadata('filelock')
@@ -17,11 +17,13 @@ import pandas as pd
 import random
 import socket
 import os
+import threading
 import torch
 from importlib import resources
 from typing import Dict
 from acelib.constants import *
 from acelib.main import run_ace_generate, run_ace_deconvolve
+from acelib.model_registry import warm_up_ace_engine
 from acelib.block_assignment import BlockAssignment, infer_coverage_ids
 from acelib.plate_well import PlateWell
 from acelib.peptide import Peptide
@@ -31,6 +33,10 @@ from acelib.utilities import get_open_port
 eel.init('views')
 
 
+EMBEDDING_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.ace', 'embedding_cache')
+TRAINED_MODEL_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'trained_model_w_data_augmentation_b3000.pt')
+
+
 @eel.expose
 def generate_configuration(
         sequences_available: bool,
@@ -71,12 +77,11 @@ def generate_configuration(
         allow_extra_pools = False
 
     # Step 2. Generate an ELISpot configuration
-    dir_path = os.path.dirname(os.path.realpath(__file__))
     block_assignment, block_design = run_ace_generate(
         peptides=peptides_,
         num_peptides_per_pool=num_peptides_per_pool,
         num_coverage=num_coverage,
-        trained_model_file=dir_path + '/trained_model_w_data_augmentation_b3000.pt',
+        trained_model_file=TRAINED_MODEL_FILE,
         cluster_peptides=cluster_peptides,
         mode=GenerateMode.GOLFY,
         sequence_similarity_function=SequenceSimilarityFunction(sequence_similarity_fxn),
@@ -85,7 +90,8 @@ def generate_configuration(
         golfy_strategy=GolfyStrategy(init_strategy),
         golfy_max_iters=max_iters,
         golfy_allow_extra_pools=allow_extra_pools,
-        num_plate_wells=NumPlateWells(plate_size)
+        num_plate_wells=NumPlateWells(plate_size),
+        embedding_cache_dir=EMBEDDING_CACHE_DIR
     )
 
     return block_assignment.to_dataframe().to_dict(), \
@@ -210,4 +216,7 @@ def find_port(port=1111):
 if __name__ == '__main__':
     multiprocessing.freeze_support()
     os.environ["KMP_DUPLICATE_LIB_OK"] = "True" # For Windows
+    if os.path.exists(TRAINED_MODEL_FILE):
+        # Load the neural engine in the background so that the first 'generate' does not wait for it
+        threading.Thread(target=warm_up_ace_engine, kwargs={'trained_model_file': TRAINED_MODEL_FILE}, daemon=True).start()
     eel.start('html/index.html', size=(1920, 1080), port=get_open_port())
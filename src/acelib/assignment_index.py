@@ -0,0 +1,236 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+The purpose of this python3 script is to implement the AssignmentIndex class,
+an integer-indexed columnar view of a BlockAssignment.
+"""
+
+
+import numpy as np
+import pandas as pd
+from dataclasses import dataclass
+from scipy.sparse import csr_matrix, triu
+from typing import Mapping
+from .logger import get_logger
+from .plate_well import PlateWell
+from .pool import Pool
+
+
+logger = get_logger(__name__)
+
+
+@dataclass(frozen=True)
+class AssignmentIndex:
+    """
+    Peptides are indexed in sorted peptide ID order and pools in insertion order.
+    Each (pool, peptide) entry of the assignment is one non-zero of the incidence
+    matrices; entries keep their insertion order within a pool.
+    """
+    peptide_ids: np.ndarray         # (num_peptides,) peptide IDs (sorted)
+    peptide_sequences: np.ndarray   # (num_peptides,) peptide sequences
+    pool_ids: np.ndarray            # (num_pools,) pool IDs
+    coverage_ids: np.ndarray        # (num_pools,) coverage ID of each pool
+    plate_ids: np.ndarray           # (num_pools,) plate ID of each pool ('' if not assigned)
+    well_ids: np.ndarray            # (num_pools,) well ID of each pool ('' if not assigned)
+    pool_peptides: csr_matrix       # (num_pools, num_peptides) pool -> peptide incidence
+    peptide_pools: csr_matrix       # (num_peptides, num_pools) peptide -> pool incidence
+
+    @property
+    def num_entries(self) -> int:
+        """
+        Return the total number of (pool, peptide) entries.
+
+        Returns:
+            num_entries :   Number of entries.
+        """
+        return int(self.pool_peptides.indptr[-1])
+
+    @property
+    def num_peptides(self) -> int:
+        """
+        Return the total number of peptides.
+
+        Returns:
+            num_peptides    :   Number of peptides.
+        """
+        return len(self.peptide_ids)
+
+    @property
+    def num_pools(self) -> int:
+        """
+        Return the total number of pools.
+
+        Returns:
+            num_pools   :   Number of pools.
+        """
+        return len(self.pool_ids)
+
+    @property
+    def entry_pool_indices(self) -> np.ndarray:
+        """
+        Return the pool index of each entry (in pool -> peptide CSR order).
+
+        Returns:
+            pool_indices    :   Array of pool indices.
+        """
+        return np.repeat(np.arange(self.num_pools, dtype=np.int64), np.diff(self.pool_peptides.indptr))
+
+    def get_peptide_index(self, peptide_id: str) -> int:
+        """
+        Return the index of a peptide ID.
+
+        Parameters:
+            peptide_id      :   Peptide ID.
+
+        Returns:
+            peptide_idx     :   Peptide index.
+        """
+        peptide_idx = int(np.searchsorted(self.peptide_ids, peptide_id))
+        if peptide_idx == len(self.peptide_ids) or self.peptide_ids[peptide_idx] != peptide_id:
+            raise KeyError('Peptide ID %s not found.' % peptide_id)
+        return peptide_idx
+
+    def compute_peptide_cooccurrence(self) -> csr_matrix:
+        """
+        Compute the number of distinct pools shared by each pair of peptides
+        as the sparse product A·Aᵀ of the binary peptide x pool incidence matrix A.
+
+        Returns:
+            cooccurrence    :   CSR matrix of shape (num_peptides, num_peptides) holding
+                                the pair co-occurrence counts in the upper triangle
+                                (row < column); pairs that never share a pool are absent.
+        """
+        # Copy before deduplicating; sum_duplicates would reorder the index in place
+        incidence = csr_matrix(
+            (np.ones(self.num_entries, dtype=np.int32),
+             self.peptide_pools.indices.copy(),
+             self.peptide_pools.indptr.copy()),
+            shape=self.peptide_pools.shape
+        )
+        incidence.sum_duplicates()
+        incidence.data[:] = 1
+        cooccurrence = triu(incidence @ incidence.T, k=1, format='csr')
+        cooccurrence.eliminate_zeros()
+        return cooccurrence
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Return a Pandas DataFrame with one row per entry (in pool -> peptide CSR order).
+
+        Returns:
+            df_assignments  :   Pandas DataFrame with the following columns:
+
+                                    - 'coverage_id'
+                                    - 'pool_id'
+                                    - 'peptide_id'
+                                    - 'peptide_sequence'
+                                    - 'plate_id'
+                                    - 'well_id'
+        """
+        pool_indices = self.entry_pool_indices
+        peptide_indices = self.pool_peptides.indices
+        return pd.DataFrame({
+            'coverage_id': self.coverage_ids[pool_indices],
+            'pool_id': self.pool_ids[pool_indices],
+            'peptide_id': self.peptide_ids[peptide_indices].tolist(),
+            'peptide_sequence': self.peptide_sequences[peptide_indices].tolist(),
+            'plate_id': self.plate_ids[pool_indices].tolist(),
+            'well_id': self.well_ids[pool_indices].tolist()
+        })
+
+    @staticmethod
+    def from_pools(
+            pools: Mapping[int, Pool],
+            plate_map: Mapping[int, PlateWell]
+    ) -> 'AssignmentIndex':
+        """
+        Build an AssignmentIndex from pools and a plate map.
+
+        Parameters:
+            pools       :   Mapping from a pool ID to a Pool object.
+            plate_map   :   Mapping from a pool ID to plate and well IDs.
+
+        Returns:
+            index       :   AssignmentIndex object.
+        """
+        # Step 1. Collect pool columns and entries (pools without peptides are skipped)
+        pool_ids = []
+        coverage_ids = []
+        plate_ids = []
+        well_ids = []
+        pool_sizes = []
+        entry_peptide_ids = []
+        peptide_sequences = {}
+        for pool in pools.values():
+            if len(pool.peptides) == 0:
+                continue
+            pool_ids.append(pool.id)
+            coverage_ids.append(pool.coverage_id)
+            if pool.id in plate_map:
+                plate_ids.append(plate_map[pool.id].plate_id)
+                well_ids.append(plate_map[pool.id].well_id)
+            else:
+                plate_ids.append('')
+                well_ids.append('')
+            pool_sizes.append(len(pool.peptides))
+            for peptide in pool.peptides:
+                entry_peptide_ids.append(peptide.id)
+                peptide_sequences.setdefault(peptide.id, peptide.sequence)
+
+        # Step 2. Index peptides in sorted peptide ID order
+        peptide_ids = np.empty(len(peptide_sequences), dtype=object)
+        peptide_ids[:] = sorted(peptide_sequences.keys())
+        sequences = np.empty(len(peptide_ids), dtype=object)
+        sequences[:] = [peptide_sequences[peptide_id] for peptide_id in peptide_ids]
+        peptide_idx = {peptide_id: idx for idx, peptide_id in enumerate(peptide_ids)}
+        entry_peptide_indices = np.fromiter(
+            (peptide_idx[peptide_id] for peptide_id in entry_peptide_ids),
+            dtype=np.int64,
+            count=len(entry_peptide_ids)
+        )
+
+        # Step 3. Build the pool -> peptide incidence (entries are already grouped by pool)
+        num_pools = len(pool_ids)
+        num_peptides = len(peptide_ids)
+        pool_indptr = np.zeros(num_pools + 1, dtype=np.int64)
+        np.cumsum(pool_sizes, out=pool_indptr[1:])
+        pool_peptides = csr_matrix(
+            (np.ones(len(entry_peptide_indices), dtype=np.int8), entry_peptide_indices, pool_indptr),
+            shape=(num_pools, num_peptides)
+        )
+
+        # Step 4. Build the peptide -> pool incidence (stable, so pools keep insertion order)
+        entry_pool_indices = np.repeat(np.arange(num_pools, dtype=np.int64), pool_sizes)
+        order = np.argsort(entry_peptide_indices, kind='stable')
+        peptide_indptr = np.zeros(num_peptides + 1, dtype=np.int64)
+        np.cumsum(np.bincount(entry_peptide_indices, minlength=num_peptides), out=peptide_indptr[1:])
+        peptide_pools = csr_matrix(
+            (np.ones(len(order), dtype=np.int8), entry_pool_indices[order], peptide_indptr),
+            shape=(num_peptides, num_pools)
+        )
+
+        plate_ids_ = np.empty(num_pools, dtype=object)
+        plate_ids_[:] = plate_ids
+        well_ids_ = np.empty(num_pools, dtype=object)
+        well_ids_[:] = well_ids
+        return AssignmentIndex(
+            peptide_ids=peptide_ids,
+            peptide_sequences=sequences,
+            pool_ids=np.array(pool_ids, dtype=np.int64),
+            coverage_ids=np.array(coverage_ids, dtype=np.int64),
+            plate_ids=plate_ids_,
+            well_ids=well_ids_,
+            pool_peptides=pool_peptides,
+            peptide_pools=peptide_pools
+        )
@@ -19,12 +19,17 @@ The purpose of this python3 script is to implement the BlockAssignment dataclass
 import copy
 import math
 import random
+import numpy as np
 from collections import defaultdict
 from dataclasses import dataclass, field
 from golfy import Design
 from itertools import combinations, product
-from typing import Dict, List, Mapping, Tuple
+from scipy.sparse import csr_matrix, triu
+from scipy.sparse.csgraph import connected_components
+from typing import Callable, Dict, List, Mapping, Tuple
+from .assignment_index import AssignmentIndex
 from .constants import *
+from .defaults import DEFAULT_GENERATE_CPSAT_SOLVER_ALIGNMENT_PASSES
 from .logger import get_logger
 from .peptide import Peptide
 from .peptide_set import PeptideSet
@@ -48,47 +53,33 @@ def compute_transitive_neighbors(
     Returns:
         peptide_neighbors   :   List of list of peptide IDs.
     """
-    # Step 1. Create a dictionary to store peptide relationships
-    # peptide_dict:
-    # {
-    #     peptide_id_1: set(peptide_id_2, peptide_id_3,...),
-    #     peptide_id_2: set(peptide_id_1, peptide_id_4,...),
-    #     ...
-    # }
-    peptide_dict = {}
+    # Step 1. Index peptide IDs in order of first appearance
+    peptide_idx = {}
+    rows = []
+    cols = []
     for peptide_id_1, peptide_id_2, score in peptide_pairs:
-        if peptide_id_1 not in peptide_dict:
-            peptide_dict[peptide_id_1] = set()
-        if peptide_id_2 not in peptide_dict:
-            peptide_dict[peptide_id_2] = set()
-        peptide_dict[peptide_id_1].add(peptide_id_2)
-        peptide_dict[peptide_id_2].add(peptide_id_1)
-
-    # Step 2. Find transitive peptide IDs
-    transitive_peptides = []
-    for peptide_id in peptide_dict:
-        stack = list(peptide_dict[peptide_id])
-        visited = set()
-        while stack:
-            curr_peptide_id = stack.pop()
-            if curr_peptide_id not in visited:
-                visited.add(curr_peptide_id)
-                if curr_peptide_id in peptide_dict:
-                    stack.extend(peptide_dict[curr_peptide_id])
-        transitive_peptides.append(list(visited))
-
-    # Step 3. De-duplicate peptide IDs
-    transitive_peptides_ = []
-    for i in transitive_peptides:
-        duplicate = False
-        for j in transitive_peptides_:
-            if set(i) == j:
-                duplicate = True
-                break
-        if not duplicate:
-            transitive_peptides_.append(set(i))
+        rows.append(peptide_idx.setdefault(peptide_id_1, len(peptide_idx)))
+        cols.append(peptide_idx.setdefault(peptide_id_2, len(peptide_idx)))
+    if len(peptide_idx) == 0:
+        return []
+
+    # Step 2. Find connected components of the peptide pair graph
+    graph = csr_matrix(
+        (np.ones(len(rows), dtype=np.int8), (rows, cols)),
+        shape=(len(peptide_idx), len(peptide_idx))
+    )
+    _, labels = connected_components(csgraph=graph, directed=False)
 
-    return [list(p) for p in transitive_peptides_]
+    # Step 3. Group peptide IDs by component (components and their members
+    # are ordered by first appearance in peptide_pairs)
+    component_idx = {}
+    transitive_peptides = []
+    for peptide_id, label in zip(peptide_idx.keys(), labels.tolist()):
+        if label not in component_idx:
+            component_idx[label] = len(transitive_peptides)
+            transitive_peptides.append([])
+        transitive_peptides[component_idx[label]].append(peptide_id)
+    return transitive_peptides
 
 
 def infer_coverage_ids(df: pd.DataFrame) -> pd.DataFrame:
@@ -274,6 +265,35 @@ class BlockAssignment:
         default_factory=dict,
         metadata={"doc": "Mapping from a pool ID to plate and well IDs."}
     )
+    _version: int = field(
+        default=0,
+        init=False,
+        repr=False,
+        compare=False,
+        metadata={"doc": "Incremented on every mutation; invalidates cached derived data."}
+    )
+    _cache: Dict[str, Tuple[int, object]] = field(
+        default_factory=dict,
+        init=False,
+        repr=False,
+        compare=False,
+        metadata={"doc": "Mapping from a cache key to (version, derived data)."}
+    )
+
+    @property
+    def assignment_index(self) -> AssignmentIndex:
+        """
+        Return the integer-indexed columnar view (peptide and pool arrays and
+        CSR incidence matrices) of this BlockAssignment. The view is built once
+        per version (see bump_version).
+
+        Returns:
+            assignment_index    :   AssignmentIndex object.
+        """
+        return self._get_cached(
+            key='assignment_index',
+            build=lambda: AssignmentIndex.from_pools(pools=self.pools, plate_map=self.plate_map)
+        )
 
     @property
     def coverage_ids(self) -> List[int]:
@@ -281,10 +301,9 @@ class BlockAssignment:
         Return all coverage IDs.
 
         Returns:
-            coverage_ids    :   Coverage IDs.
+            coverage_ids    :   Coverage IDs (sorted).
         """
-        df_assignments = self.to_dataframe()
-        return list(df_assignments['coverage_id'].unique())
+        return np.unique(self.assignment_index.coverage_ids).tolist()
 
     @property
     def num_peptides(self) -> int:
@@ -294,8 +313,7 @@ class BlockAssignment:
         Returns:
             num_peptides   :   Total number of peptides.
         """
-        df_assignments = self.to_dataframe()
-        return len(list(df_assignments['peptide_id'].unique()))
+        return self.assignment_index.num_peptides
 
     @property
     def num_pools(self) -> int:
@@ -305,8 +323,7 @@ class BlockAssignment:
         Returns:
             num_pools   :   Total number of pools.
         """
-        df_assignments = self.to_dataframe()
-        return len(list(df_assignments['pool_id'].unique()))
+        return len(np.unique(self.assignment_index.pool_ids))
 
     @property
     def num_violations(self) -> int:
@@ -316,24 +333,37 @@ class BlockAssignment:
         Returns:
             num_violations  :   Number of violations.
         """
-        # Step 1. Create a dictionary of peptides and pools
-        df_assignments = self.to_dataframe()
-        peptide_pool_dict = defaultdict(list) # key = peptide ID, value = list of pool IDs
-        peptide_ids = list(df_assignments['peptide_id'].unique())
-        for peptide_id in peptide_ids:
-            peptide_pool_dict[peptide_id] = list(df_assignments.loc[df_assignments['peptide_id'] == peptide_id, 'pool_id'].unique())
-
-        # Step 2. Count the number of violations
-        num_violations = 0
-        for i in range(0, len(peptide_ids)):
-            for j in range(i + 1, len(peptide_ids)):
-                p1_pools = peptide_pool_dict[peptide_ids[i]]
-                p2_pools = peptide_pool_dict[peptide_ids[j]]
-                shared_pools = set(p1_pools).intersection(set(p2_pools))
-                if len(shared_pools) > 1:
-                    num_violations += len(shared_pools) - 1
-
-        return num_violations
+        cooccurrence = self.peptide_cooccurrence
+        return int(np.maximum(cooccurrence.data.astype(np.int64) - 1, 0).sum())
+
+    @property
+    def pair_cooccurrence_counts(self) -> np.ndarray:
+        """
+        Return the multiset of pair co-occurrence counts.
+
+        Returns:
+            counts  :   Array where counts[c] is the number of peptide pairs
+                        pooled together in exactly c pools (including c = 0).
+        """
+        cooccurrence = self.peptide_cooccurrence
+        counts = np.bincount(cooccurrence.data, minlength=2).astype(np.int64)
+        num_peptides = cooccurrence.shape[0]
+        counts[0] = num_peptides * (num_peptides - 1) // 2 - cooccurrence.nnz
+        return counts
+
+    @property
+    def peptide_cooccurrence(self) -> csr_matrix:
+        """
+        Return the number of pools shared by each pair of peptides.
+
+        Returns:
+            cooccurrence    :   CSR matrix (row < column) over peptide indices
+                                (see assignment_index.peptide_ids).
+        """
+        return self._get_cached(
+            key='peptide_cooccurrence',
+            build=lambda: self.assignment_index.compute_peptide_cooccurrence()
+        )
 
     @property
     def peptide_ids(self) -> List[str]:
@@ -341,10 +371,9 @@ class BlockAssignment:
         Return all peptide IDs.
 
         Returns:
-            peptide_ids :   Peptide IDs.
+            peptide_ids :   Peptide IDs (sorted).
         """
-        df_assignments = self.to_dataframe()
-        return list(df_assignments['peptide_id'].unique())
+        return self.assignment_index.peptide_ids.tolist()
 
     @property
     def pool_ids(self) -> List[int]:
@@ -352,10 +381,9 @@ class BlockAssignment:
         Return all pool IDs.
 
         Returns:
-            pool_ids    :   Pool IDs.
+            pool_ids    :   Pool IDs (sorted).
         """
-        df_assignments = self.to_dataframe()
-        return list(df_assignments['pool_id'].unique())
+        return np.unique(self.assignment_index.pool_ids).tolist()
 
     @property
     def pooled_peptide_pairs(self) -> List[Tuple[str,str]]:
@@ -366,12 +394,60 @@ class BlockAssignment:
             peptide_pairs   :   List of all peptide pairs that appear together in a pool.
         """
         peptide_pairs = []
-        df_assignments = self.to_dataframe()
-        for name, group in df_assignments.groupby('pool_id'):
-            for peptide_id_1, peptide_id_2 in combinations(group['peptide_id'], r=2):
+        index = self.assignment_index
+        pool_peptides = index.pool_peptides
+        for pool_idx in np.argsort(index.pool_ids, kind='stable'):
+            peptide_indices = np.sort(pool_peptides.indices[pool_peptides.indptr[pool_idx]:pool_peptides.indptr[pool_idx + 1]])
+            for peptide_id_1, peptide_id_2 in combinations(index.peptide_ids[peptide_indices].tolist(), r=2):
                 peptide_pairs.append((peptide_id_1, peptide_id_2))
         return peptide_pairs
 
+    @property
+    def violating_peptide_pairs(self) -> List[Tuple[str,str,int]]:
+        """
+        Return the peptide pairs that are pooled together more than once.
+
+        Returns:
+            peptide_pairs   :   List of (peptide ID, peptide ID, number of shared pools).
+        """
+        index = self.assignment_index
+        cooccurrence = self.peptide_cooccurrence
+        rows = np.repeat(np.arange(cooccurrence.shape[0]), np.diff(cooccurrence.indptr))
+        is_violation = cooccurrence.data > 1
+        return list(zip(
+            index.peptide_ids[rows[is_violation]].tolist(),
+            index.peptide_ids[cooccurrence.indices[is_violation]].tolist(),
+            cooccurrence.data[is_violation].tolist()
+        ))
+
+    def _get_cached(self, key: str, build: Callable[[], object]) -> object:
+        """
+        Return cached derived data, building it if it is missing or stale.
+
+        Parameters:
+            key     :   Cache key.
+            build   :   Function that builds the derived data.
+
+        Returns:
+            value   :   Derived data.
+        """
+        if key in self._cache:
+            version, value = self._cache[key]
+            if version == self._version:
+                return value
+        value = build()
+        self._cache[key] = (self._version, value)
+        return value
+
+    def bump_version(self):
+        """
+        Invalidate cached derived data (index, DataFrame). All BlockAssignment
+        methods that mutate pools or the plate map call this; callers that
+        mutate self.pools or self.plate_map directly must call it themselves.
+        """
+        self._version += 1
+        self._cache = {}
+
     def add_peptide(
             self,
             peptide_id: str,
@@ -401,6 +477,7 @@ class BlockAssignment:
                 "Coverage ID mismatch for pool ID %i: expected %i, found %i" % (pool_id, self.pools[pool_id].coverage_id, coverage_id)
             )
             self.pools[pool_id].add_peptide(peptide=peptide)
+        self.bump_version()
 
     def assign_well_ids(self, num_plate_wells: NumPlateWells):
         """
@@ -443,7 +520,7 @@ class BlockAssignment:
             raise Exception("Unsupported number of wells: %i" % num_plate_wells)
 
         # Step 3. Assign well IDs
-        for pool_id in sorted(self.to_dataframe()['pool_id'].unique()):
+        for pool_id in self.pool_ids:
             if len(curr_well_ids) == 0:
                 if num_plate_wells == NumPlateWells.WELLS_24:
                     curr_well_ids = get_24_well_ids()
@@ -463,6 +540,7 @@ class BlockAssignment:
                 well_id=curr_well_id
             )
             self.plate_map[pool_id] = plate_well
+        self.bump_version()
 
     def get_peptide_sequence(self, peptide_id: str) -> str:
         """
@@ -471,8 +549,8 @@ class BlockAssignment:
         Returns:
             peptide_sequence    :   Peptide sequence.
         """
-        df = self.to_dataframe()
-        return str(df.loc[df['peptide_id'] == peptide_id, 'peptide_sequence'].values[0])
+        index = self.assignment_index
+        return str(index.peptide_sequences[index.get_peptide_index(peptide_id=peptide_id)])
 
     def get_pool_ids(self, peptide_id: str) -> List[int]:
         """
@@ -481,8 +559,10 @@ class BlockAssignment:
         Returns:
             pool_ids    :   List of pool IDs.
         """
-        df = self.to_dataframe()
-        return df.loc[df['peptide_id'] == peptide_id, 'pool_id'].values.tolist()
+        index = self.assignment_index
+        peptide_idx = index.get_peptide_index(peptide_id=peptide_id)
+        peptide_pools = index.peptide_pools
+        return index.pool_ids[peptide_pools.indices[peptide_pools.indptr[peptide_idx]:peptide_pools.indptr[peptide_idx + 1]]].tolist()
 
     def is_optimal(
             self,
@@ -505,12 +585,16 @@ class BlockAssignment:
         Returns:
             is_optimal              :   True if the input configuration meets all desired criteria. False otherwise.
         """
-        df_assignments = self.to_dataframe()
+        index = self.assignment_index
+        peptide_pools = index.peptide_pools
+        peptide_pool_ids = [
+            np.unique(index.pool_ids[peptide_pools.indices[peptide_pools.indptr[i]:peptide_pools.indptr[i + 1]]]).tolist()
+            for i in range(0, index.num_peptides)
+        ]
 
         # Step 1. Check if each peptide is in 'num_coverage' number of different pools.
         constraint_1_bool = True
-        for peptide_id in list(df_assignments['peptide_id'].unique()):
-            pool_ids = (df_assignments.loc[df_assignments['peptide_id'] == peptide_id, 'pool_id'].unique())
+        for peptide_id, pool_ids in zip(index.peptide_ids, peptide_pool_ids):
             if len(pool_ids) != num_coverage:
                 if verbose:
                     logger.info('Assignment does not meet constraint #1: peptide %s is in %i different pools (expected: %i).' %
@@ -523,9 +607,7 @@ class BlockAssignment:
         # Step 2. Check that each peptide belongs to exactly one unique combination of pool IDs
         constraint_2_bool = True
         pool_ids_peptides_dict = defaultdict(list)
-        for peptide_id in list(df_assignments['peptide_id'].unique()):
-            pool_ids = list(df_assignments.loc[df_assignments['peptide_id'] == peptide_id, 'pool_id'].unique())
-            pool_ids = sorted(pool_ids)
+        for peptide_id, pool_ids in zip(index.peptide_ids, peptide_pool_ids):
             pool_ids_peptides_dict[','.join([str(i) for i in pool_ids])].append(peptide_id)
         for key, value in pool_ids_peptides_dict.items():
             if len(value) > 1:
@@ -553,9 +635,9 @@ class BlockAssignment:
 
         # Step 4. Check that there is an optimal number of pools
         constraint_4_bool = True
-        num_pools = math.ceil(len(df_assignments['peptide_id'].unique()) / num_peptides_per_pool) * num_coverage
-        if len(df_assignments['pool_id'].unique()) != num_pools:
-            num_extra_pools = len(df_assignments['pool_id'].unique()) - num_pools
+        num_pools = math.ceil(index.num_peptides / num_peptides_per_pool) * num_coverage
+        if self.num_pools != num_pools:
+            num_extra_pools = self.num_pools - num_pools
             if verbose:
                 logger.info('Assignment does not meet constraint #4: %i extra pool(s) than the minimum possible number of pools (%i).' %
                             (num_extra_pools, num_pools))
@@ -571,8 +653,8 @@ class BlockAssignment:
         Shuffle pool IDs.
         """
         # Step 1. Shuffle pool IDs
-        curr_pool_ids = list(self.to_dataframe()['pool_id'].unique())
-        new_pool_ids = list(self.to_dataframe()['pool_id'].unique())
+        curr_pool_ids = self.pool_ids
+        new_pool_ids = self.pool_ids
         random.shuffle(new_pool_ids)
 
         # Step 2. Create a dictionary of old and new pool IDs
@@ -583,6 +665,7 @@ class BlockAssignment:
         # Step 3. Reassign pool IDs
         old_pools = self.pools
         self.pools = {}
+        self.bump_version()
         for old_pool_id, pool in old_pools.items():
             new_pool_id = new_pool_ids_dict[old_pool_id]
             coverage_id = pool.coverage_id
@@ -596,6 +679,7 @@ class BlockAssignment:
 
     def load_plate_map(self, plate_map: Dict[int,PlateWell]):
         self.plate_map = plate_map
+        self.bump_version()
 
     def to_bench_ready_dataframe(self) -> pd.DataFrame:
         """
@@ -637,31 +721,12 @@ class BlockAssignment:
                                     - 'plate_id'
                                     - 'well_id'
         """
-        data = {
-            'coverage_id': [],
-            'pool_id': [],
-            'peptide_id': [],
-            'peptide_sequence': [],
-            'plate_id': [],
-            'well_id': []
-        }
-        for pool_id,pool in self.pools.items():
-            coverage_id = pool.coverage_id
-            pool_id = pool.id
-            for peptide in pool.peptides:
-                data['coverage_id'].append(coverage_id)
-                data['pool_id'].append(pool_id)
-                data['peptide_id'].append(peptide.id)
-                data['peptide_sequence'].append(peptide.sequence)
-                if pool_id in self.plate_map.keys():
-                    data['plate_id'].append(self.plate_map[pool_id].plate_id)
-                    data['well_id'].append(self.plate_map[pool_id].well_id)
-                else:
-                    data['plate_id'].append('')
-                    data['well_id'].append('')
-        df = pd.DataFrame(data)
-        df.sort_values(by=['peptide_id'], inplace=True)
-        return df
+        def build() -> pd.DataFrame:
+            df = self.assignment_index.to_dataframe()
+            df.sort_values(by=['peptide_id'], inplace=True)
+            return df
+        # Callers may modify the returned DataFrame, so the cached one is copied
+        return self._get_cached(key='dataframe', build=build).copy()
 
     def to_golfy_design(self) -> Tuple[Design, Mapping[int,str]]:
         """
@@ -811,6 +876,7 @@ class BlockAssignment:
             block_assignment    :   BlockAssignment object.
         """
         block_assignment = BlockAssignment()
+        plate_map = {}
         for index, row in df_assignment.iterrows():
             coverage_id = int(row['coverage_id'])
             pool_id = int(row['pool_id'])
@@ -825,7 +891,8 @@ class BlockAssignment:
             if 'plate_id' in row and 'well_id' in row:
                 plate_id = row['plate_id']
                 well_id = row['well_id']
-                block_assignment.plate_map[pool_id] = PlateWell(plate_id=plate_id, well_id=well_id)
+                plate_map[pool_id] = PlateWell(plate_id=plate_id, well_id=well_id)
+        block_assignment.load_plate_map(plate_map=plate_map)
         return block_assignment
 
     @staticmethod
@@ -910,6 +977,7 @@ class BlockAssignment:
 
         # Step 2. Add peptides
         block_assignment = BlockAssignment()
+        plate_map = {}
         # coverage_ids:
         # {
         #     peptide_id_1: 1,
@@ -930,7 +998,8 @@ class BlockAssignment:
                 coverage_id=curr_coverage_id,
                 pool_id=curr_pool_id
             )
-            block_assignment.plate_map[curr_pool_id] = PlateWell(plate_id=curr_plate_id, well_id=curr_well_id)
+            plate_map[curr_pool_id] = PlateWell(plate_id=curr_plate_id, well_id=curr_well_id)
+        block_assignment.load_plate_map(plate_map=plate_map)
         return block_assignment
 
     @staticmethod
@@ -1018,6 +1087,213 @@ class BlockAssignment:
                     )
         return merged_block_assignment
 
+    @staticmethod
+    def index_block_pools(
+            block_assignments: List['BlockAssignment']
+    ) -> Tuple[int, List[List[Tuple[Pool, np.ndarray]]], List[np.ndarray], List[List[np.ndarray]]]:
+        """
+        Index the peptides and pools of a list of block assignments.
+
+        Parameters:
+            block_assignments   :   List of BlockAssignment objects.
+
+        Returns:
+            Tuple[int, List, List, List]:
+                - Number of peptides (across all block assignments).
+                - block_pools[b][i] = (i-th Pool of block b, its peptide indices).
+                - pool_ids[b][i] = pool ID of the i-th pool of block b.
+                - coverage_pools[b] = list of arrays of pool positions of block b
+                  (one per coverage with more than one pool).
+        """
+        peptide_idx = {}
+        for block_assignment in block_assignments:
+            for peptide_id in block_assignment.peptide_ids:
+                peptide_idx.setdefault(peptide_id, len(peptide_idx))
+        block_pools = []
+        pool_ids = []
+        coverage_pools = []
+        for block_assignment in block_assignments:
+            pools = [(pool, np.unique(np.array([peptide_idx[peptide.id] for peptide in pool.peptides], dtype=np.int64)))
+                     for pool in block_assignment.pools.values()]
+            coverages = defaultdict(list)
+            for i, (pool, _) in enumerate(pools):
+                coverages[pool.coverage_id].append(i)
+            block_pools.append(pools)
+            pool_ids.append(np.array([pool.id for pool, _ in pools], dtype=np.int64))
+            coverage_pools.append([np.array(v, dtype=np.int64) for v in coverages.values() if len(v) > 1])
+        return len(peptide_idx), block_pools, pool_ids, coverage_pools
+
+    @staticmethod
+    def relabel_block_pools(
+            block_pools: List[List[Tuple[Pool, np.ndarray]]],
+            pool_ids: List[np.ndarray]
+    ) -> List['BlockAssignment']:
+        """
+        Return block assignments whose pools are relabeled with new pool IDs.
+
+        Parameters:
+            block_pools         :   block_pools[b][i] = (i-th Pool of block b, its peptide indices).
+            pool_ids            :   pool_ids[b][i] = new pool ID of the i-th pool of block b.
+
+        Returns:
+            block_assignments   :   List of BlockAssignment objects.
+        """
+        block_assignments = []
+        for pools, pool_ids_ in zip(block_pools, pool_ids):
+            block_assignment = BlockAssignment()
+            for (pool, _), pool_id in zip(pools, pool_ids_.tolist()):
+                for peptide in pool.peptides:
+                    block_assignment.add_peptide(
+                        peptide_id=peptide.id,
+                        peptide_sequence=peptide.sequence,
+                        coverage_id=pool.coverage_id,
+                        pool_id=pool_id
+                    )
+            block_assignments.append(block_assignment)
+        return block_assignments
+
+    @staticmethod
+    def align_pool_ids(
+            block_assignments: List['BlockAssignment'],
+            max_passes: int = DEFAULT_GENERATE_CPSAT_SOLVER_ALIGNMENT_PASSES,
+            verbose: bool = True
+    ) -> List['BlockAssignment']:
+        """
+        Minimize violations (i.e. number of times peptide pairs are pooled together more than once) in a list of
+        block assignments by aligning pool IDs across blocks (pools with the same ID are merged).
+
+        The pools of one coverage of one block are relabeled optimally among their own pool IDs given a set of
+        other pools: the cost of giving pool i the ID of pool j is the number of peptide pairs (one peptide from
+        pool i, one from the other blocks' pools with that ID) that are already pooled together elsewhere, and
+        the relabeling is solved as a linear assignment problem. Each pass visits every coverage of every block
+        given all other pools, until there are no violations or no relabeling improves. Passes start both from
+        the given pool IDs and from placing coverages one at a time (given only the pools placed so far); the
+        result with fewer violations is kept, or the given pool IDs if neither improves on them.
+
+        Parameters:
+            block_assignments   :   List of BlockAssignment objects.
+            max_passes          :   Maximum number of passes per start (default: 10).
+            verbose             :   Verbose.
+
+        Returns:
+            block_assignments   :   List of BlockAssignment objects.
+        """
+        from scipy.optimize import linear_sum_assignment
+
+        # Step 1. Index peptides and the pools of each block
+        # Pools of all blocks are flattened into parts; part g holds the peptides
+        # part_peptides[part_indptr[g]:part_indptr[g + 1]] and is labeled with pool ID part_labels[g]
+        num_peptides, block_pools, pool_ids, coverage_pools = BlockAssignment.index_block_pools(
+            block_assignments=block_assignments
+        )
+        part_offsets = np.cumsum([0] + [len(pools) for pools in block_pools])
+        part_sizes = np.array([len(peptide_indices) for pools in block_pools for _, peptide_indices in pools], dtype=np.int64)
+        part_indptr = np.concatenate(([0], np.cumsum(part_sizes)))
+        part_peptides = np.concatenate([peptide_indices for pools in block_pools for _, peptide_indices in pools] +
+                                       [np.zeros(0, dtype=np.int64)])
+        part_labels = np.concatenate(pool_ids + [np.zeros(0, dtype=np.int64)])
+        label_ids = np.unique(part_labels)
+
+        part_coverages = np.array([pool.coverage_id for pools in block_pools for pool, _ in pools], dtype=np.int64)
+        part_blocks = np.repeat(np.arange(len(block_pools)), np.diff(part_offsets))
+
+        def get_incidence(labels: np.ndarray, part_mask: np.ndarray) -> csr_matrix:
+            # Binary peptide x pool ID incidence of the parts in part_mask
+            entry_mask = np.repeat(part_mask, part_sizes)
+            entry_columns = np.repeat(np.searchsorted(label_ids, labels), part_sizes)
+            incidence = csr_matrix(
+                (np.ones(int(entry_mask.sum()), dtype=np.int32), (part_peptides[entry_mask], entry_columns[entry_mask])),
+                shape=(num_peptides, len(label_ids))
+            )
+            incidence.data[:] = 1
+            return incidence
+
+        def count_violations(labels: np.ndarray) -> int:
+            incidence = get_incidence(labels=labels, part_mask=np.ones(len(labels), dtype=bool))
+            cooccurrence = triu(incidence @ incidence.T, k=1, format='csr')
+            return int(np.maximum(cooccurrence.data - 1, 0).sum())
+
+        def align_parts(labels: np.ndarray, parts: np.ndarray, part_mask: np.ndarray) -> bool:
+            # Optimally relabel the pools 'parts' (one coverage of one block) among their own pool IDs
+            # given the parts in part_mask; returns True if the relabeling strictly lowers the cost
+            rest = get_incidence(labels=labels, part_mask=part_mask)
+
+            # Peptides of the moving pools and the peptides they already share a pool with
+            moving_peptides = np.unique(np.concatenate([part_peptides[part_indptr[g]:part_indptr[g + 1]] for g in parts]))
+            shared = (rest[moving_peptides] @ rest.T).tocoo()
+            is_other = shared.col != moving_peptides[shared.row]
+            shared = csr_matrix(
+                (np.ones(int(is_other.sum()), dtype=np.int32), (shared.row[is_other], shared.col[is_other])),
+                shape=(len(moving_peptides), num_peptides)
+            )
+
+            # cost[i, j] = number of already pooled pairs created by giving pool i the ID of pool j
+            moving = csr_matrix(
+                (np.ones(int(part_sizes[parts].sum()), dtype=np.int32),
+                 np.searchsorted(moving_peptides, np.concatenate([part_peptides[part_indptr[g]:part_indptr[g + 1]] for g in parts])),
+                 np.concatenate(([0], np.cumsum(part_sizes[parts])))),
+                shape=(len(parts), len(moving_peptides))
+            )
+            targets = rest.T.tocsr()[np.searchsorted(label_ids, labels[parts])]
+            cost = (moving @ shared @ targets.T).toarray()
+            rows, cols = linear_sum_assignment(cost)
+            if cost[rows, cols].sum() < np.trace(cost):
+                labels[parts[rows]] = labels[parts][cols]
+                return True
+            return False
+
+        def align_coverages(labels: np.ndarray) -> int:
+            # Align the pools of one (block, coverage) at a time given all other pools
+            num_violations = count_violations(labels=labels)
+            for _ in range(0, max_passes):
+                if num_violations == 0:
+                    break
+                is_improved = False
+                for b in range(0, len(block_pools)):
+                    for positions in coverage_pools[b]:
+                        parts = part_offsets[b] + positions
+                        part_mask = np.ones(len(labels), dtype=bool)
+                        part_mask[parts] = False
+                        is_improved |= align_parts(labels=labels, parts=parts, part_mask=part_mask)
+                num_violations = count_violations(labels=labels)
+                if not is_improved:
+                    break
+            return num_violations
+
+        num_violations = count_violations(labels=part_labels)
+        if verbose:
+            logger.info('\tNumber of violations before aligning pool IDs: %i' % num_violations)
+        if num_violations > 0:
+            # Step 2. Align starting from the given pool IDs
+            aligned_part_labels = part_labels.copy()
+            aligned_num_violations = align_coverages(labels=aligned_part_labels)
+
+            # Step 3. Align starting from placing coverages one at a time, aligning each block's pools
+            # only to the pools placed so far (mirrored blocks are a local optimum of step 2)
+            placed_part_labels = part_labels.copy()
+            is_placed = np.zeros(len(part_labels), dtype=bool)
+            for coverage_id in np.unique(part_coverages).tolist():
+                for b in range(0, len(block_pools)):
+                    parts = np.flatnonzero((part_blocks == b) & (part_coverages == coverage_id))
+                    if len(parts) > 1 and is_placed.any():
+                        align_parts(labels=placed_part_labels, parts=parts, part_mask=is_placed)
+                    is_placed[parts] = True
+            placed_num_violations = align_coverages(labels=placed_part_labels)
+            if placed_num_violations < aligned_num_violations:
+                aligned_part_labels = placed_part_labels
+                aligned_num_violations = placed_num_violations
+            if aligned_num_violations < num_violations:
+                part_labels = aligned_part_labels
+                num_violations = aligned_num_violations
+        if verbose:
+            logger.info('\tNumber of violations after aligning pool IDs: %i' % num_violations)
+
+        # Step 4. Relabel pools with the aligned pool IDs
+        return BlockAssignment.relabel_block_pools(
+            block_pools=block_pools,
+            pool_ids=np.split(part_labels, part_offsets[1:-1])
+        )
+
     @staticmethod
     def minimize_violations(
             block_assignments: List['BlockAssignment'],
@@ -1028,24 +1304,89 @@ class BlockAssignment:
         Minimize violations (i.e. number of times peptide pairs are pooled together more than once) in a list of
         block assignments by shuffling pool IDs.
 
+        Each iteration proposes swapping the IDs of two pools of the same coverage in a random block and
+        keeps the swap unless it increases the number of violations. Pools with the same ID are merged across
+        blocks, so a swap only changes two merged pools; its violation delta is computed from those two pools
+        and a running count of the number of pools shared by each peptide pair.
+
         Parameters:
             block_assignments   :   List of BlockAssignment objects.
-            shuffle_iters       :   Number of iterations to shuffle pool IDs.
+            shuffle_iters       :   Number of pool ID swaps to propose.
+            verbose             :   Verbose.
 
         Returns:
             block_assignments   :   List of BlockAssignment objects.
         """
-        min_violations = BlockAssignment.merge(block_assignments=block_assignments).num_violations
-        curr_block_assignments = copy.deepcopy(block_assignments)
-        best_block_assignments = copy.deepcopy(block_assignments)
+        # Step 1. Index peptides and the pools of each block
+        num_peptides, block_pools, pool_ids, coverage_pools = BlockAssignment.index_block_pools(
+            block_assignments=block_assignments
+        )
+
+        # Step 2. Count the number of pools shared by each peptide pair in the merged assignment
+        # pool_parts[pool_id] = set of (block, pool position) merged into pool_id
+        pool_parts = defaultdict(set)
+        for b in range(0, len(block_pools)):
+            for i in range(0, len(block_pools[b])):
+                pool_parts[int(pool_ids[b][i])].add((b, i))
+
+        def get_pool_pair_keys(parts) -> np.ndarray:
+            peptide_indices = np.unique(np.concatenate([block_pools[b][i][1] for b, i in parts]))
+            rows, cols = np.triu_indices(len(peptide_indices), k=1)
+            return peptide_indices[rows] * num_peptides + peptide_indices[cols]
+
+        pair_keys, pair_counts = np.unique(
+            np.concatenate([get_pool_pair_keys(parts) for parts in pool_parts.values()] + [np.zeros(0, dtype=np.int64)]),
+            return_counts=True
+        )
+        pair_count_dict = dict(zip(pair_keys.tolist(), pair_counts.tolist()))
+        curr_num_violations = int(np.maximum(pair_counts - 1, 0).sum())
+        min_violations = curr_num_violations
+        best_pool_ids = [p.copy() for p in pool_ids]
+
+        # Step 3. Swap pool IDs
+        shuffle_blocks = [b for b in range(0, len(block_pools)) if len(coverage_pools[b]) > 0]
         for _ in range(0, shuffle_iters):
-            random_idx = random.choice(list(range(0, len(curr_block_assignments))))
-            curr_block_assignments[random_idx].shuffle_pool_ids()
-            curr_num_violations = BlockAssignment.merge(block_assignments=curr_block_assignments).num_violations
+            if len(shuffle_blocks) == 0 or curr_num_violations == 0:
+                break
+            b = random.choice(shuffle_blocks)
+            i, j = random.sample(random.choice(coverage_pools[b]).tolist(), k=2)
+            pool_id_i = int(pool_ids[b][i])
+            pool_id_j = int(pool_ids[b][j])
+
+            # Pair count changes of the two touched (merged) pools
+            new_parts_i = (pool_parts[pool_id_i] - {(b, i)}) | {(b, j)}
+            new_parts_j = (pool_parts[pool_id_j] - {(b, j)}) | {(b, i)}
+            old_keys = [get_pool_pair_keys(pool_parts[pool_id_i]), get_pool_pair_keys(pool_parts[pool_id_j])]
+            new_keys = [get_pool_pair_keys(new_parts_i), get_pool_pair_keys(new_parts_j)]
+            keys, inverse = np.unique(np.concatenate(old_keys + new_keys), return_inverse=True)
+            weights = np.ones(len(inverse), dtype=np.int64)
+            weights[:len(old_keys[0]) + len(old_keys[1])] = -1
+            deltas = np.bincount(inverse, weights=weights, minlength=len(keys)).astype(np.int64)
+            keys = keys[deltas != 0].tolist()
+            deltas = deltas[deltas != 0].tolist()
+            counts = [pair_count_dict.get(key, 0) for key in keys]
+            delta_violations = sum(max(count + delta - 1, 0) - max(count - 1, 0)
+                                   for count, delta in zip(counts, deltas))
+            if delta_violations > 0:
+                continue
+
+            # Apply the swap
+            pool_ids[b][i] = pool_id_j
+            pool_ids[b][j] = pool_id_i
+            pool_parts[pool_id_i] = new_parts_i
+            pool_parts[pool_id_j] = new_parts_j
+            for key, count, delta in zip(keys, counts, deltas):
+                if count + delta == 0:
+                    del pair_count_dict[key]
+                else:
+                    pair_count_dict[key] = count + delta
+            curr_num_violations += delta_violations
             if curr_num_violations < min_violations:
                 if verbose:
                     logger.info('\tFound a better assignment; current number of violations: %i, new number of violations: %i' %
                                 (min_violations, curr_num_violations))
-                best_block_assignments = copy.deepcopy(curr_block_assignments)
+                best_pool_ids = [p.copy() for p in pool_ids]
                 min_violations = curr_num_violations
-        return best_block_assignments
+
+        # Step 4. Relabel pools with the best pool IDs
+        return BlockAssignment.relabel_block_pools(block_pools=block_pools, pool_ids=best_pool_ids)
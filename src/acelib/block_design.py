@@ -20,12 +20,13 @@ import math
 import pandas as pd
 from dataclasses import dataclass, field
 from itertools import combinations
-from ortools.sat.python import cp_model
+from scipy.sparse import csr_matrix
 from typing import Dict, List, Tuple
 from .block_assignment import BlockAssignment
 from .constants import GolfyStrategy, SequenceSimilarityFunction
 from .logger import get_logger
 from .peptide import Peptide
+from .similarity_graph import peptide_pairs_to_csr_matrix
 
 
 logger = get_logger(__name__)
@@ -109,6 +110,14 @@ class BlockDesign:
             data['peptide_sequence'].append(peptide.sequence)
         return pd.DataFrame(data)
 
+    @property
+    def preferred_peptide_pairs_matrix(self) -> csr_matrix:
+        """
+        Preferred peptide pairs as a sparse similarity graph: entry (i, j), i < j,
+        is the score of the pair (peptide_ids[i], peptide_ids[j]).
+        """
+        return peptide_pairs_to_csr_matrix(peptide_pairs=self.preferred_peptide_pairs, peptide_ids=self.peptide_ids)
+
     @property
     def preferred_peptide_pairs_dataframe(self) -> pd.DataFrame:
         data = {
@@ -167,6 +176,8 @@ class BlockDesign:
         Returns:
             block_assignment    :   BlockAssignment object.
         """
+        from ortools.sat.python import cp_model
+
         # Step 1. Calculate the number of pools per coverage
         num_pools_per_coverage = int(self.num_total_peptides / self.num_peptides_per_pool)
         pool_ids = list(range(0, num_pools_per_coverage))
@@ -24,12 +24,8 @@ from random import choices
 import pandas as pd
 import os
 import random
-import torch
 from importlib import resources
 from pathlib import Path
-from ortools.sat.python import cp_model
-from transformers import BertModel, BertTokenizer
-from transformers import AutoTokenizer, AutoModelForMaskedLM
 from ..block_assignment import BlockAssignment
 from ..block_design import BlockDesign
 from ..constants import *
@@ -37,7 +33,6 @@ from ..defaults import *
 from ..logger import get_logger
 from ..main import run_ace_sat_solver, run_ace_golfy, run_ace_generate
 from ..utilities import *
-from ..sequence_features import AceNeuralEngine
 
 
 logger = get_logger(__name__)
@@ -150,6 +145,122 @@ def add_ace_generate_arg_parser(sub_parsers):
         help="Sequence similarity threshold (default: %f). "
              "A higher threshold leads to more stringent peptide pairing." % DEFAULT_GENERATE_SEQUENCE_SIMILARITY_THRESHOLD
     )
+    parser_optional.add_argument(
+        "--embedding-cache-dir",
+        dest="embedding_cache_dir",
+        type=str,
+        default=None,
+        required=False,
+        help="Directory of a persistent sequence embedding cache. If supplied, "
+             "embeddings of previously seen peptide sequences are reused instead of "
+             "being recomputed (default: no caching)."
+    )
+    parser_optional.add_argument(
+        "--embedding-batch-size",
+        dest="embedding_batch_size",
+        type=int,
+        default=None,
+        required=False,
+        help="Number of peptides per embedding batch. If set, peptides are grouped by sequence "
+             "length so that batches require no padding, and token-level embeddings are "
+             "zero-padded (default: all peptides in one padded batch)."
+    )
+    parser_optional.add_argument(
+        "--embedding-representation",
+        dest="embedding_representation",
+        type=str,
+        default=DEFAULT_EMBEDDING_REPRESENTATION,
+        choices=['last_hidden_state', 'cls_embedding', 'mean_pooling', 'max_pooling', 'mean_max_pooling',
+                 'concatenate_pooling', 'concatenate_mean_pooling'],
+        required=False,
+        help="Sequence embedding representation. Pooled representations are reduced per batch "
+             "into one compact vector per peptide (default: %s)." % DEFAULT_EMBEDDING_REPRESENTATION
+    )
+    parser_optional.add_argument(
+        "--embedding-dtype",
+        dest="embedding_dtype",
+        type=str,
+        default=DEFAULT_EMBEDDING_DTYPE,
+        choices=['float32', 'float16'],
+        required=False,
+        help="Data type of stored sequence embeddings (default: %s)." % DEFAULT_EMBEDDING_DTYPE
+    )
+    parser_optional.add_argument(
+        "--embedding-precision",
+        dest="embedding_precision",
+        type=str,
+        default=DEFAULT_MODEL_PRECISION,
+        choices=[str(p) for p in ModelPrecision],
+        required=False,
+        help="Precision of the sequence embedding model. Allowed values: %s (default: %s). "
+             "'bf16' runs under bfloat16 autocast and 'int8' quantizes the linear layers (CPU only)." %
+             (', '.join([str(p) for p in ModelPrecision]), DEFAULT_MODEL_PRECISION)
+    )
+    parser_optional.add_argument(
+        "--embedding-num-threads",
+        dest="embedding_num_threads",
+        type=int,
+        default=None,
+        required=False,
+        help="Number of intra-op threads used to compute sequence embeddings (default: torch default)."
+    )
+    parser_optional.add_argument(
+        "--embedding-num-processes",
+        dest="embedding_num_processes",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of worker processes used to compute sequence embeddings. Each worker loads "
+             "the model once and embeds a shard of the peptides (default: 1)."
+    )
+    parser_optional.add_argument(
+        "--similarity-search-mode",
+        dest="similarity_search_mode",
+        type=str,
+        default=DEFAULT_SIMILARITY_SEARCH_MODE,
+        choices=['matrix', 'index', 'pairwise'],
+        required=False,
+        help="Similar peptide search. 'matrix': tiled all-pairs similarity matrix, "
+             "'index': radius queries against a BallTree (faster for large peptide libraries), "
+             "'pairwise': one pair at a time (default: %s)." % DEFAULT_SIMILARITY_SEARCH_MODE
+    )
+    parser_optional.add_argument(
+        "--similarity-search-exact",
+        dest="similarity_search_exact",
+        type=eval,
+        default=True,
+        choices=[True, False],
+        required=False,
+        help="If False, the 'index' similarity search runs on a random projection of the "
+             "embeddings. Faster, but some similar peptide pairs may be missed (default: True)."
+    )
+    parser_optional.add_argument(
+        "--levenshtein-num-processes",
+        dest="levenshtein_num_processes",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of processes used to compute Levenshtein distances "
+             "(applies when '--sequence-similarity-function levenshtein'; default: 1)."
+    )
+    parser_optional.add_argument(
+        "--physicochemical-encoding",
+        dest="physicochemical_encoding",
+        type=str,
+        default=DEFAULT_PHYSICOCHEMICAL_ENCODING,
+        choices=['positional', 'composition'],
+        required=False,
+        help="Amino acid property profile of each peptide "
+             "(applies when '--sequence-similarity-function physicochemical'; default: %s)." % DEFAULT_PHYSICOCHEMICAL_ENCODING
+    )
+    parser_optional.add_argument(
+        "--kmer-size",
+        dest="kmer_size",
+        type=int,
+        default=DEFAULT_KMER_SIZE,
+        required=False,
+        help="k-mer size (applies when '--sequence-similarity-function kmer_jaccard'; default: %i)." % DEFAULT_KMER_SIZE
+    )
     # Golfy optional parameters
     parser_optional_golfy = parser.add_argument_group("optional arguments (applies when '--mode golfy')")
     parser_optional_golfy.add_argument(
@@ -265,6 +376,18 @@ def run_ace_generate_from_parsed_args(args):
                 plate_size
                 sequence_similarity_function
                 sequence_similarity_threshold
+                embedding_cache_dir
+                embedding_batch_size
+                embedding_representation
+                embedding_dtype
+                embedding_precision
+                embedding_num_threads
+                embedding_num_processes
+                similarity_search_mode
+                similarity_search_exact
+                levenshtein_num_processes
+                physicochemical_encoding
+                kmer_size
                 golfy_random_seed
                 golfy_max_iters
                 golfy_strategy
@@ -316,6 +439,18 @@ def run_ace_generate_from_parsed_args(args):
         cpsat_solver_max_peptides_per_block=args.cpsat_solver_max_peptides_per_block,
         cpsat_solver_max_peptides_per_pool=args.cpsat_solver_max_peptides_per_pool,
         num_plate_wells=NumPlateWells(args.num_plate_wells),
+        embedding_cache_dir=args.embedding_cache_dir,
+        embedding_batch_size=args.embedding_batch_size,
+        embedding_representation=args.embedding_representation,
+        embedding_dtype=args.embedding_dtype,
+        embedding_precision=ModelPrecision(args.embedding_precision),
+        embedding_num_threads=args.embedding_num_threads,
+        embedding_num_processes=args.embedding_num_processes,
+        similarity_search_mode=args.similarity_search_mode,
+        similarity_search_exact=args.similarity_search_exact,
+        levenshtein_num_processes=args.levenshtein_num_processes,
+        physicochemical_encoding=args.physicochemical_encoding,
+        kmer_size=args.kmer_size,
         verbose=args.verbose
     )
 
@@ -86,6 +86,15 @@ class GolfyStrategy(Enum):
         return self.value
 
 
+class ModelPrecision(Enum):
+    FP32 = 'fp32'
+    BF16 = 'bf16'
+    INT8 = 'int8'
+
+    def __str__(self) -> str:
+        return self.value
+
+
 class NumPlateWells(IntEnum):
     WELLS_24 = 24
     WELLS_48 = 48
@@ -105,6 +114,9 @@ class SequenceSimilarityFunction(Enum):
     EUCLIDEAN = 'euclidean'
     COSINE = 'cosine'
     LEVENSHTEIN = 'levenshtein'
+    HAMMING = 'hamming'
+    PHYSICOCHEMICAL = 'physicochemical'
+    KMER_JACCARD = 'kmer_jaccard'
 
     def __str__(self) -> str:
         return self.value
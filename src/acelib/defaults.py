@@ -22,15 +22,35 @@ DEFAULT_GENERATE_NUM_PLATE_WELLS = 96
 DEFAULT_GENERATE_CLUSTER_PEPTIDES = True
 DEFAULT_GENERATE_SEQUENCE_SIMILARITY_FUNCTION = 'euclidean'
 DEFAULT_GENERATE_SEQUENCE_SIMILARITY_THRESHOLD = 0.7
+DEFAULT_GENERATE_SEQUENCE_SIMILARITY_TOP_K = 1
 DEFAULT_GENERATE_GOLFY_RANDOM_SEED = 42
 DEFAULT_GENERATE_GOLFY_MAX_ITERS = 2000
 DEFAULT_GENERATE_GOLFY_STRATEGY = 'greedy'
 DEFAULT_GENERATE_GOLFY_ALLOW_EXTRA_POOLS = False
 DEFAULT_GENERATE_CPSAT_SOLVER_NUM_PROCESSES = 2
 DEFAULT_GENERATE_CPSAT_SOLVER_SHUFFLE_ITERS = 1000
+DEFAULT_GENERATE_CPSAT_SOLVER_ALIGNMENT_PASSES = 10
 DEFAULT_GENERATE_CPSAT_SOLVER_MAX_PEPTIDES_PER_BLOCK = 100
 DEFAULT_GENERATE_CPSAT_SOLVER_MAX_PEPTIDES_PER_POOL = 10
 
 
+"""sequence similarity"""
+DEFAULT_ESM2_MODEL_NAME = 'facebook/esm2_t6_8M_UR50D'
+DEFAULT_MODEL_PRECISION = 'fp32'
+DEFAULT_SIMILARITY_SEARCH_MODE = 'matrix'
+DEFAULT_SIMILARITY_SEARCH_MEMORY_BUDGET = 256 * 1024 * 1024  # bytes per similarity tile
+DEFAULT_SIMILARITY_SEARCH_NUM_PROJECTIONS = 64              # random projection dimensions of the approximate index
+DEFAULT_LEVENSHTEIN_SEARCH_QGRAM_SIZE = 2
+DEFAULT_LEVENSHTEIN_SEARCH_BLOCK_SIZE = 1024
+DEFAULT_PHYSICOCHEMICAL_ENCODING = 'positional'
+DEFAULT_KMER_SIZE = 3
+DEFAULT_KMER_MINHASH_NUM_PERMUTATIONS = 128
+DEFAULT_KMER_JACCARD_BLOCK_SIZE = 100000
+DEFAULT_EMBEDDING_CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024     # bytes
+DEFAULT_EMBEDDING_BATCH_SIZE = 256
+DEFAULT_EMBEDDING_REPRESENTATION = 'last_hidden_state'
+DEFAULT_EMBEDDING_DTYPE = 'float32'
+
+
 """deconvolve"""
 DEFAULT_DECONVOLVE_METHOD = 'cem'
@@ -0,0 +1,319 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+The purpose of this python3 script is to implement the EmbeddingCache class,
+a persistent content-addressed store of peptide sequence embeddings.
+"""
+
+
+import hashlib
+import numpy as np
+import os
+import sqlite3
+from typing import Dict, Sequence, Tuple
+from .defaults import DEFAULT_EMBEDDING_CACHE_MAX_SIZE
+from .logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+def compute_file_hash(file_path: str) -> str:
+    """
+    Compute the SHA-256 hash of a file.
+
+    Parameters:
+        file_path   :   File path.
+
+    Returns:
+        file_hash   :   Hexadecimal SHA-256 digest.
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    On-disk embedding store keyed by (sequence, model weights hash, representation).
+
+    Embeddings with the same shape and data type share one memory-mapped array
+    file ('<dtype>_<shape>.dat') in the cache directory. An SQLite index maps
+    each key to a row (slot) of one of these arrays and records when the entry
+    was last used (as a logical clock), so that the least recently used entries can be evicted once
+    the total size of the stored embeddings exceeds 'max_size' bytes. Array files of which
+    more than half of the slots are free after an eviction are compacted, so that the cache
+    uses at most about twice 'max_size' bytes on disk.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int = DEFAULT_EMBEDDING_CACHE_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._connection = sqlite3.connect(os.path.join(self.cache_dir, 'index.sqlite'))
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'key TEXT PRIMARY KEY, namespace TEXT NOT NULL, slot INTEGER NOT NULL, '
+                'nbytes INTEGER NOT NULL, last_used INTEGER NOT NULL)'
+            )
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS namespaces ('
+                'namespace TEXT PRIMARY KEY, dtype TEXT NOT NULL, shape TEXT NOT NULL, num_slots INTEGER NOT NULL)'
+            )
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS free_slots ('
+                'namespace TEXT NOT NULL, slot INTEGER NOT NULL, PRIMARY KEY (namespace, slot))'
+            )
+            self._connection.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+        self._arrays = {} # key = namespace, value = np.memmap
+
+    @property
+    def size(self) -> int:
+        """
+        Return the total size (bytes) of the stored embeddings.
+
+        Returns:
+            size    :   Total size in bytes.
+        """
+        return int(self._connection.execute('SELECT COALESCE(SUM(nbytes), 0) FROM entries').fetchone()[0])
+
+    @property
+    def num_entries(self) -> int:
+        """
+        Return the number of stored embeddings.
+
+        Returns:
+            num_entries     :   Number of stored embeddings.
+        """
+        return int(self._connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0])
+
+    @staticmethod
+    def compute_key(sequence: str, model_hash: str, representation: str) -> str:
+        """
+        Compute the content address of an embedding.
+
+        Parameters:
+            sequence        :   Peptide sequence.
+            model_hash      :   Hash of the model weights.
+            representation  :   Representation (e.g. 'last_hidden_state').
+
+        Returns:
+            key             :   Hexadecimal SHA-256 digest.
+        """
+        return hashlib.sha256(('%s\0%s\0%s' % (model_hash, representation, sequence)).encode('utf-8')).hexdigest()
+
+    def get(
+            self,
+            sequences: Sequence[str],
+            model_hash: str,
+            representation: str
+    ) -> Dict[int, np.ndarray]:
+        """
+        Look up embeddings.
+
+        Parameters:
+            sequences       :   Peptide sequences.
+            model_hash      :   Hash of the model weights.
+            representation  :   Representation (e.g. 'last_hidden_state').
+
+        Returns:
+            embeddings      :   Mapping from the index of a sequence in 'sequences'
+                                to its embedding (cache misses are absent).
+        """
+        embeddings = {}
+        used_keys = []
+        tick = self._get_last_tick()
+        for idx, sequence in enumerate(sequences):
+            key = self.compute_key(sequence=sequence, model_hash=model_hash, representation=representation)
+            row = self._connection.execute('SELECT namespace, slot FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                continue
+            namespace, slot = row
+            embeddings[idx] = np.array(self._get_array(namespace=namespace)[slot])
+            tick += 1
+            used_keys.append((tick, key))
+        if len(used_keys) > 0:
+            with self._connection:
+                self._connection.executemany('UPDATE entries SET last_used = ? WHERE key = ?', used_keys)
+        return embeddings
+
+    def put(
+            self,
+            sequences: Sequence[str],
+            embeddings: Sequence[np.ndarray],
+            model_hash: str,
+            representation: str
+    ):
+        """
+        Store embeddings and evict the least recently used entries if the cache is over capacity.
+
+        Parameters:
+            sequences       :   Peptide sequences.
+            embeddings      :   Embeddings (one per sequence).
+            model_hash      :   Hash of the model weights.
+            representation  :   Representation (e.g. 'last_hidden_state').
+        """
+        assert len(sequences) == len(embeddings)
+        tick = self._get_last_tick()
+        with self._connection:
+            for sequence, embedding in zip(sequences, embeddings):
+                embedding = np.asarray(embedding)
+                key = self.compute_key(sequence=sequence, model_hash=model_hash, representation=representation)
+                row = self._connection.execute('SELECT namespace, slot FROM entries WHERE key = ?', (key,)).fetchone()
+                tick += 1
+                if row is not None:
+                    namespace, slot = row
+                    self._connection.execute('UPDATE entries SET last_used = ? WHERE key = ?', (tick, key))
+                else:
+                    namespace = self._get_namespace(dtype=embedding.dtype, shape=embedding.shape)
+                    slot = self._allocate_slot(namespace=namespace)
+                    self._connection.execute(
+                        'INSERT INTO entries (key, namespace, slot, nbytes, last_used) VALUES (?, ?, ?, ?, ?)',
+                        (key, namespace, slot, int(embedding.nbytes), tick)
+                    )
+                self._get_array(namespace=namespace)[slot] = embedding
+        for array in self._arrays.values():
+            array.flush()
+        self.evict()
+
+    def evict(self):
+        """
+        Evict the least recently used entries until the cache is within 'max_size' bytes.
+        """
+        size = self.size
+        if size <= self.max_size:
+            return
+        evicted = []
+        for key, namespace, slot, nbytes in self._connection.execute(
+                'SELECT key, namespace, slot, nbytes FROM entries ORDER BY last_used ASC'):
+            if size <= self.max_size:
+                break
+            evicted.append((key, namespace, slot))
+            size -= nbytes
+        with self._connection:
+            self._connection.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key, _, _ in evicted])
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO free_slots (namespace, slot) VALUES (?, ?)',
+                [(namespace, slot) for _, namespace, slot in evicted]
+            )
+            for namespace in sorted(set(namespace for _, namespace, _ in evicted)):
+                self._compact(namespace=namespace)
+
+    def clear(self):
+        """
+        Remove all stored embeddings.
+        """
+        self._arrays = {}
+        for (namespace,) in self._connection.execute('SELECT namespace FROM namespaces').fetchall():
+            array_file = self._get_array_file(namespace=namespace)
+            if os.path.exists(array_file):
+                os.remove(array_file)
+        with self._connection:
+            self._connection.execute('DELETE FROM entries')
+            self._connection.execute('DELETE FROM namespaces')
+            self._connection.execute('DELETE FROM free_slots')
+
+    def close(self):
+        """
+        Close the cache index.
+        """
+        self._arrays = {}
+        self._connection.close()
+
+    def _get_last_tick(self) -> int:
+        # 'last_used' is a logical clock so that the LRU order does not depend on the timer resolution
+        return int(self._connection.execute('SELECT COALESCE(MAX(last_used), 0) FROM entries').fetchone()[0])
+
+    def _get_array_file(self, namespace: str) -> str:
+        return os.path.join(self.cache_dir, '%s.dat' % namespace)
+
+    def _get_namespace(self, dtype: np.dtype, shape: Tuple[int, ...]) -> str:
+        shape_str = 'x'.join([str(i) for i in shape]) if len(shape) > 0 else 'scalar'
+        namespace = '%s_%s' % (np.dtype(dtype).name, shape_str)
+        self._connection.execute(
+            'INSERT OR IGNORE INTO namespaces (namespace, dtype, shape, num_slots) VALUES (?, ?, ?, 0)',
+            (namespace, np.dtype(dtype).name, shape_str)
+        )
+        return namespace
+
+    def _get_array(self, namespace: str) -> np.memmap:
+        dtype, shape_str, num_slots = self._connection.execute(
+            'SELECT dtype, shape, num_slots FROM namespaces WHERE namespace = ?', (namespace,)
+        ).fetchone()
+        array = self._arrays.get(namespace, None)
+        if array is None or len(array) != num_slots:
+            shape = tuple(int(i) for i in shape_str.split('x')) if shape_str != 'scalar' else ()
+            array = np.memmap(self._get_array_file(namespace=namespace), dtype=dtype, mode='r+', shape=(num_slots,) + shape)
+            self._arrays[namespace] = array
+        return array
+
+    def _allocate_slot(self, namespace: str) -> int:
+        row = self._connection.execute(
+            'SELECT slot FROM free_slots WHERE namespace = ? ORDER BY slot LIMIT 1', (namespace,)
+        ).fetchone()
+        if row is not None:
+            self._connection.execute('DELETE FROM free_slots WHERE namespace = ? AND slot = ?', (namespace, row[0]))
+            return int(row[0])
+
+        # Grow the array file (doubling its capacity) and hand out the next slot
+        dtype, shape_str, num_slots = self._connection.execute(
+            'SELECT dtype, shape, num_slots FROM namespaces WHERE namespace = ?', (namespace,)
+        ).fetchone()
+        shape = tuple(int(i) for i in shape_str.split('x')) if shape_str != 'scalar' else ()
+        row_nbytes = int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+        new_num_slots = max(16, num_slots * 2)
+        self._arrays.pop(namespace, None)
+        with open(self._get_array_file(namespace=namespace), 'ab') as f:
+            f.truncate(new_num_slots * row_nbytes)
+        self._connection.execute('UPDATE namespaces SET num_slots = ? WHERE namespace = ?', (new_num_slots, namespace))
+        self._connection.executemany(
+            'INSERT INTO free_slots (namespace, slot) VALUES (?, ?)',
+            [(namespace, slot) for slot in range(num_slots + 1, new_num_slots)]
+        )
+        return num_slots
+
+    def _compact(self, namespace: str):
+        # Move the stored embeddings to the front of the array file and truncate the free tail
+        num_slots = self._connection.execute(
+            'SELECT num_slots FROM namespaces WHERE namespace = ?', (namespace,)
+        ).fetchone()[0]
+        rows = self._connection.execute(
+            'SELECT key, slot FROM entries WHERE namespace = ? ORDER BY slot', (namespace,)
+        ).fetchall()
+        if len(rows) * 2 >= num_slots:
+            return
+        self._connection.execute('DELETE FROM free_slots WHERE namespace = ?', (namespace,))
+        if len(rows) == 0:
+            self._arrays.pop(namespace, None)
+            self._connection.execute('DELETE FROM namespaces WHERE namespace = ?', (namespace,))
+            os.remove(self._get_array_file(namespace=namespace))
+            return
+        array = self._get_array(namespace=namespace)
+        for new_slot, (_, slot) in enumerate(rows):
+            if slot != new_slot:
+                array[new_slot] = array[slot] # slots are in ascending order, so 'slot' is not yet overwritten
+        array.flush()
+        row_nbytes = array[0].nbytes
+        del array
+        self._arrays.pop(namespace, None)
+        with open(self._get_array_file(namespace=namespace), 'r+b') as f:
+            f.truncate(len(rows) * row_nbytes)
+        self._connection.execute('UPDATE namespaces SET num_slots = ? WHERE namespace = ?', (len(rows), namespace))
+        self._connection.executemany(
+            'UPDATE entries SET slot = ? WHERE key = ?',
+            [(new_slot, key) for new_slot, (key, _) in enumerate(rows)]
+        )
@@ -0,0 +1,261 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+The purpose of this python3 script is to implement peptide sequence
+similarity based on shared k-mers (Jaccard similarity of k-mer sets),
+with candidate pairs generated by MinHash locality-sensitive hashing.
+"""
+
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from typing import Dict, List, Sequence, Tuple
+from .defaults import DEFAULT_KMER_SIZE, DEFAULT_KMER_MINHASH_NUM_PERMUTATIONS, DEFAULT_KMER_JACCARD_BLOCK_SIZE
+from .logger import get_logger
+from .similarity_search import select_top_k_pairs
+
+
+logger = get_logger(__name__)
+
+
+_MERSENNE_PRIME = (1 << 31) - 1
+
+
+def compute_kmer_sets(
+        sequences: Sequence[str],
+        k: int = DEFAULT_KMER_SIZE
+) -> List[np.ndarray]:
+    """
+    Compute the set of k-mers of each sequence.
+
+    Parameters:
+        sequences   :   Sequences.
+        k           :   k-mer size.
+
+    Returns:
+        kmer_sets   :   List of sorted arrays of k-mer IDs (one array per sequence).
+    """
+    vocabulary: Dict[str, int] = {}
+    kmer_sets = []
+    for sequence in sequences:
+        kmer_ids = {vocabulary.setdefault(sequence[i:i + k], len(vocabulary)) for i in range(len(sequence) - k + 1)}
+        kmer_sets.append(np.array(sorted(kmer_ids), dtype=np.int64))
+    return kmer_sets
+
+
+def compute_minhash_signatures(
+        kmer_sets: List[np.ndarray],
+        num_permutations: int = DEFAULT_KMER_MINHASH_NUM_PERMUTATIONS,
+        random_seed: int = 1
+) -> np.ndarray:
+    """
+    Compute MinHash signatures of k-mer sets.
+
+    Parameters:
+        kmer_sets           :   List of arrays of k-mer IDs.
+        num_permutations    :   Number of hash functions.
+        random_seed         :   Random seed of the hash functions.
+
+    Returns:
+        signatures          :   Array of shape (number of sets, num_permutations).
+                                Rows of empty sets are filled with the hash modulus.
+    """
+    rng = np.random.default_rng(random_seed)
+    a = rng.integers(1, _MERSENNE_PRIME, size=num_permutations, dtype=np.int64)
+    b = rng.integers(0, _MERSENNE_PRIME, size=num_permutations, dtype=np.int64)
+    signatures = np.full((len(kmer_sets), num_permutations), _MERSENNE_PRIME, dtype=np.int64)
+    sizes = np.array([len(s) for s in kmer_sets], dtype=np.int64)
+    nonempty = np.flatnonzero(sizes > 0)
+    if len(nonempty) == 0:
+        return signatures
+    kmer_ids = np.concatenate([kmer_sets[i] for i in nonempty])
+    offsets = np.concatenate([[0], np.cumsum(sizes[nonempty])[:-1]])
+    for idx in range(num_permutations):
+        # (a * x + b) mod p with x, a, b < 2^31 does not overflow int64
+        hashes = (a[idx] * kmer_ids + b[idx]) % _MERSENNE_PRIME
+        signatures[nonempty, idx] = np.minimum.reduceat(hashes, offsets)
+    return signatures
+
+
+def choose_lsh_bands(
+        threshold: float,
+        num_permutations: int = DEFAULT_KMER_MINHASH_NUM_PERMUTATIONS,
+        min_candidate_probability: float = 0.99
+) -> Tuple[int, int]:
+    """
+    Choose the number of LSH bands and rows per band.
+
+    A pair with Jaccard similarity s becomes a candidate with probability 1 - (1 - s^r)^b.
+    The number of rows r is the largest divisor of num_permutations for which a pair
+    at the threshold becomes a candidate with at least min_candidate_probability.
+    If no divisor reaches min_candidate_probability, a warning is logged and one row
+    per band (the highest candidate probability) is used.
+
+    Parameters:
+        threshold                   :   Jaccard similarity threshold.
+        num_permutations            :   Number of hash functions.
+        min_candidate_probability   :   Minimum probability that a pair at the threshold is a candidate.
+
+    Returns:
+        num_bands                   :   Number of bands (b).
+        num_rows                    :   Number of rows per band (r).
+    """
+    best = None
+    for num_rows in range(1, num_permutations + 1):
+        if num_permutations % num_rows != 0:
+            continue
+        num_bands = num_permutations // num_rows
+        if 1.0 - (1.0 - threshold ** num_rows) ** num_bands >= min_candidate_probability:
+            best = (num_bands, num_rows)
+    if best is None:
+        best = (num_permutations, 1)
+        logger.warning('With %i MinHash permutations, a pair at the Jaccard similarity threshold %.3f becomes a candidate '
+                       'with a probability of %.3f only (target: %.3f); increase the number of permutations.'
+                       % (num_permutations, threshold, 1.0 - (1.0 - max(threshold, 0.0)) ** num_permutations,
+                          min_candidate_probability))
+    return best
+
+
+def find_minhash_candidate_pairs(
+        signatures: np.ndarray,
+        num_bands: int,
+        num_rows: int
+) -> np.ndarray:
+    """
+    Find candidate pairs that share at least one LSH band.
+
+    Parameters:
+        signatures  :   MinHash signatures of shape (number of sets, num_bands * num_rows).
+        num_bands   :   Number of bands.
+        num_rows    :   Number of rows per band.
+
+    Returns:
+        candidates  :   Array of shape (number of candidates, 2) of unique index pairs (i < j).
+    """
+    valid = np.flatnonzero(signatures[:, 0] != _MERSENNE_PRIME)
+    candidates = []
+    for band in range(num_bands):
+        band_signatures = signatures[valid, band * num_rows:(band + 1) * num_rows]
+        _, bucket_ids = np.unique(band_signatures, axis=0, return_inverse=True)
+        bucket_ids = bucket_ids.reshape(-1)
+        order = np.argsort(bucket_ids, kind='stable')
+        sorted_bucket_ids = bucket_ids[order]
+        # Pair every member of a bucket with the members 'offset' positions after it
+        offset = 1
+        while offset < len(order):
+            same_bucket = sorted_bucket_ids[offset:] == sorted_bucket_ids[:-offset]
+            if not same_bucket.any():
+                break
+            candidates.append(np.stack([valid[order[:-offset][same_bucket]], valid[order[offset:][same_bucket]]], axis=1))
+            offset += 1
+    if len(candidates) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    candidates = np.sort(np.concatenate(candidates), axis=1)
+    return np.unique(candidates, axis=0)
+
+
+def compute_jaccard_similarity(
+        kmer_set_1: np.ndarray,
+        kmer_set_2: np.ndarray
+) -> float:
+    """
+    Compute the Jaccard similarity of two sorted arrays of k-mer IDs.
+
+    Parameters:
+        kmer_set_1  :   Sorted array of k-mer IDs.
+        kmer_set_2  :   Sorted array of k-mer IDs.
+
+    Returns:
+        similarity  :   |intersection| / |union| (0 if both sets are empty).
+    """
+    num_shared = len(np.intersect1d(kmer_set_1, kmer_set_2, assume_unique=True))
+    num_union = len(kmer_set_1) + len(kmer_set_2) - num_shared
+    return num_shared / num_union if num_union > 0 else 0.0
+
+
+def compute_jaccard_similarities(
+        kmer_sets: List[np.ndarray],
+        pairs: np.ndarray,
+        block_size: int = DEFAULT_KMER_JACCARD_BLOCK_SIZE
+) -> np.ndarray:
+    """
+    Compute the Jaccard similarities of pairs of k-mer sets.
+
+    The k-mer sets are rows of a binary sparse matrix, so the intersection sizes of
+    'block_size' pairs at a time are the row sums of an element-wise sparse product.
+
+    Parameters:
+        kmer_sets   :   List of sorted arrays of k-mer IDs.
+        pairs       :   Array of shape (number of pairs, 2) of set indices.
+        block_size  :   Number of pairs compared at a time.
+
+    Returns:
+        similarities    :   Array of Jaccard similarities (0 if both sets are empty).
+    """
+    sizes = np.array([len(kmer_set) for kmer_set in kmer_sets], dtype=np.int64)
+    indptr = np.zeros(len(kmer_sets) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=indptr[1:])
+    indices = np.concatenate(kmer_sets) if len(kmer_sets) > 0 else np.zeros(0, dtype=np.int64)
+    num_kmers = int(indices.max()) + 1 if len(indices) > 0 else 0
+    incidence = csr_matrix((np.ones(len(indices), dtype=np.int32), indices, indptr), shape=(len(kmer_sets), num_kmers))
+    num_shared = np.zeros(len(pairs), dtype=np.int64)
+    for start in range(0, len(pairs), block_size):
+        block = pairs[start:start + block_size]
+        num_shared[start:start + len(block)] = np.asarray(
+            incidence[block[:, 0]].multiply(incidence[block[:, 1]]).sum(axis=1)
+        ).reshape(-1)
+    num_union = sizes[pairs[:, 0]] + sizes[pairs[:, 1]] - num_shared
+    return np.divide(num_shared, num_union, out=np.zeros(len(pairs), dtype=np.float64), where=num_union > 0)
+
+
+def find_kmer_paired_peptides(
+        peptide_ids: List[str],
+        peptide_sequences: List[str],
+        threshold: float = 0.5,
+        k: int = DEFAULT_KMER_SIZE,
+        top_k: int = 1,
+        num_permutations: int = DEFAULT_KMER_MINHASH_NUM_PERMUTATIONS,
+        random_seed: int = 1
+) -> List[Tuple[str, str, float]]:
+    """
+    Find pairs of peptides whose k-mer sets have a Jaccard similarity greater than
+    or equal to the threshold. Candidate pairs come from MinHash LSH banding and are
+    verified with the exact Jaccard similarity, so every returned pair is a true pair.
+    The LSH bands are chosen so that a true pair is missed with a probability of at most 1%
+    (at the threshold, less above it); if the number of permutations is too small to reach
+    this for the threshold, a warning is logged (see choose_lsh_bands).
+
+    Parameters:
+        peptide_ids         :   Peptide IDs.
+        peptide_sequences   :   Peptide sequences.
+        threshold           :   Jaccard similarity threshold.
+        k                   :   k-mer size.
+        top_k               :   Maximum number of pairs to keep per peptide.
+        num_permutations    :   Number of MinHash hash functions.
+        random_seed         :   Random seed of the hash functions.
+
+    Returns:
+        paired_peptide_triples  :   List of (peptide ID, peptide ID, Jaccard similarity).
+    """
+    kmer_sets = compute_kmer_sets(sequences=peptide_sequences, k=k)
+    signatures = compute_minhash_signatures(kmer_sets=kmer_sets, num_permutations=num_permutations, random_seed=random_seed)
+    num_bands, num_rows = choose_lsh_bands(threshold=threshold, num_permutations=num_permutations)
+    candidates = find_minhash_candidate_pairs(signatures=signatures, num_bands=num_bands, num_rows=num_rows)
+    similarities = compute_jaccard_similarities(kmer_sets=kmer_sets, pairs=candidates)
+    keep = similarities >= threshold
+    pairs = list(zip(candidates[keep, 0].tolist(), candidates[keep, 1].tolist(), similarities[keep].tolist()))
+    paired_peptide_ids = []
+    for i, j, similarity in select_top_k_pairs(pairs, top_k=top_k):
+        paired_peptide_ids.append((peptide_ids[i], peptide_ids[j], similarity))
+    return paired_peptide_ids
@@ -0,0 +1,276 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+The purpose of this python3 script is to implement all-pairs Levenshtein
+(edit) and Hamming distance search over peptide sequences.
+"""
+
+
+import multiprocessing as mp
+import numpy as np
+from typing import Dict, List, Sequence, Tuple
+from .defaults import DEFAULT_LEVENSHTEIN_SEARCH_QGRAM_SIZE, DEFAULT_LEVENSHTEIN_SEARCH_BLOCK_SIZE
+from .logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+_SEQUENCES: Sequence[str] = []
+
+
+def compute_qgram_profiles(
+        sequences: Sequence[str],
+        q: int = DEFAULT_LEVENSHTEIN_SEARCH_QGRAM_SIZE
+) -> np.ndarray:
+    """
+    Compute q-gram count profiles.
+
+    Parameters:
+        sequences   :   Sequences.
+        q           :   q-gram size.
+
+    Returns:
+        profiles    :   Array of shape (number of sequences, number of distinct q-grams)
+                        with the number of occurrences of each q-gram in each sequence.
+    """
+    vocabulary: Dict[str, int] = {}
+    rows, cols = [], []
+    for idx, sequence in enumerate(sequences):
+        for start in range(len(sequence) - q + 1):
+            col = vocabulary.setdefault(sequence[start:start + q], len(vocabulary))
+            rows.append(idx)
+            cols.append(col)
+    profiles = np.zeros((len(sequences), max(len(vocabulary), 1)), dtype=np.int32)
+    np.add.at(profiles, (np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)), 1)
+    return profiles
+
+
+def find_levenshtein_candidate_pairs(
+        sequences: Sequence[str],
+        threshold: int,
+        q: int = DEFAULT_LEVENSHTEIN_SEARCH_QGRAM_SIZE,
+        block_size: int = DEFAULT_LEVENSHTEIN_SEARCH_BLOCK_SIZE
+) -> np.ndarray:
+    """
+    Find candidate pairs of sequences whose Levenshtein distance may be less than
+    or equal to the threshold. Two filters that never discard a true pair are applied:
+        1. Length filter: the lengths differ by at most the threshold.
+        2. q-gram count filter: one edit changes at most q q-grams of each sequence,
+           so the L1 distance between q-gram profiles is at most 2 * q * threshold.
+
+    Parameters:
+        sequences   :   Sequences.
+        threshold   :   Maximum Levenshtein distance.
+        q           :   q-gram size.
+        block_size  :   Number of sequences compared at a time.
+
+    Returns:
+        candidates  :   Array of shape (number of candidates, 2) of index pairs (i < j).
+    """
+    from scipy.spatial.distance import cdist
+    lengths = np.array([len(s) for s in sequences], dtype=np.int64)
+    profiles = compute_qgram_profiles(sequences=sequences, q=q)
+    max_profile_distance = 2 * q * threshold
+    indices_by_length = {int(length): np.flatnonzero(lengths == length) for length in np.unique(lengths)}
+    candidates = []
+    for length_1, indices_1 in indices_by_length.items():
+        for length_2 in range(length_1, length_1 + threshold + 1):
+            indices_2 = indices_by_length.get(length_2, None)
+            if indices_2 is None:
+                continue
+            for start_1 in range(0, len(indices_1), block_size):
+                block_1 = indices_1[start_1:start_1 + block_size]
+                # Blocks below the diagonal hold no new pairs of equal-length sequences
+                first_start_2 = start_1 if length_1 == length_2 else 0
+                for start_2 in range(first_start_2, len(indices_2), block_size):
+                    block_2 = indices_2[start_2:start_2 + block_size]
+                    distances = cdist(profiles[block_1], profiles[block_2], metric='cityblock')
+                    hits = distances <= max_profile_distance
+                    rows, cols = np.nonzero(hits)
+                    pairs = np.stack([block_1[rows], block_2[cols]], axis=1)
+                    if length_1 == length_2:
+                        pairs = pairs[pairs[:, 0] < pairs[:, 1]]
+                    else:
+                        pairs = np.sort(pairs, axis=1)
+                    candidates.append(pairs)
+    if len(candidates) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    return np.concatenate(candidates)
+
+
+def encode_sequences(sequences: Sequence[str]) -> np.ndarray:
+    """
+    Encode equal-length sequences as an array of character codes.
+
+    Parameters:
+        sequences   :   Sequences (all of the same length).
+
+    Returns:
+        codes       :   uint8 array of shape (number of sequences, sequence length).
+    """
+    lengths = set(len(s) for s in sequences)
+    if len(lengths) > 1:
+        raise ValueError("All sequences must have the same length.")
+    length = lengths.pop() if len(lengths) > 0 else 0
+    codes = np.frombuffer(''.join(sequences).encode('ascii', errors='replace'), dtype=np.uint8)
+    return codes.reshape(len(sequences), length)
+
+
+def find_hamming_pairs(
+        sequences: Sequence[str],
+        threshold: int,
+        block_size: int = DEFAULT_LEVENSHTEIN_SEARCH_BLOCK_SIZE
+) -> List[Tuple[int, int, int]]:
+    """
+    Find all pairs of equal-length sequences whose Hamming distance is less than or equal to the threshold.
+    Distances are computed in (block_size x block_size) tiles of broadcast character comparisons.
+
+    Parameters:
+        sequences   :   Sequences (all of the same length).
+        threshold   :   Maximum Hamming distance.
+        block_size  :   Number of sequences compared at a time.
+
+    Returns:
+        pairs       :   List of (index 1, index 2, distance) where index 1 < index 2,
+                        ordered by index 1 and then by index 2.
+    """
+    codes = encode_sequences(sequences=sequences)
+    all_rows, all_cols, all_distances = [], [], []
+    for row_start in range(0, len(codes), block_size):
+        row_codes = codes[row_start:row_start + block_size]
+        for col_start in range(row_start, len(codes), block_size):
+            col_codes = codes[col_start:col_start + block_size]
+            distances = (row_codes[:, None, :] != col_codes[None, :, :]).sum(axis=2, dtype=np.int32)
+            hits = distances <= threshold
+            if row_start == col_start:
+                hits = np.triu(hits, k=1)
+            rows, cols = np.nonzero(hits)
+            all_rows.append(rows + row_start)
+            all_cols.append(cols + col_start)
+            all_distances.append(distances[rows, cols])
+    if len(all_rows) == 0:
+        return []
+    rows = np.concatenate(all_rows)
+    cols = np.concatenate(all_cols)
+    distances = np.concatenate(all_distances)
+    order = np.lexsort((cols, rows))
+    return list(zip(rows[order].tolist(), cols[order].tolist(), distances[order].tolist()))
+
+
+def _init_worker(sequences: Sequence[str]):
+    global _SEQUENCES
+    _SEQUENCES = sequences
+
+
+def _compute_distances(args: Tuple[np.ndarray, int]) -> np.ndarray:
+    import Levenshtein as levenshtein
+    candidates, threshold = args
+    return np.array(
+        [levenshtein.distance(_SEQUENCES[i], _SEQUENCES[j], score_cutoff=threshold) for i, j in candidates.tolist()],
+        dtype=np.int64
+    )
+
+
+def find_levenshtein_pairs(
+        sequences: Sequence[str],
+        threshold: int,
+        q: int = DEFAULT_LEVENSHTEIN_SEARCH_QGRAM_SIZE,
+        num_processes: int = 1,
+        block_size: int = DEFAULT_LEVENSHTEIN_SEARCH_BLOCK_SIZE
+) -> List[Tuple[int, int, int]]:
+    """
+    Find all pairs of sequences whose Levenshtein distance is less than or equal to the threshold.
+
+    If all sequences have the same length and the threshold is at most 1, the vectorized
+    Hamming distance search is used instead: two equal-length sequences are within one edit
+    exactly when they differ in at most one position (an insertion plus a deletion costs 2).
+
+    Parameters:
+        sequences       :   Sequences.
+        threshold       :   Maximum Levenshtein distance.
+        q               :   q-gram size of the candidate filter.
+        num_processes   :   Number of processes used to compute the distances of candidate pairs.
+        block_size      :   Number of sequences compared at a time by the candidate filter.
+
+    Returns:
+        pairs           :   List of (index 1, index 2, distance) where index 1 < index 2,
+                            ordered by index 1 and then by index 2.
+    """
+    threshold = int(threshold)
+    sequences = list(sequences)
+    if threshold <= 1 and len(set(len(s) for s in sequences)) == 1:
+        return find_hamming_pairs(sequences=sequences, threshold=threshold, block_size=block_size)
+    candidates = find_levenshtein_candidate_pairs(sequences=sequences, threshold=threshold, q=q, block_size=block_size)
+    if len(candidates) == 0:
+        return []
+    if num_processes > 1:
+        chunks = np.array_split(candidates, num_processes * 4)
+        # Spawned workers do not inherit the parent's threads (e.g. torch or OpenMP pools), which can deadlock after fork
+        with mp.get_context('spawn').Pool(processes=num_processes, initializer=_init_worker, initargs=(sequences,)) as pool:
+            distances = np.concatenate(pool.map(_compute_distances, [(chunk, threshold) for chunk in chunks]))
+    else:
+        _init_worker(sequences)
+        distances = _compute_distances((candidates, threshold))
+    keep = distances <= threshold
+    candidates = candidates[keep]
+    distances = distances[keep]
+    order = np.lexsort((candidates[:, 1], candidates[:, 0]))
+    return list(zip(candidates[order, 0].tolist(), candidates[order, 1].tolist(), distances[order].tolist()))
+
+
+def find_levenshtein_paired_peptides(
+        peptide_ids: List[str],
+        peptide_sequences: List[str],
+        threshold: int = 1,
+        num_processes: int = 1
+) -> List[Tuple[str, str, int]]:
+    """
+    Find pairs of peptides whose sequences are within a Levenshtein (edit) distance of the threshold.
+
+    Parameters:
+        peptide_ids         :   Peptide IDs.
+        peptide_sequences   :   Peptide sequences.
+        threshold           :   Maximum edit distance of paired peptides (integer).
+        num_processes       :   Number of processes used to compute edit distances.
+
+    Returns:
+        paired_peptide_triples  :   List of (peptide ID, peptide ID, distance).
+    """
+    if not float(threshold).is_integer():
+        raise ValueError("Threshold must be an integer value greater than or equal to 1.")
+    pairs = find_levenshtein_pairs(sequences=peptide_sequences, threshold=int(threshold), num_processes=num_processes)
+    return [(peptide_ids[i], peptide_ids[j], distance) for i, j, distance in pairs]
+
+
+def find_hamming_paired_peptides(
+        peptide_ids: List[str],
+        peptide_sequences: List[str],
+        threshold: int = 1
+) -> List[Tuple[str, str, int]]:
+    """
+    Find pairs of equal-length peptides whose sequences are within a Hamming distance of the threshold.
+
+    Parameters:
+        peptide_ids         :   Peptide IDs.
+        peptide_sequences   :   Peptide sequences (all of the same length).
+        threshold           :   Maximum number of mismatched positions of paired peptides (integer).
+
+    Returns:
+        paired_peptide_triples  :   List of (peptide ID, peptide ID, distance).
+    """
+    if not float(threshold).is_integer():
+        raise ValueError("Threshold must be an integer value greater than or equal to 1.")
+    pairs = find_hamming_pairs(sequences=peptide_sequences, threshold=int(threshold))
+    return [(peptide_ids[i], peptide_ids[j], distance) for i, j, distance in pairs]
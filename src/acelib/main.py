@@ -17,10 +17,8 @@ The purpose of this python3 script is to implement the main API functions of ACE
 
 
 import numpy as np
-import torch
 from golfy import init, optimize
-from transformers import AutoTokenizer, AutoModelForMaskedLM
-from typing import List, Literal, Tuple, Union
+from typing import List, Literal, Optional, Tuple, Union
 from .block_assignment import BlockAssignment
 from .block_design import BlockDesign
 from .constants import *
@@ -28,9 +26,13 @@ from .defaults import *
 from .deconvolution import perform_empirical_deconvolution, perform_statistical_deconvolution, compute_background_spot_count
 from .deconvolved_peptide import DeconvolvedPeptide
 from .deconvolved_peptide_set import DeconvolvedPeptideSet
+from .embedding_cache import EmbeddingCache
+from .kmer_similarity import find_kmer_paired_peptides
+from .levenshtein_search import find_hamming_paired_peptides, find_levenshtein_paired_peptides
 from .logger import get_logger
 from .peptide import Peptide
-from .sequence_features import AceNeuralEngine
+from .physicochemical_features import find_physicochemical_paired_peptides
+from .similarity_graph import csr_matrix_to_pairs
 from .utilities import *
 
 
@@ -68,11 +70,10 @@ def run_ace_golfy(
     # Step 2. Create a DataFrame of peptide IDs and index IDs
     df_peptides = block_design.peptides_dataframe
     df_peptides['peptide_index'] = list(range(0, len(df_peptides)))
-    preferred_neighbors: List[Tuple[int, int]] = []
-    for peptide_id_1, peptide_id_2, score in block_design.preferred_peptide_pairs:
-        peptide_index_1 = df_peptides.loc[df_peptides['peptide_id'] == peptide_id_1,'peptide_index'].values[0]
-        peptide_index_2 = df_peptides.loc[df_peptides['peptide_id'] == peptide_id_2,'peptide_index'].values[0]
-        preferred_neighbors.append((peptide_index_1, peptide_index_2))
+    preferred_neighbors: List[Tuple[int, int]] = [
+        (peptide_index_1, peptide_index_2)
+        for peptide_index_1, peptide_index_2, score in csr_matrix_to_pairs(matrix=block_design.preferred_peptide_pairs_matrix)
+    ]
 
     # Step 3. Run golfy
     golfy_solution = init(
@@ -196,6 +197,10 @@ def run_ace_sat_solver(
     # Step 4. Merge assignments
     if verbose:
         logger.info('Started minimizing violations.')
+    block_assignments = BlockAssignment.align_pool_ids(
+        block_assignments=block_assignments,
+        verbose=verbose
+    )
     block_assignments = BlockAssignment.minimize_violations(
         block_assignments=block_assignments,
         shuffle_iters=shuffle_iters,
@@ -231,6 +236,18 @@ def run_ace_generate(
         cpsat_solver_max_peptides_per_block: int = DEFAULT_GENERATE_CPSAT_SOLVER_MAX_PEPTIDES_PER_BLOCK,
         cpsat_solver_max_peptides_per_pool: int = DEFAULT_GENERATE_CPSAT_SOLVER_MAX_PEPTIDES_PER_POOL,
         num_plate_wells: NumPlateWells = NumPlateWells.WELLS_96,
+        embedding_cache_dir: Optional[str] = None,
+        embedding_batch_size: Optional[int] = None,
+        embedding_precision: ModelPrecision = DEFAULT_MODEL_PRECISION,
+        embedding_num_threads: Optional[int] = None,
+        embedding_num_processes: int = 1,
+        similarity_search_mode: str = DEFAULT_SIMILARITY_SEARCH_MODE,
+        similarity_search_exact: bool = True,
+        levenshtein_num_processes: int = 1,
+        embedding_representation: str = DEFAULT_EMBEDDING_REPRESENTATION,
+        embedding_dtype: str = DEFAULT_EMBEDDING_DTYPE,
+        physicochemical_encoding: str = DEFAULT_PHYSICOCHEMICAL_ENCODING,
+        kmer_size: int = DEFAULT_KMER_SIZE,
         verbose: bool = True
 ) -> Tuple[BlockAssignment, BlockDesign]:
     """
@@ -243,11 +260,15 @@ def run_ace_generate(
         trained_model_file                  :   Trained model file.
         cluster_peptides                    :   Cluster peptides.
         mode                                :   'golfy' or 'cpsat_solver' (default: 'golfy').
-        sequence_similarity_function        :   'euclidean', 'cosine' or 'levenshtein' (default: 'euclidean').
+        sequence_similarity_function        :   'euclidean', 'cosine', 'levenshtein', 'hamming',
+                                                'physicochemical' or 'kmer_jaccard' (default: 'euclidean').
         sequence_similarity_threshold       :   Sequence similarity threshold. Recommended values:
                                                 0.8 for 'euclidean'
                                                 0.9 for 'cosine'
                                                 3 for 'levenshtein'
+                                                2 for 'hamming' (peptides of equal length only)
+                                                0.8 for 'physicochemical'
+                                                0.5 for 'kmer_jaccard'
         golfy_random_seed                   :   Random seed for golfy (default: randomly generated).
         golfy_strategy                      :   'greedy', 'random', 'valid', 'singleton' or 'repeat' (default: 'greedy').
         golfy_max_iters                     :   Maximum number of iterations for golfy (default: 2000).
@@ -257,6 +278,20 @@ def run_ace_generate(
         cpsat_solver_max_peptides_per_block :   Maximum number of peptides per block for CP-SAT solver (default: 10).
         cpsat_solver_max_peptides_per_pool  :   Maximum number of peptides per pool for CP-SAT solver (default: 100).
         num_plate_wells                     :   Number of wells on the plate (default: 96).
+        embedding_cache_dir                 :   Directory of a persistent embedding cache (default: None, no caching).
+        embedding_batch_size                :   Number of peptides per length-bucketed embedding batch (default: None, one padded batch).
+        embedding_precision                 :   'fp32', 'bf16' or 'int8' (default: 'fp32').
+        embedding_num_threads               :   Number of intra-op threads for embedding (default: None, torch default).
+        embedding_num_processes             :   Number of worker processes for embedding (default: 1).
+        similarity_search_mode              :   'matrix', 'index' or 'pairwise' (default: 'matrix').
+        similarity_search_exact             :   If False, the 'index' search runs on a random projection
+                                                of the embeddings, which is faster but may miss pairs (default: True).
+        levenshtein_num_processes           :   Number of processes to compute Levenshtein distances (default: 1).
+        embedding_representation            :   Sequence representation (e.g. 'last_hidden_state', 'mean_pooling',
+                                                'concatenate_mean_pooling'; default: 'last_hidden_state').
+        embedding_dtype                     :   'float32' or 'float16' (default: 'float32').
+        physicochemical_encoding            :   'positional' or 'composition' (default: 'positional').
+        kmer_size                           :   k-mer size for 'kmer_jaccard' (default: 3).
         verbose                             :   Print logs (default: True).
 
     Returns:
@@ -265,27 +300,83 @@ def run_ace_generate(
     """
     # Step 1. Identify pairs of similar peptides
     if cluster_peptides:
+        # Identical sequences are embedded and paired once, under the ID of their first peptide
+        unique_peptide_ids, unique_peptide_sequences, duplicate_peptide_ids = deduplicate_peptide_sequences(peptides=peptides)
+        if len(duplicate_peptide_ids) > 0 and verbose:
+            logger.info('%i peptide(s) share their sequence with another peptide.' %
+                        (len(peptides) - len(unique_peptide_ids)))
         if sequence_similarity_function == SequenceSimilarityFunction.LEVENSHTEIN:
-            preferred_peptide_pairs = AceNeuralEngine.find_levenshtein_paired_peptides(
-                peptide_ids=[p.id for p in peptides],
-                peptide_sequences=[p.sequence for p in peptides],
+            preferred_peptide_pairs = find_levenshtein_paired_peptides(
+                peptide_ids=unique_peptide_ids,
+                peptide_sequences=unique_peptide_sequences,
+                threshold=sequence_similarity_threshold,
+                num_processes=levenshtein_num_processes
+            )
+        elif sequence_similarity_function == SequenceSimilarityFunction.HAMMING:
+            preferred_peptide_pairs = find_hamming_paired_peptides(
+                peptide_ids=unique_peptide_ids,
+                peptide_sequences=unique_peptide_sequences,
                 threshold=sequence_similarity_threshold
             )
+        elif sequence_similarity_function == SequenceSimilarityFunction.PHYSICOCHEMICAL:
+            preferred_peptide_pairs = find_physicochemical_paired_peptides(
+                peptide_ids=unique_peptide_ids,
+                peptide_sequences=unique_peptide_sequences,
+                threshold=sequence_similarity_threshold,
+                top_k=DEFAULT_GENERATE_SEQUENCE_SIMILARITY_TOP_K,
+                encoding=physicochemical_encoding
+            )
+        elif sequence_similarity_function == SequenceSimilarityFunction.KMER_JACCARD:
+            preferred_peptide_pairs = find_kmer_paired_peptides(
+                peptide_ids=unique_peptide_ids,
+                peptide_sequences=unique_peptide_sequences,
+                threshold=sequence_similarity_threshold,
+                k=kmer_size,
+                top_k=DEFAULT_GENERATE_SEQUENCE_SIMILARITY_TOP_K
+            )
         else:
-            ESM2_TOKENIZER = AutoTokenizer.from_pretrained("facebook/esm2_t6_8M_UR50D")
-            ESM2_MODEL = AutoModelForMaskedLM.from_pretrained("facebook/esm2_t6_8M_UR50D", return_dict=True, output_hidden_states=True)
-            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-            ace_eng = AceNeuralEngine(ESM2_MODEL, ESM2_TOKENIZER, device)
-            ace_eng.load_weights(trained_model_file)
+            # torch and transformers are only imported by the neural engine (euclidean and cosine similarity)
+            from .model_registry import get_ace_engine
+            from .sequence_features import AceNeuralEngine
+            if embedding_num_threads is not None:
+                AceNeuralEngine.set_num_threads(embedding_num_threads)
+            ace_eng = get_ace_engine(
+                trained_model_file=trained_model_file,
+                precision=str(embedding_precision),
+                representation=embedding_representation
+            )
+            if embedding_cache_dir is not None:
+                embedding_cache = EmbeddingCache(cache_dir=embedding_cache_dir)
+            else:
+                embedding_cache = None
             preferred_peptide_pairs = ace_eng.find_paired_peptides(
-                peptide_ids=[p.id for p in peptides],
-                peptide_sequences=[p.sequence for p in peptides],
+                peptide_ids=unique_peptide_ids,
+                peptide_sequences=unique_peptide_sequences,
                 sim_fxn=str(sequence_similarity_function),
-                threshold=sequence_similarity_threshold
+                threshold=sequence_similarity_threshold,
+                top_k=DEFAULT_GENERATE_SEQUENCE_SIMILARITY_TOP_K,
+                cache=embedding_cache,
+                batch_size=embedding_batch_size,
+                representation=embedding_representation,
+                dtype=np.dtype(embedding_dtype),
+                search_mode=similarity_search_mode,
+                exact=similarity_search_exact,
+                num_processes=embedding_num_processes
             )
+        if sequence_similarity_function in (SequenceSimilarityFunction.LEVENSHTEIN, SequenceSimilarityFunction.HAMMING):
+            identical_score = 0     # distance
+        else:
+            identical_score = 1.0   # similarity
+        preferred_peptide_pairs = expand_duplicate_peptide_pairs(
+            peptide_pairs=preferred_peptide_pairs,
+            duplicate_peptide_ids=duplicate_peptide_ids,
+            identical_score=identical_score,
+            top_k=DEFAULT_GENERATE_SEQUENCE_SIMILARITY_TOP_K
+        )
         if verbose:
-            logger.info('%i peptide cluster(s) identified by the ACE sequence similarity neural engine:' % len(preferred_peptide_pairs))
-            logger.info('peptide ID, peptide ID: similarity score')
+            logger.info('%i peptide cluster(s) identified by the %s sequence similarity function:' %
+                        (len(preferred_peptide_pairs), str(sequence_similarity_function)))
+            logger.info('peptide ID, peptide ID: %s' % ('distance' if identical_score == 0 else 'similarity score'))
             for peptide_id_1, peptide_id_2, score in preferred_peptide_pairs:
                 logger.info('%s, %s: %f' % (peptide_id_1, peptide_id_2, score))
     else:
@@ -0,0 +1,453 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+The purpose of this python3 script is to implement a process-wide registry
+of loaded ACE sequence similarity neural engines.
+"""
+
+
+import os
+import threading
+import torch
+from importlib import resources
+from safetensors import safe_open
+from safetensors.torch import save_file as save_safetensors_file
+from transformers import AutoConfig, AutoTokenizer, AutoModelForMaskedLM
+from typing import Dict, List, Optional, Tuple
+from .defaults import DEFAULT_EMBEDDING_REPRESENTATION, DEFAULT_ESM2_MODEL_NAME, DEFAULT_MODEL_PRECISION
+from .embedding_cache import compute_file_hash
+from .logger import get_logger
+from .sequence_features import AceNeuralEngine
+
+
+logger = get_logger(__name__)
+
+
+_ENGINES: Dict[Tuple[str, str, str, str, str], AceNeuralEngine] = {}
+_ENGINES_LOCK = threading.Lock()
+_FILE_HASHES: Dict[Tuple[str, int, int], str] = {}
+
+
+def get_default_device() -> torch.device:
+    """
+    Return the default device for the neural engine.
+
+    Returns:
+        device  :   'cuda' if available, otherwise 'cpu'.
+    """
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def get_bundled_model_dir(model_name: str) -> Optional[str]:
+    """
+    Return the directory of the tokenizer and model configuration files
+    shipped with ACE for a base model.
+
+    Parameters:
+        model_name  :   Hugging Face name of the base model (e.g. 'facebook/esm2_t6_8M_UR50D').
+
+    Returns:
+        model_dir   :   Directory in acelib/resources/models, or None if the model is not bundled.
+    """
+    model_dir = str(resources.files('acelib.resources.models').joinpath(model_name.split('/')[-1]))
+    if os.path.exists(os.path.join(model_dir, 'config.json')):
+        return model_dir
+    return None
+
+
+def resolve_trained_model_file(trained_model_file: str) -> str:
+    """
+    Return the .safetensors version of a trained model file if it exists next to it
+    and was converted from the same weights.
+
+    A .safetensors file written by convert_trained_model_file records the hash of the
+    file it was converted from and is used only if that hash matches the trained model
+    file. Other .safetensors files are used only if they are newer than the trained model file.
+
+    Parameters:
+        trained_model_file  :   Trained model file (.pt or .safetensors).
+
+    Returns:
+        trained_model_file  :   Trained model file to load.
+    """
+    safetensors_file = os.path.splitext(trained_model_file)[0] + '.safetensors'
+    if safetensors_file == trained_model_file or not os.path.exists(safetensors_file):
+        return trained_model_file
+    if not os.path.exists(trained_model_file):
+        return safetensors_file
+    with safe_open(safetensors_file, framework='pt') as f:
+        metadata = f.metadata() or {}
+    if 'source_hash' in metadata:
+        if metadata['source_hash'] == _get_file_hash(file_path=trained_model_file):
+            return safetensors_file
+        logger.info('%s was converted from different weights than %s; loading %s instead.'
+                    % (safetensors_file, trained_model_file, trained_model_file))
+        return trained_model_file
+    if os.path.getmtime(safetensors_file) >= os.path.getmtime(trained_model_file):
+        return safetensors_file
+    logger.info('%s is older than %s; loading %s instead.' % (safetensors_file, trained_model_file, trained_model_file))
+    return trained_model_file
+
+
+def convert_trained_model_file(
+        trained_model_file: str,
+        safetensors_file: Optional[str] = None
+) -> str:
+    """
+    Convert a trained model file (torch .pt state dict) to a memory-mappable .safetensors file.
+
+    Parameters:
+        trained_model_file  :   Trained model file (.pt).
+        safetensors_file    :   Output file (default: trained model file with a .safetensors extension).
+
+    Returns:
+        safetensors_file    :   Output file.
+    """
+    if safetensors_file is None:
+        safetensors_file = os.path.splitext(trained_model_file)[0] + '.safetensors'
+    state_dict = torch.load(trained_model_file, map_location='cpu')
+    # safetensors does not store tensors that share memory (e.g. tied embeddings) so every tensor is copied
+    save_safetensors_file({key: value.contiguous().clone() for key, value in state_dict.items()}, safetensors_file,
+                          metadata={'source_hash': _get_file_hash(file_path=trained_model_file)})
+    return safetensors_file
+
+
+def get_torchscript_file(trained_model_file: str, representation: str) -> str:
+    """
+    Return the TorchScript file of a trained model file and a representation.
+
+    Parameters:
+        trained_model_file  :   Trained model file (.pt or .safetensors).
+        representation      :   Representation (e.g. 'last_hidden_state').
+
+    Returns:
+        torchscript_file    :   '<trained model file without extension>.<representation>.torchscript'.
+    """
+    return '%s.%s.torchscript' % (os.path.splitext(trained_model_file)[0], representation)
+
+
+def export_ace_engine(
+        trained_model_file: str,
+        representation: str = DEFAULT_EMBEDDING_REPRESENTATION,
+        model_name: str = DEFAULT_ESM2_MODEL_NAME,
+        precision: str = DEFAULT_MODEL_PRECISION,
+        torchscript_file: Optional[str] = None
+) -> str:
+    """
+    Trace the fine-tuned encoder and the pooling of one representation into a TorchScript file.
+
+    get_ace_engine loads the file (instead of building the Hugging Face model and loading
+    the trained model file) when it is asked for this representation and precision.
+
+    Parameters:
+        trained_model_file  :   Trained model file.
+        representation      :   Representation (default: 'last_hidden_state').
+        model_name          :   Hugging Face name (or directory) of the base model (default: 'facebook/esm2_t6_8M_UR50D').
+        precision           :   'fp32' or 'int8' (default: 'fp32').
+        torchscript_file    :   Output file (default: get_torchscript_file(trained_model_file, representation)).
+
+    Returns:
+        torchscript_file    :   Output file.
+    """
+    if torchscript_file is None:
+        torchscript_file = get_torchscript_file(trained_model_file=trained_model_file, representation=representation)
+    ace_eng = _load_engine(
+        trained_model_file=trained_model_file,
+        model_name=model_name,
+        device=torch.device('cpu'),
+        precision=str(precision)
+    )
+    ace_eng.export_torchscript(torchscript_file, representation=representation)
+    return torchscript_file
+
+
+def _get_engine_key(
+        trained_model_file: str,
+        model_name: str,
+        device: Optional[torch.device],
+        precision: str,
+        representation: Optional[str]
+) -> Tuple[str, str, str, str, str]:
+    if device is None:
+        device = get_default_device()
+    # Engines loaded from a TorchScript file compute one representation only
+    if representation is None or not _is_torchscript_file_usable(trained_model_file=trained_model_file, precision=precision,
+                                                                 representation=representation):
+        representation = ''
+    return model_name, os.path.abspath(trained_model_file), str(torch.device(device)), precision, representation
+
+
+def _is_torchscript_file_usable(
+        trained_model_file: str,
+        precision: str,
+        representation: str
+) -> bool:
+    torchscript_file = get_torchscript_file(trained_model_file=trained_model_file, representation=representation)
+    if not os.path.exists(torchscript_file):
+        return False
+    metadata = AceNeuralEngine.read_torchscript_metadata(torchscript_file)
+    if metadata['precision'] != precision:
+        logger.info('%s was exported at %s precision; building the model instead.' % (torchscript_file, metadata['precision']))
+        return False
+    # The exported weights hash is that of the loaded weights file (the trained model file or its .safetensors version)
+    weights_files = {trained_model_file, resolve_trained_model_file(trained_model_file=trained_model_file)}
+    weights_hashes = [_get_file_hash(file_path=f) for f in weights_files if os.path.exists(f)]
+    if metadata['weights_hash'] not in weights_hashes:
+        logger.info('%s was exported from different weights than %s; building the model instead.' % (torchscript_file, trained_model_file))
+        return False
+    return True
+
+
+def _get_file_hash(file_path: str) -> str:
+    # Trained model files are hashed once per (path, modification time, size)
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+    if key not in _FILE_HASHES:
+        _FILE_HASHES[key] = compute_file_hash(file_path=file_path)
+    return _FILE_HASHES[key]
+
+
+def _get_tokenizer(model_name: str):
+    model_dir = get_bundled_model_dir(model_name=model_name)
+    return AutoTokenizer.from_pretrained(model_dir if model_dir is not None else model_name)
+
+
+def _load_engine(
+        trained_model_file: str,
+        model_name: str,
+        device: torch.device,
+        precision: str,
+        representation: str = ''
+) -> AceNeuralEngine:
+    if representation != '':
+        torchscript_file = get_torchscript_file(trained_model_file=trained_model_file, representation=representation)
+        logger.info('Loading the TorchScript encoder from %s.' % torchscript_file)
+        return AceNeuralEngine.load_torchscript(torchscript_file, tokenizer=_get_tokenizer(model_name=model_name), device=device)
+    model_dir = get_bundled_model_dir(model_name=model_name)
+    if model_dir is not None:
+        # The bundled tokenizer and configuration are used as is and the model
+        # parameters come from the trained model file, so nothing is downloaded
+        tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        config = AutoConfig.from_pretrained(model_dir, return_dict=True, output_hidden_states=True)
+        model = AutoModelForMaskedLM.from_config(config)
+        model.name_or_path = model_name
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModelForMaskedLM.from_pretrained(model_name, return_dict=True, output_hidden_states=True)
+    ace_eng = AceNeuralEngine(model, tokenizer, device)
+    weights_file = resolve_trained_model_file(trained_model_file=trained_model_file)
+    logger.info('Loading trained model weights from %s.' % weights_file)
+    ace_eng.load_weights(weights_file)
+    ace_eng.eval()
+    ace_eng.set_precision(precision)
+    return ace_eng
+
+
+def get_ace_engine(
+        trained_model_file: str,
+        model_name: str = DEFAULT_ESM2_MODEL_NAME,
+        device: Optional[torch.device] = None,
+        precision: str = DEFAULT_MODEL_PRECISION,
+        representation: Optional[str] = None
+) -> AceNeuralEngine:
+    """
+    Return a loaded AceNeuralEngine, loading it on first use.
+
+    Engines are cached for the lifetime of the process keyed by
+    (model name, trained model file, device, precision). Base models bundled
+    in acelib/resources/models are built from the bundled tokenizer and
+    configuration files without accessing the Hugging Face hub. If an up-to-date
+    .safetensors version of the trained model file exists (see resolve_trained_model_file),
+    it is loaded instead.
+    If a representation is supplied and export_ace_engine has written a TorchScript
+    file for it from the same weights and at the same precision, the TorchScript file
+    is loaded instead.
+
+    Parameters:
+        trained_model_file  :   Trained model file.
+        model_name          :   Hugging Face name (or directory) of the base model (default: 'facebook/esm2_t6_8M_UR50D').
+        device              :   Device (default: 'cuda' if available, otherwise 'cpu').
+        precision           :   'fp32', 'bf16' or 'int8' (default: 'fp32').
+        representation      :   Representation the engine will compute (default: None, any representation).
+
+    Returns:
+        ace_eng             :   AceNeuralEngine object.
+    """
+    precision = str(precision)
+    key = _get_engine_key(trained_model_file=trained_model_file, model_name=model_name, device=device, precision=precision,
+                          representation=representation)
+    with _ENGINES_LOCK:
+        ace_eng = _ENGINES.get(key, None)
+        if ace_eng is None:
+            logger.info('Loading ACE neural engine (model: %s, weights: %s, device: %s, precision: %s, TorchScript representation: %s).' % key)
+            ace_eng = _load_engine(
+                trained_model_file=trained_model_file,
+                model_name=model_name,
+                device=torch.device(key[2]),
+                precision=precision,
+                representation=key[4]
+            )
+            _ENGINES[key] = ace_eng
+        return ace_eng
+
+
+def warm_up_ace_engine(
+        trained_model_file: str,
+        model_name: str = DEFAULT_ESM2_MODEL_NAME,
+        device: Optional[torch.device] = None,
+        precision: str = DEFAULT_MODEL_PRECISION,
+        representation: Optional[str] = None
+) -> AceNeuralEngine:
+    """
+    Load an AceNeuralEngine into the registry ahead of time and run
+    one embedding so that later calls do not pay the start-up cost.
+
+    Parameters:
+        trained_model_file  :   Trained model file.
+        model_name          :   Hugging Face name (or directory) of the base model (default: 'facebook/esm2_t6_8M_UR50D').
+        device              :   Device (default: 'cuda' if available, otherwise 'cpu').
+        precision           :   'fp32', 'bf16' or 'int8' (default: 'fp32').
+        representation      :   Representation the engine will compute (default: None, any representation).
+
+    Returns:
+        ace_eng             :   AceNeuralEngine object.
+    """
+    ace_eng = get_ace_engine(
+        trained_model_file=trained_model_file,
+        model_name=model_name,
+        device=device,
+        precision=precision,
+        representation=representation
+    )
+    if representation is not None:
+        ace_eng.embed_sequences(['SIINFEKL'], representation=representation)
+    else:
+        ace_eng.embed_sequences(['SIINFEKL'])
+    return ace_eng
+
+
+def evict_ace_engine(
+        trained_model_file: str,
+        model_name: str = DEFAULT_ESM2_MODEL_NAME,
+        device: Optional[torch.device] = None,
+        precision: str = DEFAULT_MODEL_PRECISION,
+        representation: Optional[str] = None
+) -> bool:
+    """
+    Remove an AceNeuralEngine from the registry.
+
+    Parameters:
+        trained_model_file  :   Trained model file.
+        model_name          :   Hugging Face name (or directory) of the base model (default: 'facebook/esm2_t6_8M_UR50D').
+        device              :   Device (default: 'cuda' if available, otherwise 'cpu').
+        precision           :   'fp32', 'bf16' or 'int8' (default: 'fp32').
+        representation      :   Representation passed to get_ace_engine (default: None).
+
+    Returns:
+        evicted             :   True if the engine was in the registry.
+    """
+    key = _get_engine_key(trained_model_file=trained_model_file, model_name=model_name, device=device, precision=str(precision),
+                          representation=representation)
+    with _ENGINES_LOCK:
+        evicted = _ENGINES.pop(key, None) is not None
+    if evicted and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return evicted
+
+
+def clear_ace_engines():
+    """
+    Remove all AceNeuralEngine objects from the registry.
+    """
+    with _ENGINES_LOCK:
+        _ENGINES.clear()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def get_num_ace_engines() -> int:
+    """
+    Return the number of AceNeuralEngine objects in the registry.
+
+    Returns:
+        num_engines     :   Number of loaded engines.
+    """
+    with _ENGINES_LOCK:
+        return len(_ENGINES)
+
+
+def compare_precision(
+        trained_model_file: str,
+        peptide_ids: List[str],
+        peptide_sequences: List[str],
+        precision: str,
+        sim_fxn: str = 'euclidean',
+        threshold: float = 0.8,
+        top_k: int = 1,
+        model_name: str = DEFAULT_ESM2_MODEL_NAME,
+        device: Optional[torch.device] = None
+) -> Dict[str, float]:
+    """
+    Compare the preferred peptide pairs found at a reduced precision
+    against those found at full (fp32) precision.
+
+    Parameters:
+        trained_model_file  :   Trained model file.
+        peptide_ids         :   Peptide IDs.
+        peptide_sequences   :   Peptide sequences.
+        precision           :   'bf16' or 'int8'.
+        sim_fxn             :   'euclidean' or 'cosine' (default: 'euclidean').
+        threshold           :   Sequence similarity threshold (default: 0.8).
+        top_k               :   Number of pairs kept per peptide (default: 1).
+        model_name          :   Hugging Face name (or directory) of the base model (default: 'facebook/esm2_t6_8M_UR50D').
+        device              :   Device (default: 'cuda' if available, otherwise 'cpu').
+
+    Returns:
+        report              :   Dictionary with the following keys:
+                                'num_pairs_fp32': number of pairs at fp32.
+                                'num_pairs': number of pairs at the reduced precision.
+                                'num_pairs_added': pairs found only at the reduced precision.
+                                'num_pairs_removed': pairs found only at fp32.
+                                'fraction_pairs_changed': (added + removed) / pairs at fp32.
+                                'max_score_difference': largest absolute score difference of the shared pairs.
+    """
+    pairs = {}
+    for precision_ in ['fp32', str(precision)]:
+        ace_eng = get_ace_engine(
+            trained_model_file=trained_model_file,
+            model_name=model_name,
+            device=device,
+            precision=precision_
+        )
+        preferred_peptide_pairs = ace_eng.find_paired_peptides(
+            peptide_ids=peptide_ids,
+            peptide_sequences=peptide_sequences,
+            sim_fxn=sim_fxn,
+            threshold=threshold,
+            top_k=top_k
+        )
+        pairs[precision_] = {(peptide_id_1, peptide_id_2): score for peptide_id_1, peptide_id_2, score in preferred_peptide_pairs}
+    pairs_fp32 = pairs['fp32']
+    pairs_reduced = pairs[str(precision)]
+    shared_pairs = pairs_fp32.keys() & pairs_reduced.keys()
+    num_pairs_added = len(pairs_reduced.keys() - pairs_fp32.keys())
+    num_pairs_removed = len(pairs_fp32.keys() - pairs_reduced.keys())
+    return {
+        'num_pairs_fp32': len(pairs_fp32),
+        'num_pairs': len(pairs_reduced),
+        'num_pairs_added': num_pairs_added,
+        'num_pairs_removed': num_pairs_removed,
+        'fraction_pairs_changed': (num_pairs_added + num_pairs_removed) / max(len(pairs_fp32), 1),
+        'max_score_difference': max([abs(pairs_fp32[pair] - pairs_reduced[pair]) for pair in shared_pairs], default=0.0)
+    }
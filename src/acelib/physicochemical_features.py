@@ -0,0 +1,131 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+The purpose of this python3 script is to implement peptide sequence
+similarity based on amino acid physicochemical property profiles.
+"""
+
+
+import numpy as np
+from typing import List, Optional, Sequence, Tuple
+from .constants import _AMINO_ACID_PROPERTIES
+from .defaults import DEFAULT_PHYSICOCHEMICAL_ENCODING, DEFAULT_SIMILARITY_SEARCH_MEMORY_BUDGET
+from .logger import get_logger
+from .similarity_search import find_top_k_similar_pairs
+
+
+logger = get_logger(__name__)
+
+
+def get_property_lookup_table() -> np.ndarray:
+    """
+    Return a lookup table of standardized amino acid physicochemical properties.
+
+    Each property (column of _AMINO_ACID_PROPERTIES) is standardized to zero mean
+    and unit variance across the 20 amino acids; missing values are set to 0.
+
+    Returns:
+        table   :   Array of shape (256, number of properties) indexed by the
+                    ASCII code of an amino acid. Rows of characters that are
+                    not amino acids are 0.
+    """
+    properties = _AMINO_ACID_PROPERTIES.to_numpy(dtype=np.float64)
+    means = np.nanmean(properties, axis=0)
+    stds = np.nanstd(properties, axis=0)
+    stds[stds == 0] = 1.0
+    standardized = np.nan_to_num((properties - means) / stds, nan=0.0)
+    table = np.zeros((256, properties.shape[1]), dtype=np.float32)
+    for amino_acid, row in zip(_AMINO_ACID_PROPERTIES.index, standardized):
+        table[ord(amino_acid)] = row
+        table[ord(amino_acid.lower())] = row
+    return table
+
+
+_PROPERTY_LOOKUP_TABLE = get_property_lookup_table()
+
+
+def encode_peptides(
+        sequences: Sequence[str],
+        encoding: str = DEFAULT_PHYSICOCHEMICAL_ENCODING,
+        max_length: Optional[int] = None
+) -> np.ndarray:
+    """
+    Encode peptide sequences as physicochemical property profiles.
+
+    Parameters:
+        sequences   :   Peptide sequences.
+        encoding    :   'positional' (the property vector of every residue, zero-padded to
+                        max_length) or 'composition' (the mean property vector of the residues).
+        max_length  :   Number of positions of the positional encoding
+                        (default: length of the longest sequence).
+
+    Returns:
+        profiles    :   Array of shape (number of sequences, max_length * number of properties)
+                        for 'positional' or (number of sequences, number of properties) for 'composition'.
+    """
+    if encoding not in ('positional', 'composition'):
+        raise ValueError("Encoding must be 'positional' or 'composition'")
+    num_properties = _PROPERTY_LOOKUP_TABLE.shape[1]
+    lengths = np.array([len(s) for s in sequences], dtype=np.int64)
+    if max_length is None:
+        max_length = int(lengths.max()) if len(lengths) > 0 else 0
+
+    # Character codes of all sequences, padded with 0 (which maps to a zero property vector)
+    codes = np.zeros((len(sequences), max_length), dtype=np.uint8)
+    for idx, sequence in enumerate(sequences):
+        sequence_codes = np.frombuffer(sequence[:max_length].encode('ascii', errors='replace'), dtype=np.uint8)
+        codes[idx, :len(sequence_codes)] = sequence_codes
+    profiles = _PROPERTY_LOOKUP_TABLE[codes]     # (number of sequences, max_length, number of properties)
+
+    if encoding == 'positional':
+        return profiles.reshape(len(sequences), max_length * num_properties)
+    counts = np.maximum(np.minimum(lengths, max_length), 1).astype(np.float32)
+    return profiles.sum(axis=1) / counts[:, None]
+
+
+def find_physicochemical_paired_peptides(
+        peptide_ids: List[str],
+        peptide_sequences: List[str],
+        threshold: float = 0.8,
+        top_k: int = 1,
+        encoding: str = DEFAULT_PHYSICOCHEMICAL_ENCODING,
+        sim_fxn: str = 'euclidean',
+        memory_budget: int = DEFAULT_SIMILARITY_SEARCH_MEMORY_BUDGET
+) -> List[Tuple[str, str, float]]:
+    """
+    Find pairs of peptides with similar physicochemical property profiles.
+
+    Parameters:
+        peptide_ids         :   Peptide IDs.
+        peptide_sequences   :   Peptide sequences.
+        threshold           :   Similarity threshold.
+        top_k               :   Maximum number of pairs to keep per peptide.
+        encoding            :   'positional' or 'composition'.
+        sim_fxn             :   'euclidean' or 'cosine'.
+        memory_budget       :   Memory budget in bytes for one similarity tile.
+
+    Returns:
+        paired_peptide_triples  :   List of (peptide ID, peptide ID, similarity).
+    """
+    profiles = encode_peptides(sequences=peptide_sequences, encoding=encoding)
+    paired_peptide_ids = []
+    for i, j, metric in find_top_k_similar_pairs(
+            profiles,
+            sim_fxn=sim_fxn,
+            threshold=threshold,
+            top_k=top_k,
+            memory_budget=memory_budget
+    ):
+        paired_peptide_ids.append((peptide_ids[i], peptide_ids[j], metric))
+    return paired_peptide_ids
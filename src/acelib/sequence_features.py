@@ -17,17 +17,83 @@ which handles the sequence similarity component of the SAT solver.
 """
 
 
+import json
+import multiprocessing as mp
 import numpy as np
 import pandas as pd
 import torch.nn as nn
 import torch
+import warnings
+import zipfile
+from collections import OrderedDict
+from multiprocessing import shared_memory
+from safetensors.torch import load_file as load_safetensors_file
+from transformers import BatchEncoding
+from .defaults import DEFAULT_EMBEDDING_BATCH_SIZE, DEFAULT_SIMILARITY_SEARCH_MODE, DEFAULT_SIMILARITY_SEARCH_MEMORY_BUDGET
+from .embedding_cache import EmbeddingCache, compute_file_hash
+from .levenshtein_search import find_hamming_paired_peptides, find_levenshtein_paired_peptides
 from .logger import get_logger
-import Levenshtein as levenshtein
+from .similarity_graph import pairs_to_csr_matrix, peptide_pairs_to_csr_matrix
+from .similarity_search import find_similar_pairs_indexed, find_top_k_similar_pairs, select_top_k_pairs
 
 
 logger = get_logger(__name__)
 
 
+_WORKER_ENGINE = None
+
+
+class _SharedMemoryArray:
+    """
+    Exposes a shared memory block as a numpy array. np.asarray() of this object
+    keeps it alive as the base of the array (and of every view of the array),
+    so the block is unmapped when the last view is garbage collected.
+    """
+
+    def __init__(self, shm, shape, dtype):
+        self._shm = shm
+        self._array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        self.__array_interface__ = self._array.__array_interface__
+
+    def __del__(self):
+        self._array = None
+        self._shm.close()
+
+
+def _init_embedding_worker(ace_eng, num_threads):
+    global _WORKER_ENGINE
+    torch.set_num_threads(num_threads)
+    _WORKER_ENGINE = ace_eng
+
+
+def _embed_shard(args):
+    shm_name, shape, dtype, indices, sequences, representation, batch_size = args
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        output = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        embeddings, _ = _WORKER_ENGINE._embed_sequences_bucketed(sequences, representation=representation, batch_size=batch_size, dtype=dtype)
+        if embeddings.ndim == 3:
+            output[indices, :embeddings.shape[1]] = embeddings
+        else:
+            output[indices] = embeddings
+        del output
+    finally:
+        shm.close()
+
+
+class _AceEncoder(nn.Module):
+    """Encoder and pooling of an AceNeuralEngine for one representation (traced by export_torchscript)"""
+
+    def __init__(self, ace_eng, representation):
+        super(_AceEncoder, self).__init__()
+        self.ace_eng = ace_eng
+        self.representation = representation
+
+    def forward(self, input_ids, attention_mask):
+        inputs = BatchEncoding({'input_ids': input_ids, 'attention_mask': attention_mask})
+        return self.ace_eng.forward(inputs, representation=self.representation)
+
+
 class AceNeuralEngine(nn.Module):
     """
     ACE Neural Engine handles the contextual sequence encoding 
@@ -40,8 +106,14 @@ class AceNeuralEngine(nn.Module):
     - last_hidden_state: last hidden state of the transformer
     - pooler_output: output of the pooler layer
     - cls_embedding: embedding of the [CLS] token
-    - mean_pooling: mean pooling of the last hidden state
+    - mean_pooling: mean pooling of the last hidden state (padding tokens excluded)
     - max_pooling: max pooling of the last hidden state
+    - mean_max_pooling: concatenation of mean and max pooling of the last hidden state
+    - concatenate_pooling: concatenation of the last four hidden states (per token)
+    - concatenate_mean_pooling: mean pooling of the concatenated last four hidden states
+
+    Pooled representations are reduced batch by batch, so embedding N peptides
+    yields a compact (N, D) matrix instead of a padded (N, L, H) tensor.
 
     Representation implementations are based on the HuggingFace Transformers library
     and code from this Kaggle Notebook: https://www.kaggle.com/code/rhtsingh/utilizing-transformer-representations-efficiently
@@ -51,8 +123,49 @@ class AceNeuralEngine(nn.Module):
         super(AceNeuralEngine, self).__init__()
         self.model = base_model
         self.tokenizer = tokenizer
-        self.device = device if device is not None else torch.device('cpu')
-        self.model.to(self.device)
+        self.device = torch.device(device) if device is not None else torch.device('cpu')
+        if self.model is not None:
+            self.model.to(self.device)
+        # Set by load_torchscript (the traced encoder replaces the model)
+        self.torchscript_module = None
+        self.torchscript_file = None
+        self.torchscript_representation = None
+        # Identifies the model weights in embedding cache keys
+        self.weights_hash = str(getattr(base_model, 'name_or_path', ''))
+        self.precision = 'fp32'
+
+    @property
+    def model_hash(self):
+        """Identifies the model weights and inference precision in embedding cache keys"""
+        if self.precision == 'fp32':
+            return self.weights_hash
+        return '%s_%s' % (self.weights_hash, self.precision)
+
+    def set_precision(self, precision):
+        """
+        Set the inference precision.
+
+        - fp32: full precision.
+        - bf16: bfloat16 autocast during inference.
+        - int8: dynamic int8 quantization of the linear layers (CPU only).
+          Quantization replaces the linear layers, so it must be applied after
+          load_weights and cannot be reverted.
+        """
+        precision = str(precision)
+        if precision not in ('fp32', 'bf16', 'int8'):
+            raise ValueError("Precision must be 'fp32', 'bf16' or 'int8'")
+        if self.precision == 'int8' and precision != 'int8':
+            raise ValueError("Dynamic int8 quantization cannot be reverted")
+        if precision == 'int8' and self.precision != 'int8':
+            if self.device.type != 'cpu':
+                raise ValueError("Dynamic int8 quantization is only supported on CPU")
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {nn.Linear}, dtype=torch.qint8)
+        self.precision = precision
+
+    @staticmethod
+    def set_num_threads(num_threads):
+        """Set the number of intra-op threads used by torch (applies to the whole process)"""
+        torch.set_num_threads(num_threads)
 
     def forward(self, inputs, representation='last_hidden_state'):
         """
@@ -64,6 +177,10 @@ class AceNeuralEngine(nn.Module):
         if isinstance(inputs, list):
             inputs = self.tokenizer(inputs, padding=True, return_tensors='pt')
         inputs = inputs.to(self.device)
+        if self.torchscript_module is not None:
+            if representation != self.torchscript_representation:
+                raise ValueError("The TorchScript encoder was exported for the '%s' representation" % self.torchscript_representation)
+            return self.torchscript_module(inputs['input_ids'], inputs['attention_mask'])
         attention_mask = inputs['attention_mask']
         model_outputs = self.model(**inputs)
 
@@ -91,7 +208,7 @@ class AceNeuralEngine(nn.Module):
             sum_mask = input_mask_expanded.sum(1)
             sum_mask = torch.clamp(sum_mask, min=1e-9)
             mean_embeddings = sum_embeddings / sum_mask
-            representation = model_outputs.hidden_states[-1].mean(dim=1)
+            representation = mean_embeddings
 
         elif representation=='max_pooling':
             # representation: [batch_size, hidden_size]
@@ -116,6 +233,15 @@ class AceNeuralEngine(nn.Module):
             queried_hidden_states = torch.stack(model_outputs.hidden_states[-4:])
             representation = torch.cat(tuple(queried_hidden_states), dim=-1)
 
+        elif representation == 'concatenate_mean_pooling':
+            # Concatenate the last four layers and mean pool over the (unpadded) tokens
+            # repesentation: [batch_size, 4*hidden_size]
+            concatenated_hidden_states = torch.cat(tuple(model_outputs.hidden_states[-4:]), dim=-1)
+            input_mask_expanded = attention_mask.unsqueeze(-1).to(concatenated_hidden_states.dtype)
+            sum_embeddings = torch.sum(concatenated_hidden_states * input_mask_expanded, 1)
+            sum_mask = torch.clamp(input_mask_expanded.sum(1), min=1e-9)
+            representation = sum_embeddings / sum_mask
+
         #TODO: implement other pooling strategies (e.g. weighted_layer_pooling, attention_pooling)
         # elif self.representation == 'weighted_layer_pooling':
         # elif self.representation == 'attention_pooling':
@@ -123,8 +249,101 @@ class AceNeuralEngine(nn.Module):
         return representation
 
     def load_weights(self, weights_path):
-        """Load weights from a file"""
-        self.load_state_dict(torch.load(weights_path, map_location=self.device))
+        """Load weights from a file (a torch .pt file or a memory-mapped .safetensors file)"""
+        if weights_path.endswith('.safetensors'):
+            self.load_state_dict(load_safetensors_file(weights_path, device=str(self.device)))
+        else:
+            self.load_state_dict(torch.load(weights_path, map_location=self.device))
+        self.weights_hash = compute_file_hash(weights_path)
+
+    def export_torchscript(self, torchscript_file, representation='last_hidden_state'):
+        """
+        Trace the encoder and the pooling of one representation into a TorchScript file.
+        The file can be loaded with load_torchscript without building the Hugging Face model.
+
+        Parameters:
+        ----------------------------------------------------------------------------------------
+            * torchscript_file: output file
+            * representation: representation computed by the traced encoder
+        """
+        if self.torchscript_module is not None:
+            raise ValueError("The engine already runs a TorchScript encoder")
+        if self.precision == 'bf16':
+            raise ValueError("bf16 autocast cannot be traced; export at 'fp32' or 'int8' precision")
+        # Rotary position embeddings cache their tables per sequence length; without a cache
+        # the tables are computed from the input length in the trace instead of stored as constants
+        for module in self.model.modules():
+            if hasattr(module, '_seq_len_cached'):
+                module._seq_len_cached = None
+                module._cos_cached = None
+                module._sin_cached = None
+        # Two sequences of different lengths so that the trace includes padding
+        example = self.tokenizer(['SIINFEKL', 'MKVL'], padding=True, return_tensors='pt').to(self.device)
+        encoder = _AceEncoder(self, representation).eval()
+        with torch.no_grad(), warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=torch.jit.TracerWarning)
+            traced = torch.jit.trace(encoder, (example['input_ids'], example['attention_mask']), check_trace=False)
+            traced = torch.jit.freeze(traced)
+        metadata = {'representation': representation, 'weights_hash': self.weights_hash, 'precision': self.precision}
+        torch.jit.save(traced, torchscript_file, _extra_files={'ace_metadata.json': json.dumps(metadata)})
+
+    @staticmethod
+    def read_torchscript_metadata(torchscript_file):
+        """
+        Read the metadata written by export_torchscript without loading the TorchScript module.
+
+        Parameters:
+        ----------------------------------------------------------------------------------------
+            * torchscript_file: TorchScript file
+
+        Returns:
+        ----------------------------------------------------------------------------------------
+        metadata: dictionary with the keys 'representation', 'weights_hash' and 'precision'
+        """
+        with zipfile.ZipFile(torchscript_file) as f:
+            for name in f.namelist():
+                if name.endswith('/extra/ace_metadata.json'):
+                    return json.loads(f.read(name))
+        raise ValueError("%s was not written by export_torchscript" % torchscript_file)
+
+    @classmethod
+    def load_torchscript(cls, torchscript_file, tokenizer, device=None):
+        """
+        Load an engine from a TorchScript file written by export_torchscript. The engine
+        computes only the exported representation and shares embedding cache entries
+        with the engine it was exported from.
+
+        Parameters:
+        ----------------------------------------------------------------------------------------
+            * torchscript_file: TorchScript file
+            * tokenizer: tokenizer of the base model
+            * device: device
+
+        Returns:
+        ----------------------------------------------------------------------------------------
+        ace_eng: AceNeuralEngine object
+        """
+        ace_eng = cls(None, tokenizer, device)
+        extra_files = {'ace_metadata.json': ''}
+        ace_eng.torchscript_module = torch.jit.load(torchscript_file, map_location=ace_eng.device, _extra_files=extra_files)
+        metadata = json.loads(extra_files['ace_metadata.json'])
+        ace_eng.torchscript_file = torchscript_file
+        ace_eng.torchscript_representation = metadata['representation']
+        ace_eng.weights_hash = metadata['weights_hash']
+        ace_eng.precision = metadata['precision']
+        ace_eng.eval()
+        return ace_eng
+
+    def __getstate__(self):
+        # TorchScript modules cannot be pickled (e.g. for embed_sequences_sharded), so they are reloaded from their file
+        state = self.__dict__.copy()
+        state['_modules'] = OrderedDict((name, module) for name, module in self._modules.items() if name != 'torchscript_module')
+        return state
+
+    def __setstate__(self, state):
+        super(AceNeuralEngine, self).__setstate__(state)
+        if self.torchscript_file is not None:
+            self.torchscript_module = torch.jit.load(self.torchscript_file, map_location=self.device)
 
     def save_weights(self, weights_path):
         """Save weights to a file"""
@@ -154,20 +373,171 @@ class AceNeuralEngine(nn.Module):
         b = emb2.reshape(-1)
         return 1 - np.linalg.norm(a-b)/(np.linalg.norm(a)+np.linalg.norm(b))
 
-    def embed_sequences(self, sequences, representation='last_hidden_state'):
-        """Calculate embeddings for a list of sequences"""
+    def embed_sequences(self, sequences, representation='last_hidden_state', cache=None, batch_size=None, dtype=np.float32, num_processes=1):
+        """
+        Calculate embeddings for a list of sequences.
+
+        By default all sequences are tokenized as one padded batch. If batch_size is supplied,
+        sequences are bucketed by token length and run through the model in minibatches of at
+        most batch_size sequences of equal length, so no padding is involved; the results are
+        written into a preallocated array in the original order.
+
+        If an EmbeddingCache is supplied, only the sequences missing from the cache are run
+        through the model (bucketed as above) and the new embeddings are added to the cache.
+
+        In both cases token-level representations ('last_hidden_state', 'concatenate_pooling')
+        are zero-padded to the longest sequence.
+
+        Embeddings are returned as dtype (np.float32 or np.float16); each batch is converted
+        as soon as it is computed.
+
+        If num_processes is greater than 1, the sequences (or the cache misses) are embedded
+        by embed_sequences_sharded.
+        """
+        dtype = np.dtype(dtype)
+        if dtype not in (np.float32, np.float16):
+            raise ValueError("dtype must be float32 or float16")
+        if cache is not None:
+            return self._embed_sequences_cached(sequences, representation=representation, cache=cache,
+                                                batch_size=batch_size if batch_size is not None else DEFAULT_EMBEDDING_BATCH_SIZE,
+                                                dtype=dtype, num_processes=num_processes)
+        if num_processes > 1:
+            return self.embed_sequences_sharded(sequences, representation=representation, num_processes=num_processes,
+                                                batch_size=batch_size, dtype=dtype)
+        if batch_size is not None:
+            embeddings, _ = self._embed_sequences_bucketed(sequences, representation=representation, batch_size=batch_size, dtype=dtype)
+            return embeddings
+
         # Tokenize sequences
         tokenized = self.tokenizer(list(sequences), padding=True, return_tensors='pt')
 
         # Get embeddings
-        with torch.no_grad():
-            output = self.forward(tokenized, representation=representation)
-            embeddings = output.cpu().numpy()
+        embeddings = self._infer(tokenized, representation=representation).astype(dtype, copy=False)
 
         assert len(embeddings) == len(sequences)
         return embeddings
 
-    def find_paired_peptides(self, peptide_ids, peptide_sequences, representation='last_hidden_state', sim_fxn='euclidean', threshold=0.8, top_k=1):
+    def embed_sequences_sharded(self, sequences, representation='last_hidden_state', num_processes=2, batch_size=None, dtype=np.float32):
+        """
+        Calculate embeddings for a list of sequences with a pool of worker processes.
+
+        Each worker receives a copy of the engine once (when the pool starts), embeds one shard
+        of sequences of similar length with length-bucketed minibatches, and writes the result
+        directly into a shared memory array. The returned array is a zero-copy view of that
+        shared memory; the memory is released when the array (and every view of it) is deleted.
+        The torch intra-op threads of this process are divided among the workers.
+
+        Token-level representations are zero-padded to the longest sequence, as in the
+        bucketed (batch_size) mode of embed_sequences, which gives the same embeddings.
+        """
+        dtype = np.dtype(dtype)
+        sequences = list(sequences)
+        batch_size = batch_size if batch_size is not None else DEFAULT_EMBEDDING_BATCH_SIZE
+        input_ids = self.tokenizer(sequences)['input_ids']
+        lengths = np.array([len(ids) for ids in input_ids], dtype=np.int64)
+
+        # Embed one sequence to find the shape of the representation
+        probe = self._infer(self.tokenizer(sequences[:1], return_tensors='pt'), representation=representation)
+        if probe.ndim == 3:
+            shape = (len(sequences), int(lengths.max()), probe.shape[2])
+        else:
+            shape = (len(sequences),) + probe.shape[1:]
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+
+        shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        try:
+            embeddings = np.asarray(_SharedMemoryArray(shm, shape=shape, dtype=dtype))
+            embeddings[...] = 0
+            # Shards are contiguous runs of the sequences sorted by length, so each worker sees few bucket lengths
+            shards = [shard for shard in np.array_split(np.argsort(lengths, kind='stable'), num_processes) if len(shard) > 0]
+            tasks = [(shm.name, shape, dtype, shard, [sequences[idx] for idx in shard], representation, batch_size) for shard in shards]
+            num_threads = max(1, torch.get_num_threads() // len(shards))
+            # Workers are spawned rather than forked, since forking a process that has started torch threads is unsafe
+            with mp.get_context('spawn').Pool(processes=len(shards), initializer=_init_embedding_worker,
+                                              initargs=(self, num_threads)) as pool:
+                pool.map(_embed_shard, tasks)
+        finally:
+            # The name is removed right away; the memory stays mapped until the array is deleted
+            shm.unlink()
+        return embeddings
+
+    def _infer(self, tokenized, representation):
+        """Run the model on tokenized sequences at the engine precision and return float32 embeddings"""
+        with torch.inference_mode(), torch.autocast(device_type=self.device.type, dtype=torch.bfloat16,
+                                                    enabled=self.precision == 'bf16'):
+            output = self.forward(tokenized, representation=representation)
+        return output.float().cpu().numpy()
+
+    def _embed_sequences_bucketed(self, sequences, representation, batch_size, dtype=np.float32):
+        """
+        Embed sequences in length-bucketed minibatches.
+
+        Returns:
+            embeddings  :   Embeddings in the original order.
+            lengths     :   Token length of each sequence.
+        """
+        sequences = list(sequences)
+        input_ids = self.tokenizer(sequences)['input_ids']
+        lengths = np.array([len(ids) for ids in input_ids], dtype=np.int64)
+        order = np.argsort(lengths, kind='stable')
+        embeddings = None
+        for bucket_length in np.unique(lengths):
+            bucket_idxs = order[lengths[order] == bucket_length]
+            for start in range(0, len(bucket_idxs), batch_size):
+                batch_idxs = bucket_idxs[start:start + batch_size]
+                tokenized = self.tokenizer.pad({'input_ids': [input_ids[idx] for idx in batch_idxs]}, return_tensors='pt')
+                output = self._infer(tokenized, representation=representation)
+                if embeddings is None:
+                    if output.ndim == 3:
+                        shape = (len(sequences), int(lengths.max()), output.shape[2])
+                    else:
+                        shape = (len(sequences),) + output.shape[1:]
+                    embeddings = np.zeros(shape, dtype=dtype)
+                if output.ndim == 3:
+                    embeddings[batch_idxs, :output.shape[1]] = output
+                else:
+                    embeddings[batch_idxs] = output
+        return embeddings, lengths
+
+    def _embed_sequences_cached(self, sequences, representation, cache: EmbeddingCache, batch_size, dtype=np.float32, num_processes=1):
+        sequences = list(sequences)
+        # Embeddings of each data type are stored under their own keys
+        cache_representation = representation if dtype == np.float32 else '%s:%s' % (representation, np.dtype(dtype).name)
+        embeddings = cache.get(sequences, model_hash=self.model_hash, representation=cache_representation)
+        missing_sequences = list(dict.fromkeys(seq for idx, seq in enumerate(sequences) if idx not in embeddings))
+        if len(missing_sequences) > 0:
+            if num_processes > 1:
+                missing_embeddings = self.embed_sequences_sharded(missing_sequences, representation=representation,
+                                                                  num_processes=num_processes, batch_size=batch_size, dtype=dtype)
+                lengths = [len(ids) for ids in self.tokenizer(missing_sequences)['input_ids']]
+            else:
+                missing_embeddings, lengths = self._embed_sequences_bucketed(missing_sequences, representation=representation,
+                                                                             batch_size=batch_size, dtype=dtype)
+            if missing_embeddings.ndim == 3:
+                # Store token-level embeddings without padding
+                missing_embeddings = [e[:length] for e, length in zip(missing_embeddings, lengths)]
+            new_embeddings = dict(zip(missing_sequences, missing_embeddings))
+            cache.put(missing_sequences, [new_embeddings[seq] for seq in missing_sequences],
+                      model_hash=self.model_hash, representation=cache_representation)
+            for idx, seq in enumerate(sequences):
+                if idx not in embeddings:
+                    embeddings[idx] = new_embeddings[seq]
+        return self.stack_embeddings([embeddings[idx] for idx in range(len(sequences))])
+
+    @staticmethod
+    def stack_embeddings(embeddings):
+        """Stack per-sequence embeddings, zero-padding token-level embeddings to the longest sequence"""
+        if len(embeddings) == 0 or embeddings[0].ndim < 2:
+            return np.stack(embeddings)
+        max_len = max(e.shape[0] for e in embeddings)
+        stacked = np.zeros((len(embeddings), max_len) + embeddings[0].shape[1:], dtype=embeddings[0].dtype)
+        for idx, embedding in enumerate(embeddings):
+            stacked[idx, :embedding.shape[0]] = embedding
+        return stacked
+
+    def find_paired_peptides(self, peptide_ids, peptide_sequences, representation='last_hidden_state', sim_fxn='euclidean', threshold=0.8, top_k=1,
+                             search_mode=DEFAULT_SIMILARITY_SEARCH_MODE, memory_budget=DEFAULT_SIMILARITY_SEARCH_MEMORY_BUDGET, cache=None,
+                             batch_size=None, exact=True, dtype=np.float32, return_sparse=False, num_processes=1):
         """
         Find peptides that are predicted to share the same immunological context. Works by embedding the different sequences and then finding those
         which have a similarity greater than the threshold provided. Then, the post processing is applied so only the most confident top_k pairs are 
@@ -181,54 +551,154 @@ class AceNeuralEngine(nn.Module):
             * sim_fxn: String corresponding to one of the above similarity functions ['euclidean', 'cosine', 'levenshtein']
             * threshold: the similarity threshold to cutoff similar peptides
             * top_k: the top number of pairs to cut-off. Good values can depend on the dataset but the lower the better.
+            * search_mode: 'matrix' computes similarities in tiles of the upper triangle with matrix products,
+                           'index' runs radius queries against a BallTree of the embeddings,
+                           'pairwise' compares one pair of embeddings at a time.
+            * memory_budget: memory budget in bytes for one similarity tile ('matrix' mode only).
+            * cache: EmbeddingCache object (optional) used to skip embedding previously seen sequences.
+            * batch_size: number of sequences per length-bucketed minibatch (default: one padded batch).
+            * exact: if False, the 'index' search runs on a random projection of the embeddings, which is
+                     faster but may miss pairs (see similarity_search.compute_recall).
+            * dtype: data type of the stored embeddings (np.float32 or np.float16).
+            * return_sparse: if True, return the pairs as a scipy.sparse CSR matrix over peptide indices
+                             (see similarity_graph.csr_matrix_to_peptide_pairs) instead of triples.
+            * num_processes: number of worker processes used to compute embeddings (see embed_sequences_sharded).
         
         Returns:
         ----------------------------------------------------------------------------------------
         paired_peptide_triples: a list of triples of the form [(peptide_id1, peptide_id2, similiarity)]
+                                or a CSR matrix whose entry (i, j), i < j, is the similarity of
+                                peptide_ids[i] and peptide_ids[j] if return_sparse is True
         """
-        embeddings = self.embed_sequences(peptide_sequences, representation=representation)
+        if sim_fxn not in ('euclidean', 'cosine'):
+            raise ValueError("Similarity function must be 'euclidean' 'cosine'")
+        embeddings = self.embed_sequences(peptide_sequences, representation=representation, cache=cache, batch_size=batch_size, dtype=dtype,
+                                          num_processes=num_processes)
         paired_peptide_ids = []
-        for i in range(len(peptide_ids)):
-            for j in range(len(peptide_ids)):
-                if i == j:
-                    continue
-                if sim_fxn == 'euclidean':
-                    metric =self.euclidean_similarity(embeddings[i], embeddings[j])
-                    if metric >= threshold:
-                        if (peptide_ids[j], peptide_ids[i], metric) in paired_peptide_ids:
-                            continue
-                        else:
-                            paired_peptide_ids.append((peptide_ids[i], peptide_ids[j], metric))
-                elif sim_fxn == 'cosine':
-                    metric = self.cosine_similarity(embeddings[i], embeddings[j])
+        if search_mode in ('matrix', 'index'):
+            if search_mode == 'matrix':
+                # Top-k pruning happens while the similarity tiles are computed
+                pairs = find_top_k_similar_pairs(embeddings, sim_fxn=sim_fxn, threshold=threshold, top_k=top_k, memory_budget=memory_budget)
+            else:
+                pairs = find_similar_pairs_indexed(embeddings, sim_fxn=sim_fxn, threshold=threshold, exact=exact)
+                pairs = select_top_k_pairs(pairs, top_k=top_k)
+            if return_sparse:
+                return pairs_to_csr_matrix(pairs, num_peptides=len(peptide_ids))
+            for i, j, metric in pairs:
+                paired_peptide_ids.append((peptide_ids[i], peptide_ids[j], metric))
+            return paired_peptide_ids
+        elif search_mode == 'pairwise':
+            for i in range(len(peptide_ids)):
+                for j in range(i + 1, len(peptide_ids)):
+                    if sim_fxn == 'euclidean':
+                        metric = self.euclidean_similarity(embeddings[i], embeddings[j])
+                    else:
+                        metric = self.cosine_similarity(embeddings[i], embeddings[j])
                     if metric >= threshold:
-                        if (peptide_ids[j], peptide_ids[i], metric) in paired_peptide_ids:
-                            continue
-                        else:
-                            paired_peptide_ids.append((peptide_ids[i], peptide_ids[j], metric))
-                else:
-                    raise ValueError("Similarity function must be 'euclidean' 'cosine'")
+                        paired_peptide_ids.append((peptide_ids[i], peptide_ids[j], metric))
+        else:
+            raise ValueError("Search mode must be 'matrix', 'index' or 'pairwise'")
         
-        return self.post_process(paired_peptide_ids, top_k)
+        paired_peptide_ids = self.post_process(paired_peptide_ids, top_k)
+        if return_sparse:
+            return peptide_pairs_to_csr_matrix(paired_peptide_ids, peptide_ids=peptide_ids)
+        return paired_peptide_ids
     
-    @staticmethod
-    def find_levenshtein_paired_peptides(peptide_ids, peptide_sequences, threshold=1):
-        if not float(threshold).is_integer():
-            raise ValueError("Threshold must be an integer value greater than or equal to 1.")
+    def find_incremental_paired_peptides(self, peptide_ids, peptide_sequences, preferred_peptide_pairs, new_peptide_ids, new_peptide_sequences,
+                                         embeddings=None, representation='last_hidden_state', sim_fxn='euclidean', threshold=0.8, top_k=1,
+                                         memory_budget=DEFAULT_SIMILARITY_SEARCH_MEMORY_BUDGET, cache=None, batch_size=None, dtype=np.float32):
+        """
+        Extend the preferred peptide pairs of an existing library with new peptides. Only the new sequences are embedded;
+        they are compared against the existing embeddings and each other, and the resulting pairs are merged with the
+        existing pairs. The result is identical to running find_paired_peptides (search_mode='matrix') on the existing
+        peptides followed by the new peptides, while the cost is proportional to the number of new peptides. For
+        token-level representations this holds when the embeddings are zero-padded (batch_size or cache supplied).
+
+        Parameters:
+        ----------------------------------------------------------------------------------------
+            * peptide_ids: List of existing peptide ids
+            * peptide_sequences: List of existing peptide sequences as strings
+            * preferred_peptide_pairs: triples of the existing peptides returned by find_paired_peptides (or by a
+                                       previous call of this method) with the same representation, sim_fxn, threshold and top_k
+            * new_peptide_ids: List of new peptide ids
+            * new_peptide_sequences: List of new peptide sequences as strings
+            * embeddings: embeddings of the existing peptides (as returned by embed_sequences or by a previous call of
+                          this method). If None, the existing peptides are embedded (or looked up in the cache).
+            * representation: representation passed to embed_sequences
+            * sim_fxn: 'euclidean' or 'cosine'
+            * threshold: the similarity threshold to cutoff similar peptides
+            * top_k: the top number of pairs to cut-off
+            * memory_budget: memory budget in bytes for one similarity tile
+            * cache: EmbeddingCache object (optional)
+            * batch_size: number of sequences per length-bucketed minibatch
+            * dtype: data type of the stored embeddings (np.float32 or np.float16)
 
+        Returns:
+        ----------------------------------------------------------------------------------------
+        paired_peptide_triples: a list of triples of the form [(peptide_id1, peptide_id2, similiarity)] over all peptides
+        embeddings: embeddings of the existing peptides followed by the new peptides
+        """
+        if sim_fxn not in ('euclidean', 'cosine'):
+            raise ValueError("Similarity function must be 'euclidean' 'cosine'")
+        if embeddings is None:
+            embeddings = self.embed_sequences(peptide_sequences, representation=representation, cache=cache, batch_size=batch_size, dtype=dtype)
+        if len(new_peptide_sequences) == 0:
+            return list(preferred_peptide_pairs), embeddings
+        new_embeddings = self.embed_sequences(new_peptide_sequences, representation=representation, cache=cache, batch_size=batch_size, dtype=dtype)
+        if len(embeddings) != len(peptide_ids):
+            raise ValueError("The number of embeddings must match the number of existing peptides.")
+        # Token-level representations are zero-padded to the longest sequence of both sets
+        all_embeddings = self.stack_embeddings([e.astype(new_embeddings.dtype, copy=False) for e in embeddings] + list(new_embeddings))
+        all_peptide_ids = list(peptide_ids) + list(new_peptide_ids)
+
+        # Pairs of two existing peptides are already top-k pruned, so the top k pairs of the
+        # union are the top k of the existing pairs and every pair with a new peptide
+        peptide_idx = {peptide_id: idx for idx, peptide_id in enumerate(peptide_ids)}
+        pairs = [(peptide_idx[peptide_id_1], peptide_idx[peptide_id_2], score) for peptide_id_1, peptide_id_2, score in preferred_peptide_pairs]
+        pairs += find_top_k_similar_pairs(all_embeddings, sim_fxn=sim_fxn, threshold=threshold, top_k=top_k,
+                                          memory_budget=memory_budget, column_start=len(peptide_ids))
         paired_peptide_ids = []
-        for i in range(len(peptide_ids)):
-            for j in range(len(peptide_ids)):
-                if i == j:
-                    continue
-                metric = levenshtein.distance(peptide_sequences[i], peptide_sequences[j])
-                if metric <= threshold:
-                    if (peptide_sequences[j], peptide_sequences[i], metric) in paired_peptide_ids:
-                        continue
-                    else:
-                        paired_peptide_ids.append((peptide_sequences[i], peptide_sequences[j], metric))
-        return list(paired_peptide_ids)
-    
+        for i, j, metric in select_top_k_pairs(pairs, top_k=top_k):
+            paired_peptide_ids.append((all_peptide_ids[i], all_peptide_ids[j], metric))
+        return paired_peptide_ids, all_embeddings
+
+    @staticmethod
+    def find_levenshtein_paired_peptides(peptide_ids, peptide_sequences, threshold=1, num_processes=1):
+        """
+        Find pairs of peptides whose sequences are within a Levenshtein (edit) distance of the threshold.
+        Candidate pairs are pruned with length and q-gram count filters before the distances are computed.
+
+        Parameters:
+        ----------------------------------------------------------------------------------------
+            * peptide_ids: List of peptide ids
+            * peptide_sequences: List of peptide sequences as strings
+            * threshold: the maximum edit distance of paired peptides (integer)
+            * num_processes: number of processes used to compute edit distances
+
+        Returns:
+        ----------------------------------------------------------------------------------------
+        paired_peptide_triples: a list of triples of the form [(peptide_id1, peptide_id2, distance)]
+        """
+        return find_levenshtein_paired_peptides(peptide_ids, peptide_sequences, threshold=threshold, num_processes=num_processes)
+
+    @staticmethod
+    def find_hamming_paired_peptides(peptide_ids, peptide_sequences, threshold=1):
+        """
+        Find pairs of equal-length peptides whose sequences are within a Hamming distance of the threshold.
+        Distances are computed in tiles of vectorized character comparisons.
+
+        Parameters:
+        ----------------------------------------------------------------------------------------
+            * peptide_ids: List of peptide ids
+            * peptide_sequences: List of peptide sequences as strings (all of the same length)
+            * threshold: the maximum number of mismatched positions of paired peptides (integer)
+
+        Returns:
+        ----------------------------------------------------------------------------------------
+        paired_peptide_triples: a list of triples of the form [(peptide_id1, peptide_id2, distance)]
+        """
+        return find_hamming_paired_peptides(peptide_ids, peptide_sequences, threshold=threshold)
+
     @staticmethod
     def post_process(paired_peptide_triples, n=1, return_dict=False):
         """
@@ -0,0 +1,118 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+The purpose of this python3 script is to implement conversions between
+preferred peptide pairs (triples) and sparse similarity graphs (CSR matrices).
+"""
+
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from typing import List, Sequence, Tuple
+from .logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+def pairs_to_csr_matrix(
+        pairs: Sequence[Tuple[int, int, float]],
+        num_peptides: int
+) -> csr_matrix:
+    """
+    Convert index pairs to a sparse similarity graph.
+
+    Each pair is stored once, in the upper triangle (row < column). Scores of 0
+    (e.g. a Levenshtein distance of 0) are kept as explicit entries. If a pair
+    occurs more than once, the first occurrence is kept.
+
+    Parameters:
+        pairs           :   List of (index 1, index 2, score).
+        num_peptides    :   Number of peptides (rows and columns of the matrix).
+
+    Returns:
+        matrix          :   CSR matrix of shape (num_peptides, num_peptides).
+    """
+    if len(pairs) == 0:
+        return csr_matrix((num_peptides, num_peptides), dtype=np.float64)
+    indices_1 = np.array([p[0] for p in pairs], dtype=np.int64)
+    indices_2 = np.array([p[1] for p in pairs], dtype=np.int64)
+    scores = np.array([p[2] for p in pairs], dtype=np.float64)
+    rows = np.minimum(indices_1, indices_2)
+    cols = np.maximum(indices_1, indices_2)
+    _, first = np.unique(rows * num_peptides + cols, return_index=True)
+    rows, cols, scores = rows[first], cols[first], scores[first]
+
+    # Built from (data, indices, indptr) so that explicit zero scores are not dropped
+    order = np.lexsort((cols, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+    indptr = np.zeros(num_peptides + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_peptides), out=indptr[1:])
+    return csr_matrix((scores, cols, indptr), shape=(num_peptides, num_peptides))
+
+
+def csr_matrix_to_pairs(matrix: csr_matrix) -> List[Tuple[int, int, float]]:
+    """
+    Convert a sparse similarity graph to index pairs.
+
+    Parameters:
+        matrix  :   CSR matrix (pairs in the upper triangle).
+
+    Returns:
+        pairs   :   List of (index 1, index 2, score) ordered by index 1
+                    and then by decreasing score (ties by index 2).
+    """
+    matrix = csr_matrix(matrix)
+    rows = np.repeat(np.arange(matrix.shape[0], dtype=np.int64), np.diff(matrix.indptr))
+    cols = matrix.indices.astype(np.int64)
+    scores = matrix.data.astype(np.float64)
+    order = np.lexsort((cols, -scores, rows))
+    return list(zip(rows[order].tolist(), cols[order].tolist(), scores[order].tolist()))
+
+
+def peptide_pairs_to_csr_matrix(
+        peptide_pairs: Sequence[Tuple[str, str, float]],
+        peptide_ids: Sequence[str]
+) -> csr_matrix:
+    """
+    Convert preferred peptide pairs to a sparse similarity graph over peptide indices.
+
+    Parameters:
+        peptide_pairs   :   List of (peptide ID, peptide ID, score).
+        peptide_ids     :   Peptide IDs (row i of the matrix is peptide_ids[i]).
+
+    Returns:
+        matrix          :   CSR matrix of shape (number of peptides, number of peptides).
+    """
+    peptide_idx = {peptide_id: idx for idx, peptide_id in enumerate(peptide_ids)}
+    pairs = [(peptide_idx[peptide_id_1], peptide_idx[peptide_id_2], score)
+             for peptide_id_1, peptide_id_2, score in peptide_pairs]
+    return pairs_to_csr_matrix(pairs=pairs, num_peptides=len(peptide_ids))
+
+
+def csr_matrix_to_peptide_pairs(
+        matrix: csr_matrix,
+        peptide_ids: Sequence[str]
+) -> List[Tuple[str, str, float]]:
+    """
+    Convert a sparse similarity graph over peptide indices to preferred peptide pairs.
+
+    Parameters:
+        matrix          :   CSR matrix (pairs in the upper triangle).
+        peptide_ids     :   Peptide IDs (row i of the matrix is peptide_ids[i]).
+
+    Returns:
+        peptide_pairs   :   List of (peptide ID, peptide ID, score).
+    """
+    return [(peptide_ids[i], peptide_ids[j], score) for i, j, score in csr_matrix_to_pairs(matrix=matrix)]
@@ -0,0 +1,371 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+The purpose of this python3 script is to implement matrix-based
+(tiled) and index-based all-pairs similarity search over peptide embeddings.
+"""
+
+
+import heapq
+import math
+import numpy as np
+from typing import Dict, Iterator, List, Tuple
+from .defaults import DEFAULT_SIMILARITY_SEARCH_MEMORY_BUDGET, DEFAULT_SIMILARITY_SEARCH_NUM_PROJECTIONS
+from .logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+def compute_tile_size(
+        num_embeddings: int,
+        memory_budget: int = DEFAULT_SIMILARITY_SEARCH_MEMORY_BUDGET
+) -> int:
+    """
+    Compute the number of rows (and columns) of a square similarity tile
+    that fits in the supplied memory budget.
+
+    Parameters:
+        num_embeddings  :   Number of embeddings.
+        memory_budget   :   Memory budget in bytes for one similarity tile.
+
+    Returns:
+        tile_size       :   Number of rows (and columns) per tile.
+    """
+    # A tile holds the float64 similarity block plus two temporaries of the same shape
+    tile_size = int(math.sqrt(memory_budget / (3 * np.dtype(np.float64).itemsize)))
+    return max(1, min(tile_size, num_embeddings))
+
+
+def iter_similarity_tiles(
+        embeddings: np.ndarray,
+        sim_fxn: str = 'euclidean',
+        memory_budget: int = DEFAULT_SIMILARITY_SEARCH_MEMORY_BUDGET,
+        column_start: int = 0
+) -> Iterator[Tuple[int, int, np.ndarray]]:
+    """
+    Iterate over the upper triangle of the all-pairs similarity matrix in tiles.
+
+    Parameters:
+        embeddings      :   Embeddings (first dimension indexes peptides;
+                            remaining dimensions are flattened).
+        sim_fxn         :   'euclidean' or 'cosine'.
+        memory_budget   :   Memory budget in bytes for one similarity tile.
+        column_start    :   Only columns with an index greater than or equal to
+                            column_start are computed (default: 0, all columns).
+
+    Returns:
+        Iterator of (row start index, column start index, similarity block).
+        Blocks that overlap the diagonal are returned in full; callers are expected
+        to keep only the entries above the diagonal (see _mask_lower_triangle).
+    """
+    if sim_fxn not in ('euclidean', 'cosine'):
+        raise ValueError("Similarity function must be 'euclidean' 'cosine'")
+    # Embeddings keep their (possibly float16) data type; each tile is promoted to float64
+    vectors = np.asarray(embeddings).reshape(len(embeddings), -1)
+    tile_size = compute_tile_size(num_embeddings=len(vectors), memory_budget=memory_budget)
+    squared_norms = np.empty(len(vectors), dtype=np.float64)
+    for start in range(0, len(vectors), tile_size):
+        tile = vectors[start:start + tile_size].astype(np.float64)
+        squared_norms[start:start + tile_size] = np.einsum('ij,ij->i', tile, tile)
+    norms = np.sqrt(squared_norms)
+    for row_start in range(0, len(vectors), tile_size):
+        row_end = min(row_start + tile_size, len(vectors))
+        rows = vectors[row_start:row_end].astype(np.float64)
+        for col_start in range(max(row_start, column_start), len(vectors), tile_size):
+            col_end = min(col_start + tile_size, len(vectors))
+            block = rows @ vectors[col_start:col_end].astype(np.float64).T
+            if sim_fxn == 'euclidean':
+                # ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b
+                block *= -2.0
+                block += squared_norms[row_start:row_end, None]
+                block += squared_norms[None, col_start:col_end]
+                np.maximum(block, 0.0, out=block)
+                np.sqrt(block, out=block)
+                block /= (norms[row_start:row_end, None] + norms[None, col_start:col_end])
+                np.subtract(1.0, block, out=block)
+            else:
+                block /= (norms[row_start:row_end, None] * norms[None, col_start:col_end])
+            yield row_start, col_start, block
+
+
+def _mask_lower_triangle(hits: np.ndarray, row_start: int, col_start: int) -> np.ndarray:
+    # Keep the entries of a tile whose (global) column index is above its row index
+    if col_start < row_start + hits.shape[0]:
+        return np.triu(hits, k=row_start - col_start + 1)
+    return hits
+
+
+def find_similar_pairs(
+        embeddings: np.ndarray,
+        sim_fxn: str = 'euclidean',
+        threshold: float = 0.8,
+        memory_budget: int = DEFAULT_SIMILARITY_SEARCH_MEMORY_BUDGET
+) -> List[Tuple[int, int, float]]:
+    """
+    Find all pairs of embeddings whose similarity is greater than or equal to the threshold.
+
+    Parameters:
+        embeddings      :   Embeddings (first dimension indexes peptides).
+        sim_fxn         :   'euclidean' or 'cosine'.
+        threshold       :   Similarity threshold.
+        memory_budget   :   Memory budget in bytes for one similarity tile.
+
+    Returns:
+        pairs           :   List of (index 1, index 2, similarity) where index 1 < index 2,
+                            ordered by index 1 and then by index 2.
+    """
+    all_rows, all_cols, all_scores = [], [], []
+    for row_start, col_start, block in iter_similarity_tiles(
+            embeddings=embeddings,
+            sim_fxn=sim_fxn,
+            memory_budget=memory_budget
+    ):
+        hits = _mask_lower_triangle(hits=block >= threshold, row_start=row_start, col_start=col_start)
+        rows, cols = np.nonzero(hits)
+        all_rows.append(rows + row_start)
+        all_cols.append(cols + col_start)
+        all_scores.append(block[rows, cols])
+    if len(all_rows) == 0:
+        return []
+    rows = np.concatenate(all_rows)
+    cols = np.concatenate(all_cols)
+    scores = np.concatenate(all_scores)
+    order = np.lexsort((cols, rows))
+    return list(zip(rows[order].tolist(), cols[order].tolist(), scores[order].tolist()))
+
+
+def find_top_k_similar_pairs(
+        embeddings: np.ndarray,
+        sim_fxn: str = 'euclidean',
+        threshold: float = 0.8,
+        top_k: int = 1,
+        memory_budget: int = DEFAULT_SIMILARITY_SEARCH_MEMORY_BUDGET,
+        column_start: int = 0
+) -> List[Tuple[int, int, float]]:
+    """
+    Find, for every embedding i, the top k embeddings j (j > i) whose similarity
+    is greater than or equal to the threshold. Candidates are pruned tile by tile
+    into a bounded heap per embedding, so memory stays proportional to the number
+    of embeddings times k rather than to the number of pairs above the threshold.
+
+    The result is identical to keeping the top k entries per first index of
+    find_similar_pairs (ties are broken in favor of the smaller second index).
+
+    Parameters:
+        embeddings      :   Embeddings (first dimension indexes peptides).
+        sim_fxn         :   'euclidean' or 'cosine'.
+        threshold       :   Similarity threshold.
+        top_k           :   Maximum number of pairs to keep per embedding.
+        memory_budget   :   Memory budget in bytes for one similarity tile.
+        column_start    :   Only embeddings j with j >= column_start are considered
+                            (e.g. the first new embedding when extending a library).
+
+    Returns:
+        pairs           :   List of (index 1, index 2, similarity) where index 1 < index 2,
+                            ordered by index 1 and then by decreasing similarity.
+    """
+    if top_k < 1:
+        raise ValueError("top_k must be greater than or equal to 1.")
+    # heaps[i] is a min-heap of (similarity, -j) holding the best k candidates of row i
+    heaps = [[] for _ in range(len(embeddings))]
+    for row_start, col_start, block in iter_similarity_tiles(
+            embeddings=embeddings,
+            sim_fxn=sim_fxn,
+            memory_budget=memory_budget,
+            column_start=column_start
+    ):
+        hits = _mask_lower_triangle(hits=block >= threshold, row_start=row_start, col_start=col_start)
+        if not hits.any():
+            continue
+        scores = np.where(hits, block, -np.inf)
+        if scores.shape[1] > top_k:
+            # Keep every entry tied with or above the k-th best score of its row
+            kth_scores = -np.partition(-scores, top_k - 1, axis=1)[:, top_k - 1]
+            hits &= scores >= kth_scores[:, None]
+        rows, cols = np.nonzero(hits)
+        for row, col, score in zip(rows.tolist(), cols.tolist(), scores[rows, cols].tolist()):
+            heap = heaps[row_start + row]
+            item = (score, -(col_start + col))
+            if len(heap) < top_k:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+
+    pairs = []
+    for i, heap in enumerate(heaps):
+        for score, neg_j in sorted(heap, reverse=True):
+            pairs.append((i, -neg_j, score))
+    return pairs
+
+
+def _compute_pair_similarities(
+        vectors: np.ndarray,
+        norms: np.ndarray,
+        rows: np.ndarray,
+        cols: np.ndarray,
+        sim_fxn: str,
+        chunk_size: int = 65536
+) -> np.ndarray:
+    scores = np.empty(len(rows), dtype=np.float64)
+    for start in range(0, len(rows), chunk_size):
+        end = min(start + chunk_size, len(rows))
+        a = vectors[rows[start:end]]
+        b = vectors[cols[start:end]]
+        norms_a = norms[rows[start:end]]
+        norms_b = norms[cols[start:end]]
+        if sim_fxn == 'euclidean':
+            scores[start:end] = 1.0 - np.linalg.norm(a - b, axis=1) / (norms_a + norms_b)
+        else:
+            scores[start:end] = np.einsum('ij,ij->i', a, b) / (norms_a * norms_b)
+    return scores
+
+
+def find_similar_pairs_indexed(
+        embeddings: np.ndarray,
+        sim_fxn: str = 'euclidean',
+        threshold: float = 0.8,
+        exact: bool = True,
+        num_projections: int = DEFAULT_SIMILARITY_SEARCH_NUM_PROJECTIONS,
+        leaf_size: int = 40,
+        random_seed: int = 1,
+        query_batch_size: int = 4096
+) -> List[Tuple[int, int, float]]:
+    """
+    Find all pairs of embeddings whose similarity is greater than or equal
+    to the threshold using radius queries against a BallTree.
+
+    The thresholds are translated into euclidean radii:
+        cosine      :   cos(a, b) >= t  <=>  ||a/|a| - b/|b|||  <= sqrt(2 - 2t)
+        euclidean   :   1 - ||a - b|| / (|a| + |b|) >= t  =>  ||a - b|| <= (1 - t)(|a| + max |b|)
+    Every candidate returned by the tree is verified with the exact similarity.
+
+    If exact is True the tree is built on the full embeddings and the result is identical
+    to find_similar_pairs. Otherwise the embeddings are first reduced to 'num_projections'
+    dimensions with a Gaussian random projection (which approximately preserves distances),
+    so queries are much faster but some pairs may be missed (see compute_recall).
+
+    Parameters:
+        embeddings      :   Embeddings (first dimension indexes peptides).
+        sim_fxn         :   'euclidean' or 'cosine'.
+        threshold       :   Similarity threshold.
+        exact           :   Search the full embeddings (True) or a random projection (False).
+        num_projections :   Number of random projection dimensions (exact=False only).
+        leaf_size       :   BallTree leaf size.
+        random_seed     :   Random seed of the projection (exact=False only).
+        query_batch_size:   Number of embeddings queried at a time.
+
+    Returns:
+        pairs           :   List of (index 1, index 2, similarity) where index 1 < index 2,
+                            ordered by index 1 and then by index 2.
+    """
+    from sklearn.neighbors import BallTree
+    if sim_fxn not in ('euclidean', 'cosine'):
+        raise ValueError("Similarity function must be 'euclidean' 'cosine'")
+    vectors = np.asarray(embeddings, dtype=np.float64).reshape(len(embeddings), -1)
+    if len(vectors) < 2:
+        return []
+    norms = np.linalg.norm(vectors, axis=1)
+    if sim_fxn == 'cosine':
+        points = vectors / np.maximum(norms, np.finfo(np.float64).tiny)[:, None]
+        radii = np.full(len(vectors), math.sqrt(max(2.0 - 2.0 * threshold, 0.0)))
+    else:
+        points = vectors
+        radii = max(1.0 - threshold, 0.0) * (norms + norms.max())
+    if not exact and num_projections < points.shape[1]:
+        rng = np.random.default_rng(random_seed)
+        projection = rng.normal(size=(points.shape[1], num_projections)) / math.sqrt(num_projections)
+        points = points @ projection
+    tree = BallTree(points, leaf_size=leaf_size)
+
+    all_rows, all_cols = [], []
+    for start in range(0, len(points), query_batch_size):
+        end = min(start + query_batch_size, len(points))
+        neighbors = tree.query_radius(points[start:end], r=radii[start:end])
+        counts = np.array([len(n) for n in neighbors], dtype=np.int64)
+        if counts.sum() == 0:
+            continue
+        rows = np.repeat(np.arange(start, end), counts)
+        cols = np.concatenate(neighbors).astype(np.int64)
+        keep = cols > rows
+        all_rows.append(rows[keep])
+        all_cols.append(cols[keep])
+    if len(all_rows) == 0:
+        return []
+    rows = np.concatenate(all_rows)
+    cols = np.concatenate(all_cols)
+    scores = _compute_pair_similarities(vectors=vectors, norms=norms, rows=rows, cols=cols, sim_fxn=sim_fxn)
+    keep = scores >= threshold
+    rows, cols, scores = rows[keep], cols[keep], scores[keep]
+    order = np.lexsort((cols, rows))
+    return list(zip(rows[order].tolist(), cols[order].tolist(), scores[order].tolist()))
+
+
+def select_top_k_pairs(
+        pairs: List[Tuple[int, int, float]],
+        top_k: int = 1
+) -> List[Tuple[int, int, float]]:
+    """
+    Keep the top k pairs per first index.
+
+    Parameters:
+        pairs           :   List of (index 1, index 2, similarity).
+        top_k           :   Maximum number of pairs to keep per first index.
+
+    Returns:
+        pairs           :   List of (index 1, index 2, similarity) ordered by index 1
+                            and then by decreasing similarity (ties by index 2).
+    """
+    if top_k < 1:
+        raise ValueError("top_k must be greater than or equal to 1.")
+    if len(pairs) == 0:
+        return []
+    rows = np.array([p[0] for p in pairs], dtype=np.int64)
+    cols = np.array([p[1] for p in pairs], dtype=np.int64)
+    scores = np.array([p[2] for p in pairs], dtype=np.float64)
+    order = np.lexsort((cols, -scores, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+    # Rank of each pair within its first index
+    group_starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    ranks = np.arange(len(rows)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(rows)]))
+    keep = ranks < top_k
+    return list(zip(rows[keep].tolist(), cols[keep].tolist(), scores[keep].tolist()))
+
+
+def compute_recall(
+        pairs: List[Tuple[int, int, float]],
+        reference_pairs: List[Tuple[int, int, float]]
+) -> Dict[str, float]:
+    """
+    Compute the recall of (approximate) similar pairs against reference (exact) pairs.
+
+    Parameters:
+        pairs           :   List of (index 1, index 2, similarity).
+        reference_pairs :   List of (index 1, index 2, similarity).
+
+    Returns:
+        report          :   Dictionary with the following keys:
+                            'num_pairs': number of pairs.
+                            'num_reference_pairs': number of reference pairs.
+                            'num_recovered_pairs': number of reference pairs found in pairs.
+                            'recall': num_recovered_pairs / num_reference_pairs (1.0 if there are no reference pairs).
+    """
+    found = set((i, j) for i, j, _ in pairs)
+    num_recovered = sum(1 for i, j, _ in reference_pairs if (i, j) in found)
+    return {
+        'num_pairs': len(pairs),
+        'num_reference_pairs': len(reference_pairs),
+        'num_recovered_pairs': num_recovered,
+        'recall': num_recovered / len(reference_pairs) if len(reference_pairs) > 0 else 1.0
+    }
@@ -20,7 +20,7 @@ import golfy
 import pandas as pd
 import random
 import socket
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 from .block_assignment import BlockAssignment
 from .logger import get_logger
 from .peptide import Peptide
@@ -102,6 +102,72 @@ def convert_dataframe_to_peptides(df_peptides: pd.DataFrame) -> List[Peptide]:
     return peptides
 
 
+def deduplicate_peptide_sequences(peptides: List[Peptide]) -> Tuple[List[str], List[str], Dict[str, List[str]]]:
+    """
+    Collapse peptides with identical sequences.
+
+    Parameters:
+        peptides                :   List of Peptide objects.
+
+    Returns:
+        unique_peptide_ids      :   ID of the first peptide with each distinct sequence.
+        unique_peptide_sequences:   Distinct sequences (in order of first appearance).
+        duplicate_peptide_ids   :   Mapping from a unique peptide ID to the IDs of the
+                                    other peptides with the same sequence.
+    """
+    first_peptide_ids: Dict[str, str] = {}
+    duplicate_peptide_ids: Dict[str, List[str]] = {}
+    for peptide in peptides:
+        first_peptide_id = first_peptide_ids.setdefault(peptide.sequence, peptide.id)
+        if first_peptide_id != peptide.id:
+            duplicate_peptide_ids.setdefault(first_peptide_id, []).append(peptide.id)
+    return list(first_peptide_ids.values()), list(first_peptide_ids.keys()), duplicate_peptide_ids
+
+
+def expand_duplicate_peptide_pairs(
+        peptide_pairs: List[Tuple[str, str, float]],
+        duplicate_peptide_ids: Dict[str, List[str]],
+        identical_score: float,
+        top_k: Optional[int] = None
+) -> List[Tuple[str, str, float]]:
+    """
+    Fan peptide pairs computed on unique sequences back out to every peptide ID.
+
+    Parameters:
+        peptide_pairs           :   List of (unique peptide ID, unique peptide ID, score).
+        duplicate_peptide_ids   :   Mapping returned by deduplicate_peptide_sequences.
+        identical_score         :   Score of a pair of identical sequences
+                                    (e.g. 1.0 for similarities, 0 for distances).
+        top_k                   :   Maximum number of pairs per first peptide ID added by the
+                                    fan-out (default: None, every combination is added).
+
+    Returns:
+        peptide_pairs           :   Pairs of identical peptides (the first peptide with each
+                                    other peptide with the same sequence), the supplied pairs,
+                                    and the combinations of the peptides of each supplied pair
+                                    whose first peptide ID has fewer than top_k pairs.
+    """
+    expanded_peptide_pairs = []
+    for peptide_id, other_peptide_ids in duplicate_peptide_ids.items():
+        for other_peptide_id in other_peptide_ids:
+            expanded_peptide_pairs.append((peptide_id, other_peptide_id, identical_score))
+    # The supplied pairs already respect top_k and are always kept
+    expanded_peptide_pairs.extend(peptide_pairs)
+    num_pairs: Dict[str, int] = {}
+    for peptide_id_1, _, _ in peptide_pairs:
+        num_pairs[peptide_id_1] = num_pairs.get(peptide_id_1, 0) + 1
+    for peptide_id_1, peptide_id_2, score in peptide_pairs:
+        for peptide_id_1_ in [peptide_id_1] + duplicate_peptide_ids.get(peptide_id_1, []):
+            for peptide_id_2_ in [peptide_id_2] + duplicate_peptide_ids.get(peptide_id_2, []):
+                if peptide_id_1_ == peptide_id_1 and peptide_id_2_ == peptide_id_2:
+                    continue
+                if top_k is not None and num_pairs.get(peptide_id_1_, 0) >= top_k:
+                    break
+                expanded_peptide_pairs.append((peptide_id_1_, peptide_id_2_, score))
+                num_pairs[peptide_id_1_] = num_pairs.get(peptide_id_1_, 0) + 1
+    return expanded_peptide_pairs
+
+
 def generate_random_seed():
     return random.randint(1, 100000000)
 
@@ -1,3 +1,4 @@
+import random
 from acelib.constants import GenerateMode, NumPlateWells
 from acelib.block_assignment import compute_transitive_neighbors, BlockAssignment
 from acelib.main import run_ace_generate
@@ -25,6 +26,26 @@ def test_compute_transitive_neighbors_1():
             assert 'peptide_6' in cluster
 
 
+def test_compute_transitive_neighbors_2():
+    peptide_pairs = [
+        ('peptide_1', 'peptide_2', 1.0),
+        ('peptide_7', 'peptide_8', 1.0),
+        ('peptide_3', 'peptide_2', 1.0),
+        ('peptide_8', 'peptide_9', 1.0),
+        ('peptide_1', 'peptide_3', 1.0),
+        ('peptide_4', 'peptide_4', 1.0)
+    ]
+    peptide_neighbors = compute_transitive_neighbors(
+        peptide_pairs=peptide_pairs
+    )
+    assert peptide_neighbors == [
+        ['peptide_1', 'peptide_2', 'peptide_3'],
+        ['peptide_7', 'peptide_8', 'peptide_9'],
+        ['peptide_4']
+    ]
+    assert compute_transitive_neighbors(peptide_pairs=[]) == []
+
+
 def test_block_assignment_1():
     peptides = []
     for i in range(1, 26):
@@ -126,3 +147,152 @@ def test_block_assignment_5():
     assert len(golfy_design[0].assignments[0].keys()) == 5
     assert len(golfy_design[0].assignments[1].keys()) == 5
     assert len(golfy_design[0].assignments[2].keys()) == 5
+
+
+def test_block_assignment_6():
+    excel_file = get_data_path(name='25peptides_5perpool_3x_configuration.xlsx')
+
+    block_assignment = BlockAssignment.read_excel_file(excel_file=excel_file)
+    index = block_assignment.assignment_index
+
+    assert index.num_peptides == 25
+    assert index.num_pools == 15
+    assert index.num_entries == 75
+    assert index.pool_peptides.shape == (15, 25)
+    assert index.peptide_pools.shape == (25, 15)
+    assert list(index.peptide_ids) == sorted(index.peptide_ids)
+    assert (index.pool_peptides.T.toarray() == index.peptide_pools.toarray()).all()
+    assert (index.peptide_pools.getnnz(axis=1) == 3).all()
+    peptide_id = index.peptide_ids[0]
+    peptide_idx = index.get_peptide_index(peptide_id=peptide_id)
+    assert sorted(block_assignment.get_pool_ids(peptide_id=peptide_id)) == \
+           sorted(index.pool_ids[index.peptide_pools[peptide_idx].indices].tolist())
+    assert len(index.to_dataframe()) == len(block_assignment.to_dataframe())
+    assert set(index.plate_ids.tolist()) == set(block_assignment.to_dataframe()['plate_id'])
+
+
+def test_block_assignment_7():
+    excel_file = get_data_path(name='25peptides_5perpool_3x_configuration.xlsx')
+
+    block_assignment = BlockAssignment.read_excel_file(excel_file=excel_file)
+
+    # Derived data is built once per version
+    assert block_assignment.assignment_index is block_assignment.assignment_index
+    df_assignment = block_assignment.to_dataframe()
+    df_assignment['pool_id'] = -1
+    assert (block_assignment.to_dataframe()['pool_id'] > 0).all()
+
+    # Mutations invalidate derived data
+    index = block_assignment.assignment_index
+    block_assignment.add_peptide(
+        peptide_id='peptide_26',
+        peptide_sequence='SIINFEKL',
+        coverage_id=1,
+        pool_id=16
+    )
+    assert block_assignment.assignment_index is not index
+    assert block_assignment.num_peptides == 26
+    assert block_assignment.num_pools == 16
+    assert block_assignment.get_peptide_sequence(peptide_id='peptide_26') == 'SIINFEKL'
+    assert block_assignment.get_pool_ids(peptide_id='peptide_26') == [16]
+    assert (block_assignment.to_dataframe()['plate_id'] == '').sum() == 1
+    block_assignment.assign_well_ids(num_plate_wells=NumPlateWells.WELLS_96)
+    assert (block_assignment.to_dataframe()['plate_id'] == '').sum() == 0
+    block_assignment.load_plate_map(plate_map={})
+    assert (block_assignment.to_dataframe()['plate_id'] == '').sum() == 76
+
+
+def test_block_assignment_8():
+    block_assignment = BlockAssignment()
+    pools = {
+        1: ['peptide_1', 'peptide_2', 'peptide_3'],
+        2: ['peptide_1', 'peptide_2', 'peptide_4'],
+        3: ['peptide_1', 'peptide_2', 'peptide_3'],
+        4: ['peptide_4', 'peptide_5']
+    }
+    for pool_id, peptide_ids in pools.items():
+        for peptide_id in peptide_ids:
+            block_assignment.add_peptide(
+                peptide_id=peptide_id,
+                peptide_sequence='',
+                coverage_id=1,
+                pool_id=pool_id
+            )
+
+    # (1,2) share 3 pools, (1,3) and (2,3) share 2 pools
+    assert block_assignment.num_violations == 4
+    assert block_assignment.violating_peptide_pairs == [
+        ('peptide_1', 'peptide_2', 3),
+        ('peptide_1', 'peptide_3', 2),
+        ('peptide_2', 'peptide_3', 2)
+    ]
+    assert block_assignment.pair_cooccurrence_counts.tolist() == [4, 3, 2, 1]
+    assert block_assignment.pair_cooccurrence_counts.sum() == 10
+
+
+def test_block_assignment_9():
+    # Two blocks of disjoint peptides whose pools (same IDs) are merged
+    random.seed(1)
+    block_assignments = []
+    for block_idx in range(0, 2):
+        block_assignment = BlockAssignment()
+        peptide_ids = ['block_%i_peptide_%i' % (block_idx, i) for i in range(1, 26)]
+        for coverage_id in range(1, 4):
+            random.shuffle(peptide_ids)
+            for i, peptide_id in enumerate(peptide_ids):
+                block_assignment.add_peptide(
+                    peptide_id=peptide_id,
+                    peptide_sequence='',
+                    coverage_id=coverage_id,
+                    pool_id=(coverage_id - 1) * 5 + i // 5 + 1
+                )
+        block_assignments.append(block_assignment)
+    num_violations = BlockAssignment.merge(block_assignments=block_assignments).num_violations
+
+    block_assignments_ = BlockAssignment.minimize_violations(
+        block_assignments=block_assignments,
+        shuffle_iters=200,
+        verbose=False
+    )
+
+    block_assignment = BlockAssignment.merge(block_assignments=block_assignments_)
+    assert block_assignment.num_violations < num_violations
+    assert block_assignment.num_pools == 15
+    for block_assignment, block_assignment_ in zip(block_assignments, block_assignments_):
+        # Pool IDs are only permuted within a coverage
+        pools = {(pool.coverage_id, tuple(p.id for p in pool.peptides)) for pool in block_assignment.pools.values()}
+        pools_ = {(pool.coverage_id, tuple(p.id for p in pool.peptides)) for pool in block_assignment_.pools.values()}
+        assert pools == pools_
+
+
+def test_block_assignment_10():
+    # 25 peptides (r, c) pooled by row, column and (r + c) mod 5 have no violations;
+    # split by column into two blocks whose pool IDs of block 2 are permuted within each coverage
+    pool_id_permutations = [[1, 2, 3, 4, 0], [0, 1, 2, 4, 3], [3, 4, 0, 1, 2]]
+    block_assignments = [BlockAssignment(), BlockAssignment()]
+    for r in range(0, 5):
+        for c in range(0, 5):
+            block_idx = 0 if c < 3 else 1
+            for coverage_id, line in enumerate([r, c, (r + c) % 5], start=1):
+                if block_idx == 1:
+                    line = pool_id_permutations[coverage_id - 1][line]
+                block_assignments[block_idx].add_peptide(
+                    peptide_id='peptide_%i_%i' % (r, c),
+                    peptide_sequence='',
+                    coverage_id=coverage_id,
+                    pool_id=(coverage_id - 1) * 5 + line + 1
+                )
+    assert BlockAssignment.merge(block_assignments=block_assignments).num_violations == 10
+
+    block_assignments_ = BlockAssignment.align_pool_ids(
+        block_assignments=block_assignments,
+        verbose=False
+    )
+
+    block_assignment = BlockAssignment.merge(block_assignments=block_assignments_)
+    assert block_assignment.num_violations == 0
+    assert block_assignment.is_optimal(num_coverage=3, num_peptides_per_pool=5, verbose=False)
+    for block_assignment, block_assignment_ in zip(block_assignments, block_assignments_):
+        pools = {(pool.coverage_id, tuple(p.id for p in pool.peptides)) for pool in block_assignment.pools.values()}
+        pools_ = {(pool.coverage_id, tuple(p.id for p in pool.peptides)) for pool in block_assignment_.pools.values()}
+        assert pools == pools_
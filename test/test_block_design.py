@@ -1,7 +1,8 @@
 from acelib.block_design import BlockDesign
-from acelib.constants import GenerateMode, NumPlateWells
+from acelib.constants import GenerateMode, GolfyStrategy, NumPlateWells, SequenceSimilarityFunction
 from acelib.main import run_ace_generate
 from acelib.peptide import Peptide
+from acelib.similarity_graph import csr_matrix_to_peptide_pairs, peptide_pairs_to_csr_matrix
 from .data import get_data_path
 
 
@@ -57,3 +58,27 @@ def test_block_design_2():
     assert df_design['num_plate_wells'].values[0] == 96
 
 
+def test_block_design_3():
+    peptides = [Peptide(id='peptide_%i' % i, sequence='') for i in range(1, 11)]
+    preferred_peptide_pairs = [('peptide_1', 'peptide_2', 0.9), ('peptide_5', 'peptide_3', 0.0), ('peptide_1', 'peptide_4', 0.95)]
+    block_design = BlockDesign(
+        num_peptides_per_pool=5,
+        num_coverage=3,
+        max_peptides_per_block=10,
+        num_plate_wells=96,
+        sequence_similarity_function=SequenceSimilarityFunction.LEVENSHTEIN,
+        init_strategy=GolfyStrategy.GREEDY,
+        peptides=peptides,
+        preferred_peptide_pairs=preferred_peptide_pairs
+    )
+
+    matrix = block_design.preferred_peptide_pairs_matrix
+    assert matrix.shape == (10, 10)
+    assert matrix.nnz == 3  # the zero score is kept as an explicit entry
+    assert matrix[0, 1] == 0.9 and matrix[0, 3] == 0.95 and matrix[2, 4] == 0.0
+    assert csr_matrix_to_peptide_pairs(matrix=matrix, peptide_ids=block_design.peptide_ids) == \
+           [('peptide_1', 'peptide_4', 0.95), ('peptide_1', 'peptide_2', 0.9), ('peptide_3', 'peptide_5', 0.0)]
+    assert csr_matrix_to_peptide_pairs(
+        matrix=peptide_pairs_to_csr_matrix(peptide_pairs=[], peptide_ids=block_design.peptide_ids),
+        peptide_ids=block_design.peptide_ids
+    ) == []
@@ -0,0 +1,56 @@
+import numpy as np
+from acelib.embedding_cache import EmbeddingCache
+
+
+def test_embedding_cache_1(tmp_path):
+    cache = EmbeddingCache(cache_dir=str(tmp_path))
+    embeddings = [np.arange(22, dtype=np.float32).reshape(11, 2), np.ones((5, 2), dtype=np.float32)]
+    cache.put(['SIINFEKLA', 'AAA'], embeddings, model_hash='model', representation='last_hidden_state')
+
+    hits = cache.get(['AAA', 'SIINFEKLA', 'CCC'], model_hash='model', representation='last_hidden_state')
+
+    assert sorted(hits.keys()) == [0, 1]
+    assert np.array_equal(hits[0], embeddings[1])
+    assert np.array_equal(hits[1], embeddings[0])
+    assert len(cache.get(['AAA'], model_hash='other_model', representation='last_hidden_state')) == 0
+    assert len(cache.get(['AAA'], model_hash='model', representation='mean_pooling')) == 0
+
+
+def test_embedding_cache_2(tmp_path):
+    cache = EmbeddingCache(cache_dir=str(tmp_path), max_size=3 * 16)
+    for sequence in ['A', 'C', 'D']:
+        cache.put([sequence], [np.zeros(4, dtype=np.float32)], model_hash='model', representation='mean_pooling')
+    cache.get(['A'], model_hash='model', representation='mean_pooling')
+    cache.put(['E'], [np.ones(4, dtype=np.float32)], model_hash='model', representation='mean_pooling')
+
+    # 'C' is the least recently used entry
+    hits = cache.get(['A', 'C', 'D', 'E'], model_hash='model', representation='mean_pooling')
+    assert sorted(hits.keys()) == [0, 2, 3]
+    assert cache.size <= 3 * 16
+
+    # Entries persist across instances
+    cache.close()
+    cache = EmbeddingCache(cache_dir=str(tmp_path), max_size=3 * 16)
+    assert np.array_equal(cache.get(['E'], model_hash='model', representation='mean_pooling')[0], np.ones(4))
+
+
+def test_embedding_cache_3(tmp_path):
+    max_size = 4 * 400
+    cache = EmbeddingCache(cache_dir=str(tmp_path), max_size=max_size)
+    sequences = ['P%i' % i for i in range(100)]
+    embeddings = [np.full(100, i, dtype=np.float32) for i in range(100)]
+    cache.put(['AAA'], [np.ones((3, 2), dtype=np.float64)], model_hash='model', representation='last_hidden_state')
+    cache.put(sequences, embeddings, model_hash='model', representation='mean_pooling')
+    cache.put(sequences[:2], embeddings[:2], model_hash='model', representation='mean_pooling')
+
+    # Array files are compacted after eviction (the 'AAA' namespace is removed)
+    disk_size = sum(f.stat().st_size for f in tmp_path.glob('*.dat'))
+    assert cache.size <= max_size
+    assert disk_size <= 2 * max_size
+    assert len(list(tmp_path.glob('*.dat'))) == 1
+
+    # Compacted entries keep their embeddings
+    hits = cache.get(sequences, model_hash='model', representation='mean_pooling')
+    assert sorted(hits.keys()) == [0, 1, 98, 99]
+    for idx, embedding in hits.items():
+        assert np.array_equal(embedding, embeddings[idx])
@@ -1,8 +1,8 @@
 import pandas as pd
-from acelib.constants import GenerateMode
+from acelib.constants import GenerateMode, SequenceSimilarityFunction
 from acelib.main import run_ace_generate
 from acelib.peptide import Peptide
-from acelib.utilities import convert_dataframe_to_peptides
+from acelib.utilities import convert_dataframe_to_peptides, deduplicate_peptide_sequences, expand_duplicate_peptide_pairs
 from importlib import resources
 from .data import get_data_path
 
@@ -278,3 +278,57 @@ def test_generate_cpsat_3():
     assert len(df_assignment['pool_id'].unique()) == 15
     assert len(df_assignment['coverage_id'].unique()) == 3
     assert all(len(group['pool_id'].unique()) == 3 for _, group in df_assignment.groupby('peptide_id'))
+
+
+def test_generate_golfy_9():
+    # Identical sequences are paired once and fanned out to every peptide ID
+    sequences = ['SIINFEKLAAG', 'SIINFEKLAAV', 'MKVLAAGLIRW', 'QWERTYIPASD', 'GHKLCVNMWEF']
+    peptides = []
+    for i in range(1, 21):
+        peptides.append(Peptide(id='peptide_%i' % i, sequence=sequences[(i - 1) % len(sequences)]))
+    unique_peptide_ids, unique_peptide_sequences, duplicate_peptide_ids = deduplicate_peptide_sequences(peptides=peptides)
+    assert unique_peptide_ids == ['peptide_%i' % i for i in range(1, 6)]
+    assert unique_peptide_sequences == sequences
+    assert duplicate_peptide_ids['peptide_1'] == ['peptide_6', 'peptide_11', 'peptide_16']
+
+    block_assignment, block_design = run_ace_generate(
+        peptides=peptides,
+        num_peptides_per_pool=5,
+        num_coverage=3,
+        trained_model_file='',
+        cluster_peptides=True,
+        mode=GenerateMode.GOLFY,
+        sequence_similarity_function=SequenceSimilarityFunction.KMER_JACCARD,
+        sequence_similarity_threshold=0.5,
+        golfy_random_seed=1,
+        verbose=False
+    )
+
+    preferred_peptide_pairs = {(p1, p2): score for p1, p2, score in block_design.preferred_peptide_pairs}
+    assert preferred_peptide_pairs[('peptide_1', 'peptide_6')] == 1.0
+    assert len([pair for pair, score in preferred_peptide_pairs.items() if score == 1.0]) == 5 * 3
+    # 'SIINFEKLAAG' and 'SIINFEKLAAV' are paired once and fanned out to one pair per peptide ID (top_k = 1)
+    assert sorted(pair for pair, score in preferred_peptide_pairs.items() if score < 1.0) == \
+           [('peptide_1', 'peptide_2'), ('peptide_11', 'peptide_2'), ('peptide_16', 'peptide_2'), ('peptide_6', 'peptide_2')]
+    df_assignment = block_assignment.to_dataframe()
+    assert len(df_assignment['peptide_id'].unique()) == 20
+
+
+def test_expand_duplicate_peptide_pairs_1():
+    # 'a' and 'b' are each shared by 10 peptide IDs
+    duplicate_peptide_ids = {'a': ['a%i' % i for i in range(1, 10)], 'b': ['b%i' % i for i in range(1, 10)]}
+    peptide_pairs = [('a', 'b', 0.9), ('a', 'c', 0.8)]
+
+    expanded_peptide_pairs = expand_duplicate_peptide_pairs(peptide_pairs, duplicate_peptide_ids, identical_score=1.0)
+    assert len(expanded_peptide_pairs) == 2 * 9 + 10 * 10 + 10 * 1
+
+    # With top_k, every peptide ID is the first peptide of at most top_k fanned-out pairs
+    for top_k in [1, 2]:
+        expanded_peptide_pairs = expand_duplicate_peptide_pairs(peptide_pairs, duplicate_peptide_ids, identical_score=1.0,
+                                                                top_k=top_k)
+        similar_pairs = [pair for pair in expanded_peptide_pairs if pair[2] < 1.0]
+        assert len([pair for pair in expanded_peptide_pairs if pair[2] == 1.0]) == 2 * 9
+        assert similar_pairs[:2] == peptide_pairs
+        assert len(similar_pairs) == 2 + 9 * top_k
+        assert all(sum(pair[0] == peptide_id for pair in similar_pairs[2:]) <= top_k for peptide_id in duplicate_peptide_ids['a'])
+        assert ('a1', 'b', 0.9) in similar_pairs
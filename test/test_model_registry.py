@@ -0,0 +1,169 @@
+import os
+import numpy as np
+import pytest
+import torch
+from transformers import AutoConfig, AutoModelForMaskedLM, EsmConfig, EsmForMaskedLM, EsmTokenizer
+from acelib.model_registry import get_ace_engine, evict_ace_engine, clear_ace_engines, get_num_ace_engines, \
+    get_bundled_model_dir, convert_trained_model_file, resolve_trained_model_file, compare_precision, export_ace_engine
+from acelib.sequence_features import AceNeuralEngine
+
+
+def _save_tiny_model(model_dir):
+    vocab = ['<cls>', '<pad>', '<eos>', '<unk>'] + list('LAGVSERTDIQKPNFYMHWCXBUZO.-') + ['<null_1>', '<mask>']
+    model_dir.mkdir()
+    (model_dir / 'vocab.txt').write_text('\n'.join(vocab))
+    EsmTokenizer(vocab_file=str(model_dir / 'vocab.txt')).save_pretrained(str(model_dir))
+    model = EsmForMaskedLM(EsmConfig(
+        vocab_size=len(vocab), hidden_size=16, num_hidden_layers=2, num_attention_heads=2,
+        intermediate_size=32, max_position_embeddings=64, position_embedding_type='rotary',
+        pad_token_id=1, mask_token_id=32
+    ))
+    model.save_pretrained(str(model_dir))
+    trained_model_file = str(model_dir / 'ace.pt')
+    torch.save(AceNeuralEngine(model, None, torch.device('cpu')).state_dict(), trained_model_file)
+    return trained_model_file
+
+
+def test_get_ace_engine_1(tmp_path):
+    model_dir = tmp_path / 'model'
+    trained_model_file = _save_tiny_model(model_dir)
+    clear_ace_engines()
+    ace_eng_1 = get_ace_engine(trained_model_file=trained_model_file, model_name=str(model_dir), device=torch.device('cpu'))
+    ace_eng_2 = get_ace_engine(trained_model_file=trained_model_file, model_name=str(model_dir), device=torch.device('cpu'))
+    assert ace_eng_1 is ace_eng_2
+    assert get_num_ace_engines() == 1
+    assert ace_eng_1.embed_sequences(['SIINFEKL']).shape == (1, 10, 16)
+    assert evict_ace_engine(trained_model_file=trained_model_file, model_name=str(model_dir), device=torch.device('cpu'))
+    assert get_num_ace_engines() == 0
+    ace_eng_3 = get_ace_engine(trained_model_file=trained_model_file, model_name=str(model_dir), device=torch.device('cpu'))
+    assert ace_eng_3 is not ace_eng_1
+    clear_ace_engines()
+    assert get_num_ace_engines() == 0
+
+
+def test_get_ace_engine_2(tmp_path):
+    # The bundled ESM2 tokenizer and configuration are used without the Hugging Face hub
+    model_dir = get_bundled_model_dir(model_name='facebook/esm2_t6_8M_UR50D')
+    assert model_dir is not None
+    config = AutoConfig.from_pretrained(model_dir)
+    model = AutoModelForMaskedLM.from_config(config)
+    trained_model_file = str(tmp_path / 'ace.pt')
+    torch.save(AceNeuralEngine(model, None, torch.device('cpu')).state_dict(), trained_model_file)
+
+    clear_ace_engines()
+    ace_eng = get_ace_engine(trained_model_file=trained_model_file, device=torch.device('cpu'))
+    embeddings = ace_eng.embed_sequences(['SIINFEKL', 'MKV'])
+    assert embeddings.shape == (2, 10, 320)
+
+    # A .safetensors file next to the trained model file is loaded instead and gives the same embeddings
+    safetensors_file = convert_trained_model_file(trained_model_file=trained_model_file)
+    assert resolve_trained_model_file(trained_model_file=trained_model_file) == safetensors_file
+    clear_ace_engines()
+    ace_eng = get_ace_engine(trained_model_file=trained_model_file, device=torch.device('cpu'))
+    assert np.allclose(ace_eng.embed_sequences(['SIINFEKL', 'MKV']), embeddings, atol=1e-5)
+    clear_ace_engines()
+
+
+def test_resolve_trained_model_file_1(tmp_path):
+    from safetensors.torch import save_file
+    trained_model_file = str(tmp_path / 'ace.pt')
+    safetensors_file = str(tmp_path / 'ace.safetensors')
+    torch.save({'weight': torch.zeros(2)}, trained_model_file)
+    assert resolve_trained_model_file(trained_model_file=trained_model_file) == trained_model_file
+    assert convert_trained_model_file(trained_model_file=trained_model_file) == safetensors_file
+    assert resolve_trained_model_file(trained_model_file=trained_model_file) == safetensors_file
+
+    # The .safetensors file records the weights it was converted from
+    torch.save({'weight': torch.ones(2)}, trained_model_file)
+    assert resolve_trained_model_file(trained_model_file=trained_model_file) == trained_model_file
+
+    # Without a recorded hash, the .safetensors file is used only if it is newer
+    save_file({'weight': torch.ones(2)}, safetensors_file)
+    os.utime(trained_model_file, (0, 0))
+    assert resolve_trained_model_file(trained_model_file=trained_model_file) == safetensors_file
+    os.utime(safetensors_file, (0, 0))
+    os.utime(trained_model_file, None)
+    assert resolve_trained_model_file(trained_model_file=trained_model_file) == trained_model_file
+
+
+def test_compare_precision_1(tmp_path):
+    model_dir = tmp_path / 'model'
+    trained_model_file = _save_tiny_model(model_dir)
+    peptide_sequences = ['SIINFEKL', 'SIINFEKV', 'ACDEFGHI', 'ACDEFGHK', 'MKVLAAGI', 'WWYYPPRR']
+    peptide_ids = ['peptide_%i' % i for i in range(len(peptide_sequences))]
+    clear_ace_engines()
+    for precision in ['bf16', 'int8']:
+        ace_eng = get_ace_engine(trained_model_file=trained_model_file, model_name=str(model_dir),
+                                 device=torch.device('cpu'), precision=precision)
+        assert ace_eng.precision == precision
+        assert ace_eng.embed_sequences(peptide_sequences).dtype == np.float32
+        report = compare_precision(
+            trained_model_file=trained_model_file,
+            peptide_ids=peptide_ids,
+            peptide_sequences=peptide_sequences,
+            precision=precision,
+            threshold=0.0,
+            model_name=str(model_dir),
+            device=torch.device('cpu')
+        )
+        assert report['num_pairs_fp32'] == 5
+        assert report['num_pairs'] == 5
+        assert report['max_score_difference'] < 0.05
+    assert get_num_ace_engines() == 3
+    clear_ace_engines()
+
+
+def test_export_ace_engine_1(tmp_path):
+    model_dir = tmp_path / 'model'
+    trained_model_file = _save_tiny_model(model_dir)
+    sequences = ['SIINFEKL', 'MKV', 'ACDEFGHIKLMNPQRSTVWY']
+    clear_ace_engines()
+    ace_eng = get_ace_engine(trained_model_file=trained_model_file, model_name=str(model_dir), device=torch.device('cpu'))
+    expected = ace_eng.embed_sequences(sequences, representation='mean_pooling', batch_size=2)
+
+    export_ace_engine(trained_model_file=trained_model_file, representation='mean_pooling', model_name=str(model_dir))
+    ts_ace_eng = get_ace_engine(trained_model_file=trained_model_file, model_name=str(model_dir), device=torch.device('cpu'),
+                                representation='mean_pooling')
+    assert ts_ace_eng is not ace_eng
+    assert ts_ace_eng.torchscript_module is not None
+    assert ts_ace_eng.model_hash == ace_eng.model_hash
+    assert np.allclose(ts_ace_eng.embed_sequences(sequences, representation='mean_pooling', batch_size=2), expected, atol=1e-6)
+    # Sequences of a length that was not traced
+    assert np.allclose(ts_ace_eng.embed_sequences(sequences * 2, representation='mean_pooling'),
+                       ace_eng.embed_sequences(sequences * 2, representation='mean_pooling'), atol=1e-6)
+    with pytest.raises(ValueError):
+        ts_ace_eng.embed_sequences(sequences, representation='last_hidden_state')
+
+    # Representations without a TorchScript file use the Hugging Face model
+    assert get_ace_engine(trained_model_file=trained_model_file, model_name=str(model_dir), device=torch.device('cpu'),
+                          representation='last_hidden_state') is ace_eng
+    clear_ace_engines()
+
+
+def test_export_ace_engine_2(tmp_path):
+    model_dir = tmp_path / 'model'
+    trained_model_file = _save_tiny_model(model_dir)
+    clear_ace_engines()
+    torchscript_file = export_ace_engine(trained_model_file=trained_model_file, representation='mean_pooling', model_name=str(model_dir))
+    metadata = AceNeuralEngine.read_torchscript_metadata(torchscript_file)
+    assert metadata['representation'] == 'mean_pooling'
+    assert metadata['precision'] == 'fp32'
+    ace_eng = get_ace_engine(trained_model_file=trained_model_file, model_name=str(model_dir), device=torch.device('cpu'),
+                             representation='mean_pooling')
+    assert ace_eng.torchscript_module is not None
+
+    # TorchScript files of another precision are not loaded
+    ace_eng = get_ace_engine(trained_model_file=trained_model_file, model_name=str(model_dir), device=torch.device('cpu'),
+                             precision='int8', representation='mean_pooling')
+    assert ace_eng.torchscript_module is None
+    assert ace_eng.precision == 'int8'
+
+    # TorchScript files exported from replaced weights are not loaded
+    clear_ace_engines()
+    state_dict = torch.load(trained_model_file)
+    torch.save({key: value + 1.0 if value.is_floating_point() else value for key, value in state_dict.items()}, trained_model_file)
+    ace_eng = get_ace_engine(trained_model_file=trained_model_file, model_name=str(model_dir), device=torch.device('cpu'),
+                             representation='mean_pooling')
+    assert ace_eng.torchscript_module is None
+    assert ace_eng.weights_hash != metadata['weights_hash']
+    clear_ace_engines()
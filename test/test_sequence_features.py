@@ -0,0 +1,326 @@
+import numpy as np
+import pytest
+import Levenshtein as levenshtein
+from acelib.kmer_similarity import compute_kmer_sets, compute_jaccard_similarity, compute_jaccard_similarities, \
+    find_kmer_paired_peptides, choose_lsh_bands
+from acelib.physicochemical_features import encode_peptides, find_physicochemical_paired_peptides
+from acelib.sequence_features import AceNeuralEngine
+from acelib.similarity_graph import csr_matrix_to_peptide_pairs
+from acelib.similarity_search import find_similar_pairs, find_top_k_similar_pairs, find_similar_pairs_indexed, \
+    select_top_k_pairs, compute_recall
+
+
+def _pairwise_similar_pairs(embeddings, sim_fxn, threshold):
+    pairs = []
+    for i in range(len(embeddings)):
+        for j in range(i + 1, len(embeddings)):
+            if sim_fxn == 'euclidean':
+                metric = AceNeuralEngine.euclidean_similarity(embeddings[i], embeddings[j])
+            else:
+                metric = AceNeuralEngine.cosine_similarity(embeddings[i], embeddings[j])
+            if metric >= threshold:
+                pairs.append((i, j, metric))
+    return pairs
+
+
+def test_find_similar_pairs_1():
+    rng = np.random.default_rng(1)
+    embeddings = rng.normal(size=(60, 11, 8)).astype(np.float32)
+
+    expected = _pairwise_similar_pairs(embeddings=embeddings, sim_fxn='euclidean', threshold=0.3)
+    pairs = find_similar_pairs(embeddings=embeddings, sim_fxn='euclidean', threshold=0.3, memory_budget=2000)
+
+    assert [(i, j) for i, j, _ in pairs] == [(i, j) for i, j, _ in expected]
+    assert np.allclose([s for _, _, s in pairs], [s for _, _, s in expected], atol=1e-5)
+
+
+def test_find_similar_pairs_2():
+    rng = np.random.default_rng(2)
+    embeddings = rng.normal(size=(60, 16)).astype(np.float32)
+
+    expected = _pairwise_similar_pairs(embeddings=embeddings, sim_fxn='cosine', threshold=0.2)
+    pairs = find_similar_pairs(embeddings=embeddings, sim_fxn='cosine', threshold=0.2, memory_budget=2000)
+
+    assert [(i, j) for i, j, _ in pairs] == [(i, j) for i, j, _ in expected]
+    assert np.allclose([s for _, _, s in pairs], [s for _, _, s in expected], atol=1e-5)
+
+
+def test_find_top_k_similar_pairs_1():
+    rng = np.random.default_rng(3)
+    embeddings = rng.normal(size=(80, 12)).astype(np.float32)
+    embeddings[10] = embeddings[3]
+    embeddings[20] = embeddings[3]
+
+    for top_k in [1, 3]:
+        expected = AceNeuralEngine.post_process(
+            find_similar_pairs(embeddings=embeddings, sim_fxn='euclidean', threshold=0.3, memory_budget=2000),
+            n=top_k
+        )
+        pairs = find_top_k_similar_pairs(embeddings=embeddings, sim_fxn='euclidean', threshold=0.3, top_k=top_k, memory_budget=2000)
+        assert pairs == expected
+
+
+def _tiny_ace_engine(tmp_path):
+    import torch
+    from transformers import EsmConfig, EsmForMaskedLM, EsmTokenizer
+    vocab = ['<cls>', '<pad>', '<eos>', '<unk>'] + list('LAGVSERTDIQKPNFYMHWCXBUZO.-') + ['<null_1>', '<mask>']
+    vocab_file = tmp_path / 'vocab.txt'
+    vocab_file.write_text('\n'.join(vocab))
+    tokenizer = EsmTokenizer(vocab_file=str(vocab_file))
+    torch.manual_seed(1)
+    model = EsmForMaskedLM(EsmConfig(
+        vocab_size=len(vocab), hidden_size=16, num_hidden_layers=2, num_attention_heads=2,
+        intermediate_size=32, max_position_embeddings=64, position_embedding_type='rotary',
+        pad_token_id=1, mask_token_id=32, output_hidden_states=True
+    ))
+    ace_eng = AceNeuralEngine(model, tokenizer, torch.device('cpu'))
+    ace_eng.eval()
+    return ace_eng
+
+
+def test_embed_sequences_1(tmp_path):
+    ace_eng = _tiny_ace_engine(tmp_path)
+    sequences = ['SIINFEKL', 'ACDEFGH', 'SIINFEKL', 'MKV', 'ACDEFGHIKLMN', 'WWW']
+
+    # Length-bucketed batches match one padded batch at the unpadded positions
+    embeddings = ace_eng.embed_sequences(sequences)
+    bucketed_embeddings = ace_eng.embed_sequences(sequences, batch_size=2)
+    assert bucketed_embeddings.shape == embeddings.shape
+    for idx, sequence in enumerate(sequences):
+        num_tokens = len(sequence) + 2
+        assert np.allclose(bucketed_embeddings[idx, :num_tokens], embeddings[idx, :num_tokens], atol=1e-4)
+        assert np.all(bucketed_embeddings[idx, num_tokens:] == 0)
+
+    embeddings = ace_eng.embed_sequences(sequences, representation='cls_embedding')
+    bucketed_embeddings = ace_eng.embed_sequences(sequences, representation='cls_embedding', batch_size=4)
+    assert np.allclose(bucketed_embeddings, embeddings, atol=1e-4)
+
+
+def test_find_similar_pairs_indexed_1():
+    rng = np.random.default_rng(4)
+    embeddings = rng.normal(size=(100, 6, 8))
+    embeddings = np.concatenate([embeddings, embeddings + 0.3 * rng.normal(size=embeddings.shape)])
+
+    for sim_fxn, threshold in [('euclidean', 0.7), ('cosine', 0.8)]:
+        expected = find_similar_pairs(embeddings=embeddings, sim_fxn=sim_fxn, threshold=threshold)
+        pairs = find_similar_pairs_indexed(embeddings=embeddings, sim_fxn=sim_fxn, threshold=threshold, exact=True)
+        assert [(i, j) for i, j, _ in pairs] == [(i, j) for i, j, _ in expected]
+        assert np.allclose([s for _, _, s in pairs], [s for _, _, s in expected], atol=1e-6)
+        assert compute_recall(pairs=pairs, reference_pairs=expected)['recall'] == 1.0
+
+        top_k_pairs = select_top_k_pairs(pairs, top_k=2)
+        expected_top_k_pairs = find_top_k_similar_pairs(embeddings=embeddings, sim_fxn=sim_fxn, threshold=threshold, top_k=2)
+        assert [(i, j) for i, j, _ in top_k_pairs] == [(i, j) for i, j, _ in expected_top_k_pairs]
+
+        # Approximate pairs are always true pairs
+        approximate_pairs = find_similar_pairs_indexed(embeddings=embeddings, sim_fxn=sim_fxn, threshold=threshold,
+                                                       exact=False, num_projections=16)
+        report = compute_recall(pairs=approximate_pairs, reference_pairs=expected)
+        assert report['num_recovered_pairs'] == report['num_pairs']
+        assert report['recall'] > 0.5
+
+
+def test_find_levenshtein_paired_peptides_1():
+    rng = np.random.default_rng(5)
+    amino_acids = list('ACDEFGHIKLMNPQRSTVWY')
+    peptide_sequences = []
+    for _ in range(60):
+        sequence = list(rng.choice(amino_acids, size=rng.integers(8, 11)))
+        peptide_sequences.append(''.join(sequence))
+        for _ in range(rng.integers(0, 3)):
+            idx = rng.integers(len(sequence))
+            if rng.random() < 0.5:
+                sequence[idx] = rng.choice(amino_acids)
+            else:
+                sequence.insert(idx, rng.choice(amino_acids))
+        peptide_sequences.append(''.join(sequence))
+    peptide_ids = ['peptide_%i' % i for i in range(len(peptide_sequences))]
+
+    for threshold in [1, 2, 3]:
+        expected = []
+        for i in range(len(peptide_sequences)):
+            for j in range(i + 1, len(peptide_sequences)):
+                distance = levenshtein.distance(peptide_sequences[i], peptide_sequences[j])
+                if distance <= threshold:
+                    expected.append((peptide_ids[i], peptide_ids[j], distance))
+        assert AceNeuralEngine.find_levenshtein_paired_peptides(peptide_ids, peptide_sequences, threshold=threshold) == expected
+    assert AceNeuralEngine.find_levenshtein_paired_peptides(peptide_ids, peptide_sequences, threshold=2, num_processes=2) == \
+           AceNeuralEngine.find_levenshtein_paired_peptides(peptide_ids, peptide_sequences, threshold=2)
+
+
+def test_find_hamming_paired_peptides_1():
+    rng = np.random.default_rng(6)
+    amino_acids = list('ACDEFGHIKLMNPQRSTVWY')
+    peptide_sequences = []
+    for _ in range(60):
+        sequence = list(rng.choice(amino_acids, size=9))
+        peptide_sequences.append(''.join(sequence))
+        for _ in range(rng.integers(0, 3)):
+            sequence[rng.integers(9)] = rng.choice(amino_acids)
+        peptide_sequences.append(''.join(sequence))
+        peptide_sequences.append(''.join(sequence[1:] + sequence[:1]))
+    peptide_ids = ['peptide_%i' % i for i in range(len(peptide_sequences))]
+
+    for threshold in [0, 1, 2]:
+        expected = []
+        for i in range(len(peptide_sequences)):
+            for j in range(i + 1, len(peptide_sequences)):
+                distance = levenshtein.hamming(peptide_sequences[i], peptide_sequences[j])
+                if distance <= threshold:
+                    expected.append((peptide_ids[i], peptide_ids[j], distance))
+        assert AceNeuralEngine.find_hamming_paired_peptides(peptide_ids, peptide_sequences, threshold=threshold) == expected
+    # Equal-length peptides within one edit are exactly those within one mismatch
+    assert AceNeuralEngine.find_levenshtein_paired_peptides(peptide_ids, peptide_sequences, threshold=1) == \
+           AceNeuralEngine.find_hamming_paired_peptides(peptide_ids, peptide_sequences, threshold=1)
+    with pytest.raises(ValueError):
+        AceNeuralEngine.find_hamming_paired_peptides(['a', 'b'], ['SIINFEKL', 'SIINFEK'], threshold=1)
+
+
+def test_embed_sequences_2(tmp_path):
+    ace_eng = _tiny_ace_engine(tmp_path)
+    sequences = ['SIINFEKL', 'ACDEFGH', 'MKV', 'ACDEFGHIKLMN']
+
+    # Pooled representations are reduced per batch into one vector per sequence
+    embeddings = ace_eng.embed_sequences(sequences, representation='mean_pooling')
+    bucketed_embeddings = ace_eng.embed_sequences(sequences, representation='mean_pooling', batch_size=2)
+    assert embeddings.shape == (4, 16)
+    assert np.allclose(bucketed_embeddings, embeddings, atol=1e-4)
+
+    embeddings = ace_eng.embed_sequences(sequences, representation='concatenate_mean_pooling', batch_size=2)
+    assert embeddings.shape == (4, 3 * 16)  # embedding layer output and two hidden layers
+    embeddings_float16 = ace_eng.embed_sequences(sequences, representation='concatenate_mean_pooling', batch_size=2, dtype=np.float16)
+    assert embeddings_float16.dtype == np.float16
+    assert np.allclose(embeddings_float16, embeddings, atol=1e-2)
+
+
+def test_find_paired_peptides_1(tmp_path):
+    ace_eng = _tiny_ace_engine(tmp_path)
+    peptide_ids = ['peptide_%i' % i for i in range(6)]
+    peptide_sequences = ['SIINFEKL', 'SIINFEKV', 'ACDEFGH', 'ACDEFGK', 'MKVLAAGL', 'MKVLAAGI']
+    for search_mode in ['matrix', 'index', 'pairwise']:
+        triples = ace_eng.find_paired_peptides(peptide_ids, peptide_sequences, threshold=0.5, top_k=2, search_mode=search_mode)
+        matrix = ace_eng.find_paired_peptides(peptide_ids, peptide_sequences, threshold=0.5, top_k=2, search_mode=search_mode,
+                                              return_sparse=True)
+        assert matrix.shape == (6, 6)
+        assert matrix.nnz == len(triples)
+        assert sorted(csr_matrix_to_peptide_pairs(matrix, peptide_ids)) == sorted(triples)
+
+
+def test_find_paired_peptides_2(tmp_path):
+    import inspect
+    import torch
+    from acelib.main import run_ace_generate
+    ace_eng = _tiny_ace_engine(tmp_path)
+    peptide_ids = ['peptide_%i' % i for i in range(4)]
+    peptide_sequences = ['SIINFEKL', 'SIINFEK', 'ACDEFGHIK', 'ACDEFGHI']
+
+    # By default, last_hidden_state scores compare the embeddings of one padded batch (as before batching)
+    assert inspect.signature(run_ace_generate).parameters['embedding_batch_size'].default is None
+    with torch.no_grad():
+        tokenized = ace_eng.tokenizer(peptide_sequences, padding=True, return_tensors='pt')
+        legacy_embeddings = ace_eng.forward(tokenized).numpy()
+    triples = ace_eng.find_paired_peptides(peptide_ids, peptide_sequences, threshold=-1.0, top_k=10)
+    assert len(triples) == 6
+    for peptide_id1, peptide_id2, score in triples:
+        i = peptide_ids.index(peptide_id1)
+        j = peptide_ids.index(peptide_id2)
+        assert np.isclose(score, AceNeuralEngine.euclidean_similarity(legacy_embeddings[i], legacy_embeddings[j]), atol=1e-6)
+
+    # Length-bucketed batches (opt-in) compare zero-padded embeddings
+    triples = ace_eng.find_paired_peptides(peptide_ids, peptide_sequences, threshold=-1.0, top_k=10, batch_size=2)
+    zero_padded = ace_eng.embed_sequences(peptide_sequences, batch_size=2)
+    for peptide_id1, peptide_id2, score in triples:
+        i = peptide_ids.index(peptide_id1)
+        j = peptide_ids.index(peptide_id2)
+        assert np.isclose(score, AceNeuralEngine.euclidean_similarity(zero_padded[i], zero_padded[j]), atol=1e-5)
+
+
+def test_find_physicochemical_paired_peptides_1():
+    profiles = encode_peptides(['ACD', 'AC', 'XZ'], encoding='positional')
+    assert profiles.shape == (3, 3 * 15)
+    assert not np.isnan(profiles).any()
+    assert np.all(profiles[1, 2 * 15:] == 0)
+    assert np.all(profiles[2] == 0)
+    profiles = encode_peptides(['ACD', 'DCA'], encoding='composition')
+    assert profiles.shape == (2, 15)
+    assert np.allclose(profiles[0], profiles[1])
+
+    peptide_ids = ['peptide_1', 'peptide_2', 'peptide_3', 'peptide_4']
+    peptide_sequences = ['SIINFEKL', 'SIINFEKV', 'WWWPPPGG', 'SIINFEKL']
+    paired_peptides = find_physicochemical_paired_peptides(
+        peptide_ids=peptide_ids,
+        peptide_sequences=peptide_sequences,
+        threshold=0.8
+    )
+    assert paired_peptides[0][:2] == ('peptide_1', 'peptide_4')
+    assert np.isclose(paired_peptides[0][2], 1.0)
+    assert ('peptide_2', 'peptide_4') in [p[:2] for p in paired_peptides]
+    assert 'peptide_3' not in [p[0] for p in paired_peptides] + [p[1] for p in paired_peptides]
+
+
+def test_find_kmer_paired_peptides_1():
+    # Overlapping 9-mer tiles of one protein sequence
+    protein = 'MFVFLVLLPLVSSQCVNLTTRTQLPPAYTNSFTRGVYYPDKVFRSSVLHSTQDLFLPFFSNVTWFHAIHVSGTNGTKRFDN'
+    peptide_sequences = [protein[i:i + 9] for i in range(0, len(protein) - 8)] + ['', 'SIINFEKL']
+    peptide_ids = ['peptide_%i' % i for i in range(len(peptide_sequences))]
+    kmer_sets = compute_kmer_sets(peptide_sequences, k=3)
+
+    for threshold in [0.3, 0.5, 0.7]:
+        expected = set()
+        for i in range(len(peptide_sequences)):
+            for j in range(i + 1, len(peptide_sequences)):
+                similarity = compute_jaccard_similarity(kmer_sets[i], kmer_sets[j])
+                if similarity >= threshold:
+                    expected.add((peptide_ids[i], peptide_ids[j], similarity))
+        paired_peptides = find_kmer_paired_peptides(peptide_ids, peptide_sequences, threshold=threshold, k=3, top_k=len(peptide_ids))
+        assert set(paired_peptides) == expected
+
+    paired_peptides = find_kmer_paired_peptides(peptide_ids, peptide_sequences, threshold=0.7, k=3)
+    assert paired_peptides[0] == ('peptide_0', 'peptide_1', 0.75)
+
+
+def test_find_kmer_paired_peptides_2(caplog):
+    rng = np.random.default_rng(2)
+    peptide_sequences = [''.join(rng.choice(list('ACDE'), size=rng.integers(0, 12))) for _ in range(50)]
+    kmer_sets = compute_kmer_sets(peptide_sequences, k=2)
+    pairs = rng.integers(0, len(peptide_sequences), size=(300, 2))
+    similarities = compute_jaccard_similarities(kmer_sets, pairs, block_size=7)
+    for (i, j), similarity in zip(pairs.tolist(), similarities.tolist()):
+        assert similarity == compute_jaccard_similarity(kmer_sets[i], kmer_sets[j])
+
+    # Thresholds that no band split can reach are reported
+    assert choose_lsh_bands(threshold=0.5, num_permutations=128) == (64, 2)
+    assert 'increase the number of permutations' not in caplog.text
+    assert choose_lsh_bands(threshold=0.1, num_permutations=16) == (16, 1)
+    assert 'increase the number of permutations' in caplog.text
+
+
+def test_find_incremental_paired_peptides_1(tmp_path):
+    ace_eng = _tiny_ace_engine(tmp_path)
+    rng = np.random.default_rng(7)
+    amino_acids = list('ACDEFGHIKLMNPQRSTVWY')
+    peptide_sequences = [''.join(rng.choice(amino_acids, size=rng.integers(7, 10))) for _ in range(40)]
+    peptide_ids = ['peptide_%i' % i for i in range(len(peptide_sequences))]
+    for representation in ['mean_pooling', 'last_hidden_state']:
+        expected = ace_eng.find_paired_peptides(peptide_ids, peptide_sequences, representation=representation, threshold=0.6,
+                                                top_k=2, batch_size=8)
+        pairs = ace_eng.find_paired_peptides(peptide_ids[:30], peptide_sequences[:30], representation=representation, threshold=0.6,
+                                             top_k=2, batch_size=8)
+        embeddings = None
+        for start, end in [(30, 35), (35, 40)]:
+            pairs, embeddings = ace_eng.find_incremental_paired_peptides(
+                peptide_ids[:start], peptide_sequences[:start], pairs, peptide_ids[start:end], peptide_sequences[start:end],
+                embeddings=embeddings, representation=representation, threshold=0.6, top_k=2, batch_size=8
+            )
+        assert len(embeddings) == 40
+        assert [(p1, p2) for p1, p2, _ in pairs] == [(p1, p2) for p1, p2, _ in expected]
+        assert np.allclose([s for _, _, s in pairs], [s for _, _, s in expected], atol=1e-6)
+
+
+def test_embed_sequences_sharded_1(tmp_path):
+    ace_eng = _tiny_ace_engine(tmp_path)
+    sequences = ['SIINFEKL', 'ACDEFGH', 'MKV', 'ACDEFGHIKLMN', 'SIINFEKV', 'MKVLAAGL', 'ACD']
+    expected = ace_eng.embed_sequences(sequences, batch_size=2)
+    embeddings = ace_eng.embed_sequences(sequences, batch_size=2, num_processes=2)
+    assert embeddings.shape == expected.shape
+    assert np.allclose(embeddings, expected, atol=1e-5)
@@ -1,4 +1,7 @@
+import os
 import pandas as pd
+import subprocess
+import sys
 from .data import get_data_path
 from acelib.block_assignment import BlockAssignment
 from acelib.block_design import BlockDesign
@@ -18,3 +21,25 @@ def test_verify():
     )
     assert is_optimal, "'25peptides_5perpool_3x_configuration.xlsx' " \
                        "is an optimal ELISpot assignment."
+
+
+def test_verify_import_time():
+    # 'ace verify' and 'ace deconvolve' must not import the neural network, solver or search backends
+    code = "import sys, acelib.cli.cli_main; " \
+           "print(','.join(m for m in ('torch', 'transformers', 'ortools', 'sklearn', 'Levenshtein', 'scipy.spatial', " \
+           "'scipy.optimize') if m in sys.modules))"
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, env=os.environ.copy(), check=True)
+    assert result.stdout.strip() == ''
+
+    # 'ace generate' with a non-neural sequence similarity function must not import the neural network backends
+    code = "import sys; " \
+           "from acelib.constants import GenerateMode, SequenceSimilarityFunction; " \
+           "from acelib.main import run_ace_generate; " \
+           "from acelib.peptide import Peptide; " \
+           "peptides = [Peptide(id='peptide_%i' % i, sequence='SIINFEK' + 'ACDEFGHIKLMNPQRSTVWY'[i % 20]) for i in range(25)]; " \
+           "run_ace_generate(peptides=peptides, num_peptides_per_pool=5, num_coverage=3, trained_model_file='', " \
+           "cluster_peptides=True, mode=GenerateMode.GOLFY, sequence_similarity_function=SequenceSimilarityFunction.LEVENSHTEIN, " \
+           "sequence_similarity_threshold=1, verbose=False); " \
+           "print(','.join(m for m in ('torch', 'transformers') if m in sys.modules))"
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, env=os.environ.copy(), check=True)
+    assert result.stdout.strip() == ''